@@ -3,11 +3,16 @@ Tool 2: Categorize Transaction
 Hybrid approach: LLM + Rule-based logic for maximum accuracy
 """
 
+import os
 import re
+import asyncio
 import json
 import logging
-from typing import Dict, Any, Optional
-from agent_tools.toolbox_wrapper import get_toolbox
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Any, List, Optional, Tuple
+from agent_tools.toolbox_wrapper import TTLCache, _json_dumps, _json_loads, get_toolbox
+from agent_tools.fetch_transactions import FETCH_PAGE_SIZE, iter_unprocessed_transaction_pages
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -16,13 +21,17 @@ logger = logging.getLogger(__name__)
 # Import Gemini for LLM categorization
 try:
     import google.generativeai as genai
-    import os
     
     # Configure Gemini
     GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
     if GEMINI_API_KEY:
         genai.configure(api_key=GEMINI_API_KEY)
         llm_model = genai.GenerativeModel('gemini-flash-lite-latest')
+        # Shared by every single-transaction call instead of rebuilt per request
+        _GEN_CONFIG = genai.types.GenerationConfig(
+            temperature=0.1,  # Low temperature for consistency
+            max_output_tokens=300,
+        )
         LLM_AVAILABLE = True
         logger.info("✅ Gemini LLM initialized for categorization")
     else:
@@ -51,6 +60,16 @@ CATEGORIES = [
     "Other"
 ]
 
+# Number of transactions sent to Gemini in one batched prompt.
+# Larger batches save more round-trips but accuracy degrades past ~20.
+LLM_BATCH_SIZE = int(os.environ.get("CATEGORIZATION_BATCH_SIZE", "15"))
+
+# Maximum Gemini requests in flight for the async categorization path.
+MAX_LLM_CONCURRENCY = int(os.environ.get("CATEGORIZATION_MAX_CONCURRENCY", "8"))
+
+# Fetched rows buffered ahead of the categorization workers
+PIPELINE_QUEUE_SIZE = 32
+
 
 def categorize_transaction(
     transaction_id: str,
@@ -65,8 +84,9 @@ def categorize_transaction(
     
     Hybrid Strategy:
     1. Standardize merchant name using intelligent rules
-    2. Get LLM categorization (if available)
-    3. Get rule-based categorization (always)
+    2. Get rule-based categorization (always)
+    3. Get LLM categorization (if available, skipped for known merchants
+       the rules already categorize with high confidence)
     4. Combine both results for highest accuracy
     5. Store result in database
     
@@ -92,15 +112,26 @@ def categorize_transaction(
     """
     
     try:
-        logger.info(f"🏷️ Categorizing transaction {transaction_id}: {merchant_name}")
+        logger.info("🏷️ Categorizing transaction %s: %s", transaction_id, merchant_name)
         
         # Step 1: Standardize merchant name
-        merchant_standardized = _standardize_merchant_name(merchant_name)
-        logger.info(f"   Standardized: {merchant_name} → {merchant_standardized}")
+        merchant_standardized, merchant_lower = _standardize_merchant(merchant_name)
+        logger.info("   Standardized: %s → %s", merchant_name, merchant_standardized)
         
-        # Step 2: Get LLM categorization (if available)
+        # Step 2: Get rule-based categorization (always as fallback)
+        rules_result = _categorize_with_rules(
+            merchant=merchant_name,
+            merchant_standardized=merchant_standardized,
+            amount=abs(amount),
+            description=description,
+            merchant_lower=merchant_lower
+        )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("   Rules: %s (confidence: %.2f)", rules_result['category'], rules_result['confidence'])
+        
+        # Step 3: Get LLM categorization (if available and rules aren't decisive)
         llm_result = None
-        if LLM_AVAILABLE:
+        if LLM_AVAILABLE and not _rules_are_decisive(merchant_standardized, rules_result):
             try:
                 llm_result = _categorize_with_llm(
                     merchant=merchant_name,
@@ -108,81 +139,631 @@ def categorize_transaction(
                     amount=abs(amount),
                     description=description
                 )
-                logger.info(f"   LLM: {llm_result['category']} (confidence: {llm_result['confidence']:.2f})")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("   LLM: %s (confidence: %.2f)", llm_result['category'], llm_result['confidence'])
             except Exception as e:
-                logger.warning(f"   LLM categorization failed: {e}")
+                logger.warning("   LLM categorization failed: %s", e)
+        
+        # Step 4: Combine results intelligently
+        final_result = _combine_categorization_results(llm_result, rules_result)
+        
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "   ✅ FINAL: %s (method: %s, confidence: %.2f)",
+                final_result['category'], final_result['method'], final_result['confidence']
+            )
+        
+        # Step 5: Store in processed_transactions via MCP tool
+        return _store_categorization(transaction_id, user_id, merchant_standardized, final_result)
+    
+    except Exception as e:
+        logger.error("❌ Error categorizing transaction %s: %s", transaction_id, e, exc_info=True)
+        
+        return {
+            "status": "error",
+            "transaction_id": transaction_id,
+            "message": f"Categorization failed: {str(e)}"
+        }
+
+
+def categorize_transactions_batch(
+    transactions: List[Dict[str, Any]],
+    user_id: str
+) -> Dict[str, Any]:
+    """
+    Categorizes MANY transactions at once using the same HYBRID approach as
+    categorize_transaction, but sends them to the LLM in batched prompts
+    (LLM_BATCH_SIZE transactions per Gemini call) instead of one call each.
+    Prefer this tool over calling categorize_transaction in a loop.
+    
+    Args:
+        transactions: List of transaction dicts as returned by fetch_transactions.
+            Each needs "transaction_id", "merchant_name" (or "name"), "amount"
+            and optionally "name"/"description" (required).
+        user_id: User ID for database storage (required).
+    
+    Returns:
+        A dictionary containing:
+        {
+            "status": "success" or "error",
+            "categorized_count": Number of transactions stored successfully,
+            "failed_count": Number of transactions that failed,
+            "results": Per-transaction results (same shape as categorize_transaction),
+            "message": Status message
+        }
+    """
+    
+    try:
+        logger.info("🏷️ Batch categorizing %d transactions for user %s", len(transactions), user_id)
+        
+        results = []
+        categorized = []
+        for start in range(0, len(transactions), LLM_BATCH_SIZE):
+            chunk = transactions[start:start + LLM_BATCH_SIZE]
+            
+            # Step 1: Standardize merchant names
+            prepared = []
+            for txn in chunk:
+                merchant_name = txn.get('merchant_name') or txn.get('name') or ''
+                merchant_standardized, merchant_lower = _standardize_merchant(merchant_name)
+                prepared.append({
+                    'transaction_id': txn.get('transaction_id'),
+                    'merchant': merchant_name,
+                    'merchant_standardized': merchant_standardized,
+                    'merchant_lower': merchant_lower,
+                    'amount': abs(float(txn.get('amount') or 0)),
+                    'description': txn.get('description') or txn.get('name') or '',
+                })
+            
+            # Step 2: Rule-based categorization for the whole chunk
+            rules_results = _categorize_batch_with_rules(
+                [item['merchant_lower'] for item in prepared],
+                [item['description'] for item in prepared],
+                [item['amount'] for item in prepared]
+            )
+            for item, rules_result in zip(prepared, rules_results):
+                item['rules_result'] = rules_result
+            
+            # Step 3: One LLM call for the transactions rules can't settle (if available)
+            llm_results = [None] * len(prepared)
+            undecided = [
+                i for i, item in enumerate(prepared)
+                if not _rules_are_decisive(item['merchant_standardized'], item['rules_result'])
+            ]
+            if LLM_AVAILABLE and undecided:
+                # Repeat merchant/amount patterns reuse an earlier answer
+                misses = []
+                for i in undecided:
+                    item = prepared[i]
+                    item['llm_cache_key'] = _llm_cache_key(
+                        item['merchant_standardized'], item['amount'], item['description']
+                    )
+                    llm_results[i] = _get_cached_llm_result(item['llm_cache_key'])
+                    if llm_results[i] is None:
+                        misses.append(i)
+                
+                if misses:
+                    try:
+                        batch_results = _categorize_batch_with_llm([prepared[i] for i in misses])
+                        for i, llm_result in zip(misses, batch_results):
+                            llm_results[i] = llm_result
+                            if llm_result is not None:
+                                _cache_llm_result(prepared[i]['llm_cache_key'], llm_result)
+                    except Exception as e:
+                        logger.warning("   Batch LLM categorization failed: %s", e)
+            
+            # Step 4: Combine per transaction (stored together below)
+            for item, llm_result in zip(prepared, llm_results):
+                try:
+                    final_result = _combine_categorization_results(llm_result, item['rules_result'])
+                    categorized.append((item['transaction_id'], item['merchant_standardized'], final_result))
+                except Exception as e:
+                    logger.error("❌ Error categorizing transaction %s: %s", item['transaction_id'], e, exc_info=True)
+                    results.append({
+                        "status": "error",
+                        "transaction_id": item['transaction_id'],
+                        "message": f"Categorization failed: {str(e)}"
+                    })
+        
+        # Step 5: Store every categorization with one multi-row insert
+        if categorized:
+            results.extend(_store_categorizations_batch(user_id, categorized))
+        
+        succeeded = sum(1 for r in results if r['status'] == 'success')
+        failed = len(results) - succeeded
+        
+        logger.info("   ✅ Batch complete: %d categorized, %d failed", succeeded, failed)
         
-        # Step 3: Get rule-based categorization (always as fallback)
+        return {
+            "status": "success" if failed == 0 else "partial",
+            "categorized_count": succeeded,
+            "failed_count": failed,
+            "results": results,
+            "message": f"Categorized {succeeded}/{len(results)} transactions"
+        }
+    
+    except Exception as e:
+        logger.error("❌ Error in batch categorization: %s", e, exc_info=True)
+        
+        return {
+            "status": "error",
+            "categorized_count": 0,
+            "failed_count": len(transactions),
+            "results": [],
+            "message": f"Batch categorization failed: {str(e)}"
+        }
+
+
+async def acategorize_transaction(
+    transaction_id: str,
+    merchant_name: str,
+    amount: float,
+    description: str,
+    user_id: str
+) -> Dict[str, Any]:
+    """
+    Async version of categorize_transaction. The Gemini call is awaited and the
+    database write runs in a worker thread, so many transactions can be
+    categorized concurrently (see acategorize_transactions).
+    
+    Args and return value are identical to categorize_transaction.
+    """
+    
+    try:
+        logger.info("🏷️ Categorizing transaction %s: %s", transaction_id, merchant_name)
+        
+        # Step 1: Standardize merchant name
+        merchant_standardized, merchant_lower = _standardize_merchant(merchant_name)
+        
+        # Step 2: Get rule-based categorization (always as fallback)
         rules_result = _categorize_with_rules(
             merchant=merchant_name,
             merchant_standardized=merchant_standardized,
             amount=abs(amount),
-            description=description
+            description=description,
+            merchant_lower=merchant_lower
         )
-        logger.info(f"   Rules: {rules_result['category']} (confidence: {rules_result['confidence']:.2f})")
+        
+        # Step 3: Get LLM categorization (if available and rules aren't decisive)
+        llm_result = None
+        if LLM_AVAILABLE and not _rules_are_decisive(merchant_standardized, rules_result):
+            try:
+                llm_result = await _acategorize_with_llm(
+                    merchant=merchant_name,
+                    merchant_standardized=merchant_standardized,
+                    amount=abs(amount),
+                    description=description
+                )
+            except Exception as e:
+                logger.warning("   LLM categorization failed: %s", e)
         
         # Step 4: Combine results intelligently
         final_result = _combine_categorization_results(llm_result, rules_result)
         
-        logger.info(f"   ✅ FINAL: {final_result['category']} (method: {final_result['method']}, confidence: {final_result['confidence']:.2f})")
-        
-        # Step 5: Store in processed_transactions via MCP tool
-        toolbox = get_toolbox()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "   ✅ FINAL: %s (method: %s, confidence: %.2f)",
+                final_result['category'], final_result['method'], final_result['confidence']
+            )
         
-        store_result = toolbox.call_tool(
-            "insert-processed-transaction",
-            transaction_id=transaction_id,
-            user_id=user_id,
-            category_ai=final_result['category'],
-            merchant_standardized=merchant_standardized,
-            is_subscription=False,  # Will be updated by subscription detector
-            subscription_confidence=None,
-            is_anomaly=False,  # Will be updated by fraud detector
-            anomaly_score="0.00",
-            anomaly_reason=None,
-            is_bill=False,
-            bill_cycle_day=None,
-            tags=json.dumps(final_result.get('tags', [])) if final_result.get('tags') else None,
-            notes=final_result.get('reasoning')
+        # Step 5: Store in processed_transactions without blocking the event loop
+        return await asyncio.to_thread(
+            _store_categorization, transaction_id, user_id, merchant_standardized, final_result
         )
-        
-        if not store_result['success']:
-            return {
-                "status": "error",
-                "transaction_id": transaction_id,
-                "message": f"Failed to store categorization: {store_result.get('error')}"
-            }
+    
+    except Exception as e:
+        logger.error("❌ Error categorizing transaction %s: %s", transaction_id, e, exc_info=True)
         
         return {
-            "status": "success",
+            "status": "error",
             "transaction_id": transaction_id,
-            "category": final_result['category'],
-            "merchant_standardized": merchant_standardized,
-            "confidence": final_result['confidence'],
-            "tags": final_result.get('tags', []),
-            "method": final_result['method'],
-            "message": f"Successfully categorized as {final_result['category']} (via {final_result['method']})"
+            "message": f"Categorization failed: {str(e)}"
         }
+
+
+async def acategorize_transactions(
+    transactions: List[Dict[str, Any]],
+    user_id: str,
+    max_concurrency: int = MAX_LLM_CONCURRENCY
+) -> List[Dict[str, Any]]:
+    """
+    Categorize transactions concurrently with at most `max_concurrency`
+    Gemini calls in flight. Results are returned in input order.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
     
-    except Exception as e:
-        logger.error(f"❌ Error categorizing transaction {transaction_id}: {e}", exc_info=True)
-        
+    async def _bounded(txn: Dict[str, Any]) -> Dict[str, Any]:
+        async with semaphore:
+            return await _acategorize_row(txn, user_id)
+    
+    return await asyncio.gather(*[_bounded(txn) for txn in transactions])
+
+
+async def fetch_and_categorize_transactions(
+    user_id: str,
+    page_size: int = FETCH_PAGE_SIZE,
+    max_concurrency: int = MAX_LLM_CONCURRENCY
+) -> Dict[str, Any]:
+    """
+    Fetches unprocessed transactions page by page and categorizes them while
+    later pages are still being read, so database and LLM time overlap.
+    Prefer this tool over fetch_transactions + categorize_transactions_batch
+    when a user has many unprocessed transactions.
+    
+    Args:
+        user_id: The user's ID to fetch and categorize transactions for (required).
+        page_size: Rows per database page (default: FETCH_PAGE_SIZE).
+        max_concurrency: Maximum categorizations in flight (default: MAX_LLM_CONCURRENCY).
+    
+    Returns:
+        A dictionary containing:
+        {
+            "status": "success", "partial" or "error",
+            "categorized_count": Number of transactions stored successfully,
+            "failed_count": Number of transactions that failed,
+            "results": Per-transaction results (same shape as categorize_transaction)
+                with the fetched row under "transaction", in completion order,
+            "message": Status message
+        }
+    """
+    logger.info("🏷️ Streaming categorization of unprocessed transactions for user %s", user_id)
+    
+    # Bounded so a fast database can't run far ahead of the LLM
+    queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    results: List[Dict[str, Any]] = []
+    
+    async def _produce() -> None:
+        pages = iter_unprocessed_transaction_pages(user_id, page_size)
+        try:
+            while True:
+                page = await asyncio.to_thread(next, pages, None)
+                if page is None:
+                    break
+                for txn in page:
+                    await queue.put(txn)
+        finally:
+            # One stop marker per consumer, also when fetching failed
+            for _ in range(max_concurrency):
+                await queue.put(None)
+    
+    async def _consume() -> None:
+        while True:
+            txn = await queue.get()
+            if txn is None:
+                return
+            try:
+                result = await _acategorize_row(txn, user_id)
+            except Exception as e:
+                # Keep draining the queue so the producer never blocks on a dead consumer
+                result = {
+                    "status": "error",
+                    "transaction_id": txn.get('transaction_id'),
+                    "message": f"Categorization failed: {str(e)}"
+                }
+            results.append({**result, "transaction": txn})
+    
+    outcomes = await asyncio.gather(
+        _produce(),
+        *[_consume() for _ in range(max_concurrency)],
+        return_exceptions=True
+    )
+    fetch_error = outcomes[0] if isinstance(outcomes[0], BaseException) else None
+    if fetch_error is not None:
+        logger.error("❌ Error fetching transactions: %s", fetch_error)
+    
+    categorized_count = sum(1 for r in results if r.get("status") == "success")
+    failed_count = len(results) - categorized_count
+    
+    if fetch_error is not None and not results:
+        status = "error"
+    elif fetch_error is not None or failed_count:
+        status = "partial"
+    else:
+        status = "success"
+    
+    message = f"Categorized {categorized_count} of {len(results)} fetched transactions"
+    if fetch_error is not None:
+        message += f" (fetch stopped early: {fetch_error})"
+    
+    return {
+        "status": status,
+        "categorized_count": categorized_count,
+        "failed_count": failed_count,
+        "results": results,
+        "message": message
+    }
+
+
+async def _acategorize_row(txn: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    """acategorize_transaction for a transaction row as returned by fetch_transactions"""
+    return await acategorize_transaction(
+        transaction_id=txn.get('transaction_id'),
+        merchant_name=txn.get('merchant_name') or txn.get('name') or '',
+        amount=float(txn.get('amount') or 0),
+        description=txn.get('description') or txn.get('name') or '',
+        user_id=user_id
+    )
+
+
+def _processed_transaction_row(
+    transaction_id: str,
+    user_id: str,
+    merchant_standardized: str,
+    final_result: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Column values for processed_transactions from a combined result"""
+    return {
+        "transaction_id": transaction_id,
+        "user_id": user_id,
+        "category_ai": final_result['category'],
+        "merchant_standardized": merchant_standardized,
+        "is_subscription": False,  # Will be updated by subscription detector
+        "subscription_confidence": None,
+        "is_anomaly": False,  # Will be updated by fraud detector
+        "anomaly_score": "0.00",
+        "anomaly_reason": None,
+        "is_bill": False,
+        "bill_cycle_day": None,
+        "tags": final_result.get('tags') or None,
+        "notes": final_result.get('reasoning')
+    }
+
+
+def _categorization_response(
+    transaction_id: str,
+    merchant_standardized: str,
+    final_result: Dict[str, Any],
+    store_result: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Build the tool response for one stored (or failed) categorization"""
+    if not store_result['success']:
         return {
             "status": "error",
             "transaction_id": transaction_id,
-            "message": f"Categorization failed: {str(e)}"
+            "message": f"Failed to store categorization: {store_result.get('error')}"
         }
+    
+    return {
+        "status": "success",
+        "transaction_id": transaction_id,
+        "category": final_result['category'],
+        "merchant_standardized": merchant_standardized,
+        "confidence": final_result['confidence'],
+        "tags": final_result.get('tags', []),
+        "method": final_result['method'],
+        "message": f"Successfully categorized as {final_result['category']} (via {final_result['method']})"
+    }
+
+
+def _store_categorization(
+    transaction_id: str,
+    user_id: str,
+    merchant_standardized: str,
+    final_result: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Store a combined categorization result and build the tool response"""
+    toolbox = get_toolbox()
+    
+    row = _processed_transaction_row(transaction_id, user_id, merchant_standardized, final_result)
+    if row['tags']:
+        row['tags'] = _json_dumps(row['tags'])
+    
+    store_result = toolbox.call_tool("insert-processed-transaction", **row)
+    
+    return _categorization_response(transaction_id, merchant_standardized, final_result, store_result)
+
+
+def _store_categorizations_batch(
+    user_id: str,
+    categorized: List[tuple]
+) -> List[Dict[str, Any]]:
+    """
+    Store many (transaction_id, merchant_standardized, final_result) entries
+    with a single insert-processed-transactions-batch call instead of one
+    database round-trip per transaction
+    """
+    toolbox = get_toolbox()
+    
+    # ON CONFLICT can't touch the same row twice in one statement - keep the last entry per ID
+    rows = {
+        transaction_id: _processed_transaction_row(transaction_id, user_id, merchant_standardized, final_result)
+        for transaction_id, merchant_standardized, final_result in categorized
+    }
+    
+    store_result = toolbox.call_tool(
+        "insert-processed-transactions-batch",
+        rows=_json_dumps(list(rows.values()))
+    )
+    
+    return [
+        _categorization_response(transaction_id, merchant_standardized, final_result, store_result)
+        for transaction_id, merchant_standardized, final_result in categorized
+    ]
 
 
 # ============================================================================
 # MERCHANT STANDARDIZATION
 # ============================================================================
 
+# Known merchant mappings: substring of the uppercased raw name -> display name.
+# Empty replacements mark payment processor prefixes that are stripped instead.
+# Read-only at runtime (wrapped in a MappingProxyType below).
+MERCHANT_MAPPINGS = {
+    # E-commerce
+    'AMZN': 'Amazon',
+    'AMAZON': 'Amazon',
+    'AMAZON.COM': 'Amazon',
+    'AMAZON MARKETPLACE': 'Amazon',
+    'AMZ': 'Amazon',
+    
+    # Grocery
+    'WM SUPERCENTER': 'Walmart',
+    'WALMART': 'Walmart',
+    'WAL-MART': 'Walmart',
+    'WHOLEFDS': 'Whole Foods',
+    'WHOLE FOODS': 'Whole Foods',
+    'TRADER JOE': 'Trader Joe\'s',
+    'SAFEWAY': 'Safeway',
+    'KROGER': 'Kroger',
+    
+    # Food & Dining
+    'MCDONALD': 'McDonald\'s',
+    'MCDONALDS': 'McDonald\'s',
+    'STARB': 'Starbucks',
+    'STARBUCKS': 'Starbucks',
+    'CHIPOTLE': 'Chipotle',
+    'SUBWAY': 'Subway',
+    'PANERA': 'Panera Bread',
+    'DOMINO': 'Domino\'s Pizza',
+    'PIZZA HUT': 'Pizza Hut',
+    
+    # Transportation
+    'UBER': 'Uber',
+    'LYFT': 'Lyft',
+    'SHELL': 'Shell Gas',
+    'CHEVRON': 'Chevron',
+    'EXXON': 'ExxonMobil',
+    'BP': 'BP Gas',
+    '76': '76 Gas',
+    
+    # Subscriptions
+    'NETFLIX': 'Netflix',
+    'SPOTIFY': 'Spotify',
+    'HULU': 'Hulu',
+    'DISNEY': 'Disney+',
+    'HBO': 'HBO Max',
+    'AMAZON PRIME': 'Amazon Prime',
+    'APPLE.COM': 'Apple',
+    'APPLE.COM/BILL': 'Apple',
+    'YOUTUBE': 'YouTube Premium',
+    'GOOGLE': 'Google',
+    
+    # Utilities
+    'VERIZON': 'Verizon',
+    'AT&T': 'AT&T',
+    'ATT': 'AT&T',
+    'TMOBILE': 'T-Mobile',
+    'T-MOBILE': 'T-Mobile',
+    'COMCAST': 'Comcast',
+    'XFINITY': 'Xfinity',
+    
+    # Retail
+    'TARGET': 'Target',
+    'COSTCO': 'Costco',
+    'CVS': 'CVS Pharmacy',
+    'WALGREENS': 'Walgreens',
+    'BEST BUY': 'Best Buy',
+    'HOME DEPOT': 'Home Depot',
+    'LOWES': 'Lowe\'s',
+    
+    # Payment processors (remove)
+    'SQ *': '',
+    'TST*': '',
+    'PAYPAL *': '',
+}
+MERCHANT_MAPPINGS = MappingProxyType(MERCHANT_MAPPINGS)
+
+# Patterns ordered longest first (table order breaks ties), so the most
+# specific pattern wins - e.g. 'AMAZON PRIME' over 'AMAZON'. They are
+# compiled into one alternation in that order; the zero-width lookahead
+# reports (at each position) the highest-ranked pattern starting there, so a
+# single finditer pass finds the same winner as checking every pattern in
+# ranked order.
+_MERCHANT_PATTERNS = tuple(sorted(MERCHANT_MAPPINGS, key=len, reverse=True))
+_MERCHANT_PATTERN_INDEX = {pattern: i for i, pattern in enumerate(_MERCHANT_PATTERNS)}
+_MERCHANT_SCAN_RE = re.compile(
+    '(?=(' + '|'.join(re.escape(pattern) for pattern in _MERCHANT_PATTERNS) + '))'
+)
+
+# Cleanup patterns, compiled once at import instead of on every call.
+# Payment processor prefixes are a single alternation (repeatable, so stacked
+# prefixes such as "SQ *WM ..." are still all removed).
+_PREFIX_RE = re.compile(
+    r'^(?:SQ \*|AMZN\*|TST\*|WM |PAYPAL \*|GOOGLE \*|APPLE\.COM\*)+',
+    re.IGNORECASE
+)
+_STORE_NUM_RE = re.compile(r'#\d+')
+_PHONE_RE = re.compile(r'\d{3}-\d{3}-\d{4}')
+
+# States matched case-insensitively; any other two-letter code must be uppercase
+_COMMON_STATES = frozenset({'CA', 'NY', 'TX', 'FL', 'IL', 'PA', 'OH', 'GA', 'NC', 'MI'})
+
+
+def _is_state_code(token: str) -> bool:
+    """Two-letter state code as it appears before a ZIP"""
+    if token.upper() in _COMMON_STATES:
+        return True
+    return len(token) == 2 and token.isascii() and token.isalpha() and token.isupper()
+
+
+def _clean_merchant_tokens(merchant: str) -> str:
+    """
+    Single left-to-right pass over the tokens of a merchant name that drops
+    store numbers (#1234), a trailing 4+ digit number, phone numbers and
+    State + ZIP pairs, then joins with single spaces. Regexes only run on
+    tokens that can possibly match (containing '#', or a phone-shaped token).
+    Like the patterns they replace, numbers, phones and states are only
+    removed when whitespace precedes them.
+    """
+    tokens = merchant.split()
+    leading_space = merchant[:1].isspace()
+    
+    for i, token in enumerate(tokens):
+        if '#' in token:
+            tokens[i] = _STORE_NUM_RE.sub('', token)  # #1234
+    
+    # Trailing store/terminal number
+    last = len(tokens) - 1
+    while last >= 0 and not tokens[last]:
+        last -= 1
+    if last >= 0 and (last > 0 or leading_space) and len(tokens[last]) >= 4 and tokens[last].isdecimal():
+        tokens[last] = ''
+    
+    # Phone numbers
+    for i, token in enumerate(tokens):
+        if (i > 0 or leading_space) and len(token) >= 12 and token[3] == '-' and _PHONE_RE.match(token):
+            tokens[i] = token[12:]
+    
+    # State + ZIP
+    cleaned = []
+    words = [(i, token) for i, token in enumerate(tokens) if token]
+    j = 0
+    while j < len(words):
+        i, token = words[j]
+        if (i > 0 or leading_space) and j + 1 < len(words) and _is_state_code(token):
+            zip_code = words[j + 1][1]
+            if len(zip_code) >= 5 and zip_code[:5].isdecimal():
+                if zip_code[5:]:
+                    cleaned.append(zip_code[5:])
+                j += 2
+                continue
+        cleaned.append(token)
+        j += 1
+    
+    return ' '.join(cleaned)
+
+
 def _standardize_merchant_name(raw_merchant: str) -> str:
     """
     Intelligent merchant name standardization
     Cleans and normalizes merchant names for consistency
     """
+    return _standardize_merchant(raw_merchant)[0]
+
+
+@lru_cache(maxsize=4096)
+def _standardize_merchant(raw_merchant: str) -> Tuple[str, str]:
+    """
+    Standardized merchant name plus its lowercase form for keyword rules,
+    so the case conversions happen once per distinct merchant
+    (pure function, memoized - merchants repeat heavily across transactions)
+    """
+    merchant = _standardize_merchant_display(raw_merchant)
+    return merchant, merchant.lower()
+
+
+def _standardize_merchant_display(raw_merchant: str) -> str:
+    """Display-form standardization behind _standardize_merchant"""
     if not raw_merchant:
         return "Unknown"
     
@@ -190,118 +771,36 @@ def _standardize_merchant_name(raw_merchant: str) -> str:
     merchant_upper = raw_merchant.upper()
     
     # Step 1: Known merchant mappings (most accurate)
-    MERCHANT_MAPPINGS = {
-        # E-commerce
-        'AMZN': 'Amazon',
-        'AMAZON': 'Amazon',
-        'AMAZON.COM': 'Amazon',
-        'AMAZON MARKETPLACE': 'Amazon',
-        'AMZ': 'Amazon',
-        
-        # Grocery
-        'WM SUPERCENTER': 'Walmart',
-        'WALMART': 'Walmart',
-        'WAL-MART': 'Walmart',
-        'WHOLEFDS': 'Whole Foods',
-        'WHOLE FOODS': 'Whole Foods',
-        'TRADER JOE': 'Trader Joe\'s',
-        'SAFEWAY': 'Safeway',
-        'KROGER': 'Kroger',
-        
-        # Food & Dining
-        'MCDONALD': 'McDonald\'s',
-        'MCDONALDS': 'McDonald\'s',
-        'STARB': 'Starbucks',
-        'STARBUCKS': 'Starbucks',
-        'CHIPOTLE': 'Chipotle',
-        'SUBWAY': 'Subway',
-        'PANERA': 'Panera Bread',
-        'DOMINO': 'Domino\'s Pizza',
-        'PIZZA HUT': 'Pizza Hut',
-        
-        # Transportation
-        'UBER': 'Uber',
-        'LYFT': 'Lyft',
-        'SHELL': 'Shell Gas',
-        'CHEVRON': 'Chevron',
-        'EXXON': 'ExxonMobil',
-        'BP': 'BP Gas',
-        '76': '76 Gas',
-        
-        # Subscriptions
-        'NETFLIX': 'Netflix',
-        'SPOTIFY': 'Spotify',
-        'HULU': 'Hulu',
-        'DISNEY': 'Disney+',
-        'HBO': 'HBO Max',
-        'AMAZON PRIME': 'Amazon Prime',
-        'APPLE.COM': 'Apple',
-        'APPLE.COM/BILL': 'Apple',
-        'YOUTUBE': 'YouTube Premium',
-        'GOOGLE': 'Google',
-        
-        # Utilities
-        'VERIZON': 'Verizon',
-        'AT&T': 'AT&T',
-        'ATT': 'AT&T',
-        'TMOBILE': 'T-Mobile',
-        'T-MOBILE': 'T-Mobile',
-        'COMCAST': 'Comcast',
-        'XFINITY': 'Xfinity',
-        
-        # Retail
-        'TARGET': 'Target',
-        'COSTCO': 'Costco',
-        'CVS': 'CVS Pharmacy',
-        'WALGREENS': 'Walgreens',
-        'BEST BUY': 'Best Buy',
-        'HOME DEPOT': 'Home Depot',
-        'LOWES': 'Lowe\'s',
-        
-        # Payment processors (remove)
-        'SQ *': '',
-        'TST*': '',
-        'PAYPAL *': '',
-    }
     
-    # Check for exact matches first
-    for pattern, replacement in MERCHANT_MAPPINGS.items():
-        if pattern in merchant_upper:
-            if replacement:  # Not empty (like SQ *)
-                return replacement
-            else:
-                # Remove pattern and continue processing
-                raw_merchant = raw_merchant.replace(pattern, '').strip()
+    # Check for exact matches first - one scan over the name finds every
+    # mapping pattern present; the most specific (longest) pattern wins
+    best_index = None
+    patterns_to_remove = []
+    for match in _MERCHANT_SCAN_RE.finditer(merchant_upper):
+        pattern = match.group(1)
+        index = _MERCHANT_PATTERN_INDEX[pattern]
+        if MERCHANT_MAPPINGS[pattern]:
+            if best_index is None or index < best_index:
+                best_index = index
+        else:
+            patterns_to_remove.append(pattern)
+    
+    if best_index is not None:
+        return MERCHANT_MAPPINGS[_MERCHANT_PATTERNS[best_index]]
+    
+    for pattern in patterns_to_remove:  # Processor prefixes like SQ *
+        # Remove pattern and continue processing
+        raw_merchant = raw_merchant.replace(pattern, '').strip()
     
     # Step 2: Remove common prefixes/suffixes
     merchant = raw_merchant
     
     # Remove payment processor prefixes
-    prefixes_to_remove = [
-        r'^SQ \*',
-        r'^AMZN\*',
-        r'^TST\*',
-        r'^WM ',
-        r'^PAYPAL \*',
-        r'^GOOGLE \*',
-        r'^APPLE\.COM\*',
-    ]
-    
-    for prefix in prefixes_to_remove:
-        merchant = re.sub(prefix, '', merchant, flags=re.IGNORECASE)
-    
-    # Step 3: Remove store numbers and IDs
-    merchant = re.sub(r'#\d+', '', merchant)  # #1234
-    merchant = re.sub(r'\s+\d{4,}$', '', merchant)  # trailing numbers
-    merchant = re.sub(r'\s+\d{3}-\d{3}-\d{4}', '', merchant)  # phone numbers
-    
-    # Step 4: Remove locations/addresses
-    merchant = re.sub(r'\s+(CA|NY|TX|FL|IL|PA|OH|GA|NC|MI)\s+\d{5}', '', merchant, flags=re.IGNORECASE)
-    merchant = re.sub(r'\s+[A-Z]{2}\s+\d{5}', '', merchant)  # State + ZIP
+    merchant = _PREFIX_RE.sub('', merchant)
     
-    # Step 5: Clean up
-    merchant = merchant.strip()
-    merchant = ' '.join(merchant.split())  # Remove extra spaces
+    # Steps 3-5: Remove store numbers, phone numbers and State + ZIP, and
+    # collapse whitespace - one pass over the whitespace-split tokens
+    merchant = _clean_merchant_tokens(merchant)
     
     # Step 6: Title case for readability
     if merchant.isupper() or merchant.islower():
@@ -314,21 +813,11 @@ def _standardize_merchant_name(raw_merchant: str) -> str:
 # LLM-BASED CATEGORIZATION
 # ============================================================================
 
-def _categorize_with_llm(
-    merchant: str,
-    merchant_standardized: str,
-    amount: float,
-    description: str
-) -> Optional[Dict[str, Any]]:
-    """
-    Use Gemini LLM to categorize transaction with detailed prompt template
-    """
-    
-    if not LLM_AVAILABLE:
-        return None
-    
-    # Comprehensive prompt template
-    prompt = f"""You are a financial transaction categorization expert. Analyze this transaction and provide accurate categorization.
+# Static parts of the single-transaction prompt are built once at import;
+# only the transaction details header is formatted per call
+_CATEGORIES_BULLETS = "\n".join(f"   - {cat}" for cat in CATEGORIES)
+
+_LLM_PROMPT_HEADER = """You are a financial transaction categorization expert. Analyze this transaction and provide accurate categorization.
 
 **Transaction Details:**
 - Original Merchant Name: {merchant}
@@ -336,9 +825,12 @@ def _categorize_with_llm(
 - Amount: ${amount:.2f}
 - Description: {description}
 
-**Your Task:**
+"""
+
+# Comprehensive prompt template
+_LLM_PROMPT_BODY = f"""**Your Task:**
 1. Categorize this transaction into ONE of these categories:
-{chr(10).join(f"   - {cat}" for cat in CATEGORIES)}
+{_CATEGORIES_BULLETS}
 
 2. Consider these factors:
    - Merchant name patterns (e.g., "Starbucks" → Food & Dining)
@@ -403,201 +895,532 @@ Transaction: Unknown Merchant, $1250.00
 - Be conservative with confidence - if unsure, use 0.7 or lower
 
 Now categorize the transaction above:"""
+
+
+# LLM results keyed by (merchant_standardized, amount bucket, description prefix).
+# Monthly subscriptions and daily coffee runs recur constantly, so most
+# repeats can skip the API call. Only successful answers are cached.
+LLM_CACHE_MAXSIZE = 8192
+_llm_cache = TTLCache(LLM_CACHE_MAXSIZE)
+
+
+def _llm_cache_key(merchant_standardized: str, amount: float, description: str) -> tuple:
+    """Cache key that groups similar transactions from the same merchant"""
+    return (
+        merchant_standardized,
+        round(abs(amount) / 10) * 10,
+        (description or '')[:40].lower()
+    )
+
+
+def _get_cached_llm_result(key: tuple) -> Optional[Dict[str, Any]]:
+    """Return a copy of a cached LLM result, or None on a miss"""
+    result = _llm_cache.get(key)
+    if result is None:
+        return None
+    return {**result, 'tags': list(result.get('tags') or [])}
+
+
+def _cache_llm_result(key: tuple, result: Dict[str, Any]) -> None:
+    """Store a copy of an LLM result"""
+    _llm_cache.set(key, {**result, 'tags': list(result.get('tags') or [])})
+
+
+def _build_llm_prompt(
+    merchant: str,
+    merchant_standardized: str,
+    amount: float,
+    description: str
+) -> str:
+    """
+    Build the detailed categorization prompt for a single transaction
+    """
+    return _LLM_PROMPT_HEADER.format(
+        merchant=merchant,
+        merchant_standardized=merchant_standardized,
+        amount=amount,
+        description=description
+    ) + _LLM_PROMPT_BODY
+
+
+def _categorize_with_llm(
+    merchant: str,
+    merchant_standardized: str,
+    amount: float,
+    description: str
+) -> Optional[Dict[str, Any]]:
+    """
+    Use Gemini LLM to categorize transaction with detailed prompt template
+    """
+    
+    if not LLM_AVAILABLE:
+        return None
+    
+    # Repeat merchant/amount patterns reuse an earlier answer
+    cache_key = _llm_cache_key(merchant_standardized, amount, description)
+    cached = _get_cached_llm_result(cache_key)
+    if cached is not None:
+        return cached
+    
+    prompt = _build_llm_prompt(merchant, merchant_standardized, amount, description)
     
     try:
         # Call Gemini
         response = llm_model.generate_content(
             prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.1,  # Low temperature for consistency
-                max_output_tokens=300,
-            )
+            generation_config=_GEN_CONFIG,
+            stream=True
         )
         
-        # Parse JSON response
-        text = response.text.strip()
-        
-        # Remove markdown code blocks if present
-        if text.startswith('```'):
-            # Extract content between ```json and ```
-            if '```json' in text:
-                text = text.split('```json')[1].split('```')[0].strip()
-            elif '```' in text:
-                text = text.split('```')[1].split('```')[0].strip()
-        
-        # Parse JSON
-        result = json.loads(text)
+        # Parse JSON response as soon as the object is complete
+        result = _validate_llm_result(_read_streamed_json(response))
+        _cache_llm_result(cache_key, result)
         
-        # Validate category
-        if result['category'] not in CATEGORIES:
-            logger.warning(f"LLM returned invalid category: {result['category']}, defaulting to 'Other'")
-            result['category'] = 'Other'
-            result['confidence'] = max(result['confidence'] - 0.2, 0.5)
+        return result
+    
+    except json.JSONDecodeError as e:
+        logger.error("Failed to parse LLM JSON response: %s", e)
+        logger.debug("Raw LLM response: %s", e.doc)
+        return None
+    
+    except Exception as e:
+        logger.error("LLM categorization error: %s", e)
+        return None
+
+
+async def _acategorize_with_llm(
+    merchant: str,
+    merchant_standardized: str,
+    amount: float,
+    description: str
+) -> Optional[Dict[str, Any]]:
+    """
+    Async variant of _categorize_with_llm using generate_content_async,
+    so several Gemini requests can be in flight at once
+    """
+    
+    if not LLM_AVAILABLE:
+        return None
+    
+    cache_key = _llm_cache_key(merchant_standardized, amount, description)
+    cached = _get_cached_llm_result(cache_key)
+    if cached is not None:
+        return cached
+    
+    prompt = _build_llm_prompt(merchant, merchant_standardized, amount, description)
+    
+    try:
+        # Call Gemini without blocking the event loop
+        response = await llm_model.generate_content_async(
+            prompt,
+            generation_config=_GEN_CONFIG
+        )
         
-        # Ensure confidence is in valid range
-        result['confidence'] = max(0.0, min(1.0, float(result['confidence'])))
+        text = _strip_code_fence(response.text)
+        result = _validate_llm_result(_json_loads(text))
+        _cache_llm_result(cache_key, result)
         
         return result
     
     except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse LLM JSON response: {e}")
-        logger.debug(f"Raw LLM response: {text}")
+        logger.error("Failed to parse LLM JSON response: %s", e)
         return None
     
     except Exception as e:
-        logger.error(f"LLM categorization error: {e}")
+        logger.error("LLM categorization error: %s", e)
         return None
 
 
+def _categorize_batch_with_llm(items: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Use Gemini LLM to categorize several transactions with a single prompt.
+    Returns one result per input item (None where the LLM gave no usable answer).
+    """
+    
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    
+    if not LLM_AVAILABLE or not items:
+        return results
+    
+    transaction_lines = "\n".join(
+        f"{i}. Merchant: {item['merchant']} | Standardized: {item['merchant_standardized']} | "
+        f"Amount: ${item['amount']:.2f} | Description: {item['description']}"
+        for i, item in enumerate(items, start=1)
+    )
+    
+    prompt = f"""You are a financial transaction categorization expert. Analyze each transaction below and provide accurate categorization.
+
+**Transactions:**
+{transaction_lines}
+
+**Categories (choose exactly ONE per transaction):**
+{_CATEGORIES_BULLETS}
+
+Consider merchant name patterns, industry knowledge, amount context and description keywords.
+
+**Response Format (JSON ARRAY ONLY, one object per transaction, same numbering):**
+[
+  {{
+    "index": 1,
+    "category": "Category Name",
+    "confidence": 0.95,
+    "reasoning": "Brief explanation of why this category fits",
+    "tags": ["relevant", "tags"]
+  }}
+]
+
+**IMPORTANT:**
+- Respond with ONLY the JSON array, no markdown, no explanation outside JSON
+- Return exactly {len(items)} objects, "index" must match the transaction number
+- Category MUST be exactly one of the {len(CATEGORIES)} provided categories
+- Confidence should reflect certainty (0.6-0.7 = uncertain, 0.8-0.9 = confident, 0.95+ = very confident)
+- Be conservative with confidence - if unsure, use 0.7 or lower
+
+Now categorize the transactions above:"""
+    
+    try:
+        response = llm_model.generate_content(
+            prompt,
+            generation_config=_batch_generation_config(len(items)),
+            stream=True
+        )
+        
+        parsed = _read_streamed_json(response)
+        
+        if not isinstance(parsed, list):
+            logger.error("LLM batch response is not a JSON array")
+            return results
+        
+        for entry in parsed:
+            try:
+                index = int(entry['index']) - 1
+                if 0 <= index < len(items):
+                    results[index] = _validate_llm_result(entry)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning("Skipping malformed LLM batch entry: %s", e)
+        
+        return results
+    
+    except json.JSONDecodeError as e:
+        logger.error("Failed to parse LLM batch JSON response: %s", e)
+        return results
+    
+    except Exception as e:
+        logger.error("LLM batch categorization error: %s", e)
+        return results
+
+
+@lru_cache(maxsize=32)
+def _batch_generation_config(batch_size: int):
+    """GenerationConfig for a batched prompt, built once per batch size"""
+    return genai.types.GenerationConfig(
+        temperature=0.1,  # Low temperature for consistency
+        max_output_tokens=150 * batch_size,
+    )
+
+
+def _read_streamed_json(response) -> Any:
+    """
+    Consume a streamed Gemini response and parse the JSON as soon as it is
+    complete. A parse is only attempted when a chunk could have closed the
+    value ('}' or ']'); the rest of the stream is then drained so the
+    request finishes cleanly. A stream without chunks raises
+    json.JSONDecodeError like any other unparseable answer.
+    """
+    buffer = []
+    for chunk in response:
+        piece = chunk.text
+        buffer.append(piece)
+        if '}' in piece or ']' in piece:
+            try:
+                parsed = _json_loads(_strip_code_fence(''.join(buffer)))
+            except json.JSONDecodeError:
+                continue  # Not complete yet
+            _drain_stream(response)
+            return parsed
+    
+    if not buffer:
+        raise json.JSONDecodeError("Empty streamed LLM response", "", 0)
+    
+    # Stream finished without a complete value
+    return _json_loads(_strip_code_fence(''.join(buffer)))
+
+
+def _drain_stream(response) -> None:
+    """Read the trailing chunks of a streamed response whose JSON is already parsed"""
+    try:
+        response.resolve()
+    except Exception as e:
+        # The answer is already in hand; a failure in the tail doesn't change it
+        logger.debug("Error draining LLM stream: %s", e)
+
+
+def _strip_code_fence(text: str) -> str:
+    """Remove markdown code blocks from an LLM response if present"""
+    text = text.strip()
+    
+    if text.startswith('```'):
+        # Extract content between ```json and ```
+        if '```json' in text:
+            text = text.split('```json')[1].split('```')[0].strip()
+        elif '```' in text:
+            text = text.split('```')[1].split('```')[0].strip()
+    
+    return text
+
+
+def _validate_llm_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate category and clamp confidence of a parsed LLM result"""
+    
+    # Validate category
+    if result['category'] not in CATEGORIES:
+        logger.warning("LLM returned invalid category: %s, defaulting to 'Other'", result['category'])
+        result['category'] = 'Other'
+        result['confidence'] = max(result['confidence'] - 0.2, 0.5)
+    
+    # Ensure confidence is in valid range
+    result['confidence'] = max(0.0, min(1.0, float(result['confidence'])))
+    
+    return result
+
+
 # ============================================================================
 # RULE-BASED CATEGORIZATION
 # ============================================================================
 
+# Keyword rules with priority (checked in order).
+# 'credit_only' rules apply only to positive amounts.
+CATEGORIZATION_RULES = [
+    # Income (positive amounts)
+    {
+        'category': 'Income',
+        'keywords': ['deposit', 'payroll', 'salary', 'direct dep', 'transfer from'],
+        'credit_only': True,
+        'confidence': 0.95,
+        'tags': ['income', 'deposit']
+    },
+    
+    # Subscriptions (high confidence if recurring keywords)
+    {
+        'category': 'Subscriptions',
+        'keywords': ['netflix', 'spotify', 'hulu', 'disney', 'prime', 'apple music', 
+                    'youtube premium', 'subscription', 'monthly'],
+        'confidence': 0.92,
+        'tags': ['subscription', 'recurring']
+    },
+    
+    # Food & Dining
+    {
+        'category': 'Food & Dining',
+        'keywords': ['starbucks', 'mcdonald', 'burger', 'pizza', 'restaurant', 'cafe',
+                    'coffee', 'chipotle', 'subway', 'taco', 'kfc', 'wendy', 'chick-fil-a',
+                    'panera', 'dunkin', 'domino', 'food', 'dining', 'bar', 'grill'],
+        'confidence': 0.88,
+        'tags': ['food', 'dining', 'restaurant']
+    },
+    
+    # Groceries
+    {
+        'category': 'Groceries',
+        'keywords': ['walmart', 'whole foods', 'safeway', 'kroger', 'trader joe', 
+                    'albertsons', 'publix', 'wegmans', 'grocery', 'supermarket', 
+                    'market', 'food lion', 'aldi', 'costco'],
+        'confidence': 0.90,
+        'tags': ['groceries', 'food', 'household']
+    },
+    
+    # Transportation
+    {
+        'category': 'Transportation',
+        'keywords': ['uber', 'lyft', 'gas', 'shell', 'chevron', 'exxon', 'bp', '76',
+                    'parking', 'transit', 'metro', 'taxi', 'fuel', 'toll', 'car wash'],
+        'confidence': 0.87,
+        'tags': ['transport', 'vehicle']
+    },
+    
+    # Bills & Utilities
+    {
+        'category': 'Bills & Utilities',
+        'keywords': ['electric', 'water', 'internet', 'phone', 'utility', 'verizon',
+                    'at&t', 'tmobile', 'comcast', 'xfinity', 'bill', 'utilities',
+                    'insurance', 'rent', 'mortgage'],
+        'confidence': 0.89,
+        'tags': ['bills', 'utilities', 'recurring']
+    },
+    
+    # Shopping
+    {
+        'category': 'Shopping',
+        'keywords': ['amazon', 'target', 'ebay', 'best buy', 'apple store', 'walmart',
+                    'macy', 'nordstrom', 'store', 'shop', 'retail', 'clothing',
+                    'fashion', 'mall'],
+        'confidence': 0.82,
+        'tags': ['shopping', 'retail']
+    },
+    
+    # Entertainment
+    {
+        'category': 'Entertainment',
+        'keywords': ['gym', 'fitness', 'movie', 'theater', 'cinema', 'concert', 'event',
+                    'tickets', 'amusement', 'games', 'entertainment', 'sports'],
+        'confidence': 0.85,
+        'tags': ['entertainment', 'leisure']
+    },
+    
+    # Healthcare
+    {
+        'category': 'Healthcare',
+        'keywords': ['doctor', 'hospital', 'pharmacy', 'cvs', 'walgreens', 'medical',
+                    'clinic', 'health', 'dental', 'vision', 'prescription', 'medicine'],
+        'confidence': 0.90,
+        'tags': ['health', 'medical']
+    },
+    
+    # Travel
+    {
+        'category': 'Travel',
+        'keywords': ['hotel', 'airbnb', 'flight', 'airline', 'booking', 'expedia',
+                    'marriott', 'hilton', 'airport', 'travel', 'vacation', 'resort'],
+        'confidence': 0.88,
+        'tags': ['travel', 'vacation']
+    },
+    
+    # Education
+    {
+        'category': 'Education',
+        'keywords': ['university', 'college', 'school', 'tuition', 'course', 'udemy',
+                    'coursera', 'education', 'learning', 'books', 'textbook'],
+        'confidence': 0.86,
+        'tags': ['education', 'learning']
+    },
+    
+    # Personal Care
+    {
+        'category': 'Personal Care',
+        'keywords': ['salon', 'spa', 'haircut', 'barber', 'massage', 'beauty',
+                    'cosmetics', 'sephora', 'ulta', 'personal care'],
+        'confidence': 0.84,
+        'tags': ['personal-care', 'beauty']
+    },
+]
+
+
+# Keywords this short produce too many accidental substring hits
+WHOLE_WORD_KEYWORD_MAX_LEN = 3
+
+
+def _build_rule_scanner(include_credit_only: bool):
+    """
+    Compile rule keywords into one lookahead alternation in priority order.
+    At each position of the text it reports the highest-priority keyword
+    starting there. Each keyword maps to a bitmask of the rules listing it
+    (bit i = CATEGORIZATION_RULES[i]); OR-ing the masks of one finditer pass
+    gives the matched-rule set, whose lowest bit is the first rule a
+    rule-by-rule keyword check would match.
+    
+    Short keywords ('bp', '76', 'bar', 'spa', ...) only match as whole words,
+    so 'barber' or 'spanish' no longer hit them; longer keywords keep
+    substring semantics so 'shopping' or 'movies' still match.
+    
+    Returns (compiled pattern, keyword -> rule bitmask).
+    """
+    keyword_masks: Dict[str, int] = {}
+    for index, rule in enumerate(CATEGORIZATION_RULES):
+        if rule.get('credit_only') and not include_credit_only:
+            continue
+        for keyword in rule['keywords']:
+            keyword_masks[keyword] = keyword_masks.get(keyword, 0) | (1 << index)
+    
+    alternatives = []
+    for keyword in keyword_masks:
+        escaped = re.escape(keyword)
+        if len(keyword) <= WHOLE_WORD_KEYWORD_MAX_LEN:
+            # \b is zero-width, so group(1) still captures just the keyword
+            escaped = rf'\b{escaped}\b'
+        alternatives.append(escaped)
+    
+    pattern = re.compile('(?=(' + '|'.join(alternatives) + '))')
+    return pattern, keyword_masks
+
+
+# Credit-only rules are left out of the debit scanner entirely, so one of
+# their keywords can never hide an unconditional keyword at the same position
+_CREDIT_RULE_SCAN_RE, _CREDIT_RULE_KEYWORD_MASKS = _build_rule_scanner(include_credit_only=True)
+_DEBIT_RULE_SCAN_RE, _DEBIT_RULE_KEYWORD_MASKS = _build_rule_scanner(include_credit_only=False)
+
 def _categorize_with_rules(
     merchant: str,
     merchant_standardized: str,
     amount: float,
-    description: str
+    description: str,
+    merchant_lower: Optional[str] = None
 ) -> Dict[str, Any]:
     """
     Rule-based categorization using keyword matching
     Always returns a result (fallback-safe)
+    
+    merchant_lower is merchant_standardized.lower() when the caller already
+    has it (see _standardize_merchant).
     """
+    if merchant_lower is None:
+        merchant_lower = merchant_standardized.lower()
     
-    merchant_lower = merchant_standardized.lower()
-    desc_lower = description.lower() if description else ""
-    combined_text = f"{merchant_lower} {desc_lower}"
+    # Rules only look at the standardized merchant, the description and the
+    # amount sign, so the match is memoized on exactly those inputs
+    result = _match_rules(merchant_lower, description or "", amount > 0)
     
-    # Define rules with priority (checked in order)
-    rules = [
-        # Income (positive amounts)
-        {
-            'category': 'Income',
-            'keywords': ['deposit', 'payroll', 'salary', 'direct dep', 'transfer from'],
-            'condition': lambda: amount > 0,
-            'confidence': 0.95,
-            'tags': ['income', 'deposit']
-        },
-        
-        # Subscriptions (high confidence if recurring keywords)
-        {
-            'category': 'Subscriptions',
-            'keywords': ['netflix', 'spotify', 'hulu', 'disney', 'prime', 'apple music', 
-                        'youtube premium', 'subscription', 'monthly'],
-            'confidence': 0.92,
-            'tags': ['subscription', 'recurring']
-        },
-        
-        # Food & Dining
-        {
-            'category': 'Food & Dining',
-            'keywords': ['starbucks', 'mcdonald', 'burger', 'pizza', 'restaurant', 'cafe',
-                        'coffee', 'chipotle', 'subway', 'taco', 'kfc', 'wendy', 'chick-fil-a',
-                        'panera', 'dunkin', 'domino', 'food', 'dining', 'bar', 'grill'],
-            'confidence': 0.88,
-            'tags': ['food', 'dining', 'restaurant']
-        },
-        
-        # Groceries
-        {
-            'category': 'Groceries',
-            'keywords': ['walmart', 'whole foods', 'safeway', 'kroger', 'trader joe', 
-                        'albertsons', 'publix', 'wegmans', 'grocery', 'supermarket', 
-                        'market', 'food lion', 'aldi', 'costco'],
-            'confidence': 0.90,
-            'tags': ['groceries', 'food', 'household']
-        },
-        
-        # Transportation
-        {
-            'category': 'Transportation',
-            'keywords': ['uber', 'lyft', 'gas', 'shell', 'chevron', 'exxon', 'bp', '76',
-                        'parking', 'transit', 'metro', 'taxi', 'fuel', 'toll', 'car wash'],
-            'confidence': 0.87,
-            'tags': ['transport', 'vehicle']
-        },
-        
-        # Bills & Utilities
-        {
-            'category': 'Bills & Utilities',
-            'keywords': ['electric', 'water', 'internet', 'phone', 'utility', 'verizon',
-                        'at&t', 'tmobile', 'comcast', 'xfinity', 'bill', 'utilities',
-                        'insurance', 'rent', 'mortgage'],
-            'confidence': 0.89,
-            'tags': ['bills', 'utilities', 'recurring']
-        },
-        
-        # Shopping
-        {
-            'category': 'Shopping',
-            'keywords': ['amazon', 'target', 'ebay', 'best buy', 'apple store', 'walmart',
-                        'macy', 'nordstrom', 'store', 'shop', 'retail', 'clothing',
-                        'fashion', 'mall'],
-            'confidence': 0.82,
-            'tags': ['shopping', 'retail']
-        },
-        
-        # Entertainment
-        {
-            'category': 'Entertainment',
-            'keywords': ['gym', 'fitness', 'movie', 'theater', 'cinema', 'concert', 'event',
-                        'tickets', 'amusement', 'games', 'entertainment', 'sports'],
-            'confidence': 0.85,
-            'tags': ['entertainment', 'leisure']
-        },
-        
-        # Healthcare
-        {
-            'category': 'Healthcare',
-            'keywords': ['doctor', 'hospital', 'pharmacy', 'cvs', 'walgreens', 'medical',
-                        'clinic', 'health', 'dental', 'vision', 'prescription', 'medicine'],
-            'confidence': 0.90,
-            'tags': ['health', 'medical']
-        },
-        
-        # Travel
-        {
-            'category': 'Travel',
-            'keywords': ['hotel', 'airbnb', 'flight', 'airline', 'booking', 'expedia',
-                        'marriott', 'hilton', 'airport', 'travel', 'vacation', 'resort'],
-            'confidence': 0.88,
-            'tags': ['travel', 'vacation']
-        },
-        
-        # Education
-        {
-            'category': 'Education',
-            'keywords': ['university', 'college', 'school', 'tuition', 'course', 'udemy',
-                        'coursera', 'education', 'learning', 'books', 'textbook'],
-            'confidence': 0.86,
-            'tags': ['education', 'learning']
-        },
-        
-        # Personal Care
-        {
-            'category': 'Personal Care',
-            'keywords': ['salon', 'spa', 'haircut', 'barber', 'massage', 'beauty',
-                        'cosmetics', 'sephora', 'ulta', 'personal care'],
-            'confidence': 0.84,
-            'tags': ['personal-care', 'beauty']
-        },
-    ]
+    # Hand out a copy so callers can't mutate the cached entry
+    return {**result, 'tags': list(result['tags'])}
+
+
+def _categorize_batch_with_rules(
+    merchants_lower: List[str],
+    descriptions: List[str],
+    amounts: List[float]
+) -> List[Dict[str, Any]]:
+    """
+    Rule-based categorization for a batch of transactions (parallel lists of
+    lowercased standardized merchants, descriptions and amounts).
+    Rows with the same (merchant, description, amount sign) are matched once,
+    so a batch full of repeat merchants costs one keyword scan per distinct row.
+    """
+    matches: Dict[tuple, Dict[str, Any]] = {}
+    results = []
+    for merchant_lower, description, amount in zip(merchants_lower, descriptions, amounts):
+        key = (merchant_lower, description or "", amount > 0)
+        result = matches.get(key)
+        if result is None:
+            result = matches[key] = _match_rules(*key)
+        results.append({**result, 'tags': list(result['tags'])})
     
-    # Check rules in order
-    for rule in rules:
-        # Check keywords
-        if any(keyword in combined_text for keyword in rule['keywords']):
-            # Check condition if present
-            if 'condition' in rule:
-                if not rule['condition']():
-                    continue
-            
-            return {
-                'category': rule['category'],
-                'confidence': rule['confidence'],
-                'tags': rule['tags'],
-                'reasoning': f"Rule-based: matched keywords {rule['keywords'][:3]}"
-            }
+    return results
+
+
+@lru_cache(maxsize=4096)
+def _match_rules(merchant_lower: str, description: str, is_credit: bool) -> Dict[str, Any]:
+    """Keyword rule matching behind _categorize_with_rules (memoized)"""
+    
+    combined_text = f"{merchant_lower} {description.lower()}"
+    
+    # Scan the text once, collecting matched rules as bits; the lowest set
+    # bit wins (rules are in priority order)
+    if is_credit:
+        scan_re, keyword_masks = _CREDIT_RULE_SCAN_RE, _CREDIT_RULE_KEYWORD_MASKS
+    else:
+        scan_re, keyword_masks = _DEBIT_RULE_SCAN_RE, _DEBIT_RULE_KEYWORD_MASKS
+    
+    matched = 0
+    for match in scan_re.finditer(combined_text):
+        matched |= keyword_masks[match.group(1)]
+    
+    if matched:
+        rule = CATEGORIZATION_RULES[(matched & -matched).bit_length() - 1]
+        return {
+            'category': rule['category'],
+            'confidence': rule['confidence'],
+            'tags': rule['tags'],
+            'reasoning': f"Rule-based: matched keywords {rule['keywords'][:3]}"
+        }
     
     # Default fallback
     return {
@@ -612,6 +1435,25 @@ def _categorize_with_rules(
 # RESULT COMBINATION
 # ============================================================================
 
+# Rules confidence at or above which a known merchant skips the LLM call
+RULES_SHORT_CIRCUIT_CONFIDENCE = 0.90
+
+# Display names produced by MERCHANT_MAPPINGS (exact table hits)
+_KNOWN_MERCHANTS = frozenset(name for name in MERCHANT_MAPPINGS.values() if name)
+
+
+def _rules_are_decisive(merchant_standardized: str, rules_result: Dict[str, Any]) -> bool:
+    """
+    True when the merchant came straight from the known-merchant table and the
+    rules are highly confident - the LLM would not change the outcome, so
+    its latency and token cost can be skipped
+    """
+    return (
+        merchant_standardized in _KNOWN_MERCHANTS
+        and rules_result['confidence'] >= RULES_SHORT_CIRCUIT_CONFIDENCE
+    )
+
+
 def _combine_categorization_results(
     llm_result: Optional[Dict[str, Any]],
     rules_result: Dict[str, Any]
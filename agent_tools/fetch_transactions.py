@@ -4,12 +4,15 @@ Retrieves unprocessed transactions from the database
 """
 
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Iterator, List
 from agent_tools.toolbox_wrapper import get_toolbox
 
 
 logger = logging.getLogger(__name__)
 
+# Rows per fetch-unprocessed-transactions-page call when streaming
+FETCH_PAGE_SIZE = 10
+
 
 def fetch_transactions(user_id: str, limit: int = 50) -> Dict[str, Any]:
     """
@@ -98,4 +101,46 @@ def fetch_transactions(user_id: str, limit: int = 50) -> Dict[str, Any]:
             "transaction_count": 0,
             "transactions": [],
             "message": f"Unexpected error: {str(e)}"
-        }
\ No newline at end of file
+        }
+
+
+def iter_unprocessed_transaction_pages(
+    user_id: str,
+    page_size: int = FETCH_PAGE_SIZE
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Yield unprocessed transactions for a user one page at a time, newest first,
+    so callers can start working on the first rows before the rest arrive.
+    
+    Pages come from the MCP tool 'fetch-unprocessed-transactions-page', which
+    uses a (date, transaction_id) keyset cursor: rows processed while paging
+    drop out of the unprocessed set without shifting later pages.
+    
+    Raises RuntimeError if the database call fails.
+    """
+    toolbox = get_toolbox()
+    after_date = ""
+    after_transaction_id = ""
+    
+    while True:
+        result = toolbox.call_tool(
+            "fetch-unprocessed-transactions-page",
+            user_id=user_id,
+            after_date=after_date,
+            after_transaction_id=after_transaction_id,
+            page_size=page_size
+        )
+        
+        if not result['success']:
+            raise RuntimeError(f"Database error: {result.get('error', 'Unknown error')}")
+        
+        page = result['data'] if isinstance(result['data'], list) else []
+        if page:
+            yield page
+        
+        if len(page) < page_size:
+            return
+        
+        last = page[-1]
+        after_date = str(last['date'])[:10]
+        after_transaction_id = str(last['transaction_id'])
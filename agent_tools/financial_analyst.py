@@ -3,106 +3,319 @@ Agent 2: Financial Analyst
 File: mcp_toolbox/tools/financial_analyst.py
 """
 
+import copy
 import json
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from operator import itemgetter
+from typing import List, Dict, Any, Optional, Tuple
 from collections import defaultdict
+from dataclasses import dataclass, asdict, field
 from toolbox_core import ToolboxSyncClient
+from agent_tools.toolbox_wrapper import TTLCache, _json_dumps, _json_loads
 from dotenv import load_dotenv
 import os
 load_dotenv()
+
+# pandas (installed with streamlit) aggregates large transaction lists in C
+try:
+    import pandas as pd
+    PANDAS_AVAILABLE = True
+except ImportError:
+    PANDAS_AVAILABLE = False
+
+# NumPy (a pandas dependency) computes trend statistics for all categories at once
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
 CLIENT_URL = os.getenv("CLIENT_URL", "https://toolbox-service-440584682160.us-central1.run.app")
+
+# Concurrent get-category-history calls when prefetching a run's histories
+# (e.g. one per category in the trends stage, capped here)
+HISTORY_FETCH_WORKERS = int(os.getenv("ANALYST_HISTORY_FETCH_WORKERS", "16"))
+
+# Below this many transactions a plain loop beats building a DataFrame
+PANDAS_MIN_ROWS = 32
+
+# Repeat generate_recommendations calls for a user within this many seconds
+# (dashboard refreshes, retries) reuse the previous result
+RECOMMENDATIONS_CACHE_TTL = float(os.getenv("RECOMMENDATIONS_CACHE_TTL", "300"))
+RECOMMENDATIONS_CACHE_MAXSIZE = 10000
+
+# user_id -> result
+_recommendations_cache = TTLCache(RECOMMENDATIONS_CACHE_MAXSIZE, RECOMMENDATIONS_CACHE_TTL)
+
+# A user whose last full run produced no recommendations and whose month-to-date
+# spending has moved by at most this fraction since is skipped without running
+# the stages; the snapshot is only refreshed by a full run, so one happens at
+# least every SPENDING_SNAPSHOT_TTL seconds
+STABLE_SPENDING_TOLERANCE = 0.05
+SPENDING_SNAPSHOT_TTL = float(os.getenv("SPENDING_SNAPSHOT_TTL", "86400"))
+
+# user_id -> (recommendation_count, total_spent)
+_spending_snapshots = TTLCache(RECOMMENDATIONS_CACHE_MAXSIZE, SPENDING_SNAPSHOT_TTL)
+
+
+def _get_cached_recommendations(user_id: str) -> Optional[Dict[str, Any]]:
+    """Return a copy of a fresh cached result, or None on a miss"""
+    result = _recommendations_cache.get(user_id)
+    return copy.deepcopy(result) if result is not None else None
+
+
+def _cache_recommendations(user_id: str, result: Dict[str, Any]) -> None:
+    """Store a copy of a result"""
+    _recommendations_cache.set(user_id, copy.deepcopy(result))
+
+
+def _get_spending_snapshot(user_id: str) -> Optional[Tuple[int, float]]:
+    """Return (recommendation_count, total_spent) from the last full run, or None"""
+    return _spending_snapshots.get(user_id)
+
+
+def _record_spending_snapshot(user_id: str, recommendation_count: int, total_spent: float) -> None:
+    """Remember a full run's outcome"""
+    _spending_snapshots.set(user_id, (recommendation_count, total_spent))
+
+
+@dataclass(slots=True)
+class Recommendation:
+    """A recommendation produced by one of the analysis stages"""
+    tool_name: str
+    recommendation_type: str
+    title: str
+    description: str
+    potential_savings: float
+    priority: int
+    urgency: str
+    related_category: str = ''
+    related_merchant: str = ''
+    
+    @property
+    def annual_savings(self) -> float:
+        return self.potential_savings * 12
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Result form, with the derived annual_savings included"""
+        data = asdict(self)
+        data['annual_savings'] = self.annual_savings
+        return data
+
+
+@dataclass(slots=True)
+class _RunCache:
+    """
+    Per-run cache: the stages ask for the same (user, category) history over
+    and over, so each one is fetched once per public call. Every call builds
+    its own, so overlapping calls on one agent never share or clear it.
+    """
+    histories: Dict[tuple, List[Dict]] = field(default_factory=dict)
+    # Stages run concurrently; one lock per history key keeps two of them
+    # from fetching the same history at the same time
+    locks: Dict[tuple, threading.Lock] = field(default_factory=dict)
+    locks_guard: threading.Lock = field(default_factory=threading.Lock)
+
+
 class FinancialAnalystAgent:
     
+    # Merchant keywords that mark a charge as a subscription, matched in one
+    # case-insensitive scan of the merchant name
+    SUBSCRIPTION_KEYWORDS = ('SPOTIFY', 'NETFLIX', 'LINKEDIN', 'PRIME', 'DISNEY', 'GYM')
+    SUBSCRIPTION_KEYWORD_RE = re.compile('|'.join(map(re.escape, SUBSCRIPTION_KEYWORDS)), re.IGNORECASE)
+    
     def __init__(self, toolbox_url: str = CLIENT_URL):
-        print("Initializing Agent 2: Financial Analyst...")
+        # Console output is buffered and written once per public call
+        self._log_lines: List[str] = []
+        
+        self._log("Initializing Agent 2: Financial Analyst...")
         self.toolbox_client = ToolboxSyncClient(toolbox_url)
         
-        try:
-            self.tools = self.toolbox_client.load_toolset()
-            print(f"   Loaded {len(self.tools)} tools")
-        except Exception as e:
-            print(f"   Failed to load tools: {e}")
-            raise
+        # Tool handles are loaded on first use and then reused, so startup
+        # doesn't pay for the whole toolset manifest
+        self._tools_cache: Dict[str, Any] = {}
         
-        print("Agent 2: Financial Analyst initialized successfully")
+        self._log("Agent 2: Financial Analyst initialized successfully")
+        self._flush_log()
     
     def generate_recommendations(self, user_id: str) -> Dict[str, Any]:
-        print(f"\n{'='*70}")
-        print(f"AGENT 2: GENERATING RECOMMENDATIONS")
-        print(f"   User ID: {user_id}")
-        print(f"{'='*70}\n")
+        try:
+            return self._generate_recommendations(user_id)
+        finally:
+            self._flush_log()
+    
+    def generate_daily_summary(self, user_id: str, summary_date: Optional[str] = None) -> Dict[str, Any]:
+        try:
+            return self._generate_daily_summary(user_id, summary_date)
+        finally:
+            self._flush_log()
+    
+    def _tool(self, name: str):
+        tool = self._tools_cache.get(name)
+        if tool is None:
+            tool = self._tools_cache[name] = self.toolbox_client.load_tool(name)
+        return tool
+    
+    def _call(self, name: str, **kwargs):
+        """Invoke a toolbox tool, decoding a JSON string response into Python objects"""
+        result = self._tool(name)(**kwargs)
+        if isinstance(result, (str, bytes)):
+            return _json_loads(result)
+        return result
+    
+    def _log(self, line: str = ""):
+        self._log_lines.append(line)
+    
+    def _flush_log(self):
+        if self._log_lines:
+            sys.stdout.write("\n".join(self._log_lines) + "\n")
+            sys.stdout.flush()
+            self._log_lines.clear()
+    
+    def _generate_recommendations(self, user_id: str) -> Dict[str, Any]:
+        # A recent result is returned as-is (and not saved a second time)
+        cached = _get_cached_recommendations(user_id)
+        if cached is not None:
+            self._log(f"Returning cached recommendations for user {user_id}")
+            return cached
+        
+        run_cache = _RunCache()
+        
+        # Users with nothing to recommend last time are checked against this
+        # month's spending first; if it has barely moved, the stages are skipped
+        current_spending = None
+        snapshot = _get_spending_snapshot(user_id)
+        if snapshot is not None and snapshot[0] == 0:
+            current_spending = self._get_current_month_spending(user_id)
+            last_total = snapshot[1]
+            if abs(self._total_spent(current_spending) - last_total) <= last_total * STABLE_SPENDING_TOLERANCE:
+                self._log(f"Spending unchanged for user {user_id}; skipping recommendation stages")
+                return {
+                    'status': 'success',
+                    'total_recommendations': 0,
+                    'high_priority': 0,
+                    'potential_monthly_savings': 0.0,
+                    'potential_annual_savings': 0.0,
+                    'recommendations': [],
+                    'message': 'Budget on track'
+                }
+        
+        self._log(f"\n{'='*70}")
+        self._log(f"AGENT 2: GENERATING RECOMMENDATIONS")
+        self._log(f"   User ID: {user_id}")
+        self._log(f"{'='*70}\n")
         
         recommendations_created = []
         
-        print("STEP 1: Analyzing budget health...")
-        budget_recs = self._analyze_budget_health(user_id)
-        recommendations_created.extend(budget_recs)
-        print(f"   Created {len(budget_recs)} budget recommendations\n")
-        
-        print("STEP 2: Finding savings opportunities...")
-        savings_recs = self._find_savings_opportunities(user_id)
-        recommendations_created.extend(savings_recs)
-        print(f"   Created {len(savings_recs)} savings recommendations\n")
-        
-        print("STEP 3: Optimizing subscriptions...")
-        subscription_recs = self._optimize_subscriptions(user_id)
-        recommendations_created.extend(subscription_recs)
-        print(f"   Created {len(subscription_recs)} subscription recommendations\n")
-        
-        print("STEP 4: Predicting spending trends...")
-        trend_recs = self._predict_spending_trends(user_id)
-        recommendations_created.extend(trend_recs)
-        print(f"   Created {len(trend_recs)} trend-based recommendations\n")
-        
-        total_savings = sum(r.get('potential_savings', 0) for r in recommendations_created)
-        high_priority = sum(1 for r in recommendations_created if r['priority'] <= 2)
-        
-        print(f"{'='*70}")
-        print(f"AGENT 2: RECOMMENDATIONS COMPLETE")
-        print(f"{'='*70}")
-        print(f"   Total recommendations: {len(recommendations_created)}")
-        print(f"   High priority: {high_priority}")
-        print(f"   Potential monthly savings: ${total_savings:.2f}")
-        print(f"{'='*70}\n")
+        # The four stages are independent and bound by toolbox round-trips,
+        # so they run concurrently; results are reported in stage order
+        stages = [
+            ("STEP 1: Analyzing budget health...", "budget"),
+            ("STEP 2: Finding savings opportunities...", "savings"),
+            ("STEP 3: Optimizing subscriptions...", "subscription"),
+            ("STEP 4: Predicting spending trends...", "trend-based"),
+        ]
         
-        return {
+        with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+            # Subscriptions don't need this month's spending, so start them first;
+            # the other three stages share one get-current-month-spending call
+            subscriptions_future = executor.submit(self._optimize_subscriptions, user_id)
+            if current_spending is None:
+                current_spending = self._get_current_month_spending(user_id)
+            futures = [
+                executor.submit(self._analyze_budget_health, user_id, current_spending, run_cache),
+                executor.submit(self._find_savings_opportunities, user_id, current_spending, run_cache),
+                subscriptions_future,
+                executor.submit(self._predict_spending_trends, user_id, current_spending, run_cache),
+            ]
+        
+        for (step, label), future in zip(stages, futures):
+            stage_recs = future.result()
+            recommendations_created.extend(stage_recs)
+            self._log(step)
+            self._log(f"   Created {len(stage_recs)} {label} recommendations\n")
+        
+        # One insert for everything the stages produced
+        self._save_recommendations(user_id, recommendations_created)
+        
+        total_savings = sum(r.potential_savings for r in recommendations_created)
+        high_priority = sum(1 for r in recommendations_created if r.priority <= 2)
+        
+        self._log(f"{'='*70}")
+        self._log(f"AGENT 2: RECOMMENDATIONS COMPLETE")
+        self._log(f"{'='*70}")
+        self._log(f"   Total recommendations: {len(recommendations_created)}")
+        self._log(f"   High priority: {high_priority}")
+        self._log(f"   Potential monthly savings: ${total_savings:.2f}")
+        self._log(f"{'='*70}\n")
+        
+        result = {
             'status': 'success',
             'total_recommendations': len(recommendations_created),
             'high_priority': high_priority,
             'potential_monthly_savings': total_savings,
             'potential_annual_savings': total_savings * 12,
-            'recommendations': recommendations_created
+            'recommendations': [r.to_dict() for r in recommendations_created]
         }
+        _cache_recommendations(user_id, result)
+        _record_spending_snapshot(user_id, len(recommendations_created), self._total_spent(current_spending))
+        
+        return result
     
-    def generate_daily_summary(self, user_id: str, summary_date: Optional[str] = None) -> Dict[str, Any]:
+    def _generate_daily_summary(self, user_id: str, summary_date: Optional[str] = None) -> Dict[str, Any]:
         if not summary_date:
             summary_date = datetime.now().date().isoformat()
         
-        print(f"\n{'='*70}")
-        print(f"AGENT 2: GENERATING DAILY SUMMARY")
-        print(f"   User ID: {user_id}")
-        print(f"   Date: {summary_date}")
-        print(f"{'='*70}\n")
+        self._log(f"\n{'='*70}")
+        self._log(f"AGENT 2: GENERATING DAILY SUMMARY")
+        self._log(f"   User ID: {user_id}")
+        self._log(f"   Date: {summary_date}")
+        self._log(f"{'='*70}\n")
         
-        print("STEP 1: Fetching today's transactions...")
-        today_txns = self._get_transactions_for_date(user_id, summary_date)
-        print(f"   Found {len(today_txns)} transactions\n")
+        # The budget check doesn't depend on today's transactions, so it runs
+        # alongside the transaction fetch instead of after it
+        executor = ThreadPoolExecutor(max_workers=1)
+        alerts_future = executor.submit(self._check_budget_status, user_id, _RunCache())
+        executor.shutdown(wait=False)
         
-        print("STEP 2: Analyzing spending by category...")
+        self._log("STEP 1: Fetching today's transactions...")
+        today_txns = self._get_transactions_for_date(user_id, summary_date)
+        self._log(f"   Found {len(today_txns)} transactions\n")
+        
+        # Nothing to analyze on a day without transactions; the budget check's
+        # result is dropped without waiting for it
+        if not today_txns:
+            alerts_future.cancel()
+            return {
+                'status': 'success',
+                'summary_date': summary_date,
+                'total_spent': 0.0,
+                'transaction_count': 0,
+                'spending_by_category': {},
+                'top_category': 'None',
+                'budget_alerts': [],
+                'subscriptions_charged': [],
+                'summary_text': f"No transactions on {summary_date}"
+            }
+        
+        self._log("STEP 2: Analyzing spending by category...")
         spending_by_category = self._analyze_spending_by_category(today_txns)
         total_spent = sum(spending_by_category.values())
-        print(f"   Total spent today: ${total_spent:.2f}\n")
+        self._log(f"   Total spent today: ${total_spent:.2f}\n")
         
-        print("STEP 3: Checking budget status...")
-        budget_alerts = self._check_budget_status(user_id)
-        print(f"   Budget alerts: {len(budget_alerts)}\n")
+        self._log("STEP 3: Checking budget status...")
+        budget_alerts = alerts_future.result()
+        self._log(f"   Budget alerts: {len(budget_alerts)}\n")
         
-        print("STEP 4: Checking subscription charges...")
-        subscriptions_today = self._get_subscriptions_charged_today(user_id, summary_date)
-        print(f"   Subscriptions charged: {len(subscriptions_today)}\n")
+        self._log("STEP 4: Checking subscription charges...")
+        subscriptions_today = self._get_subscriptions_charged_today(user_id, summary_date, today_txns)
+        self._log(f"   Subscriptions charged: {len(subscriptions_today)}\n")
         
-        top_category = max(spending_by_category, key=spending_by_category.get) if spending_by_category else 'None'
+        top_category = max(spending_by_category.items(), key=itemgetter(1))[0] if spending_by_category else 'None'
         
         summary_text = self._create_summary_text(
             date=summary_date,
@@ -113,11 +326,11 @@ class FinancialAnalystAgent:
             subscriptions_charged=len(subscriptions_today)
         )
         
-        print(f"{'='*70}")
-        print(f"DAILY SUMMARY")
-        print(f"{'='*70}")
-        print(summary_text)
-        print(f"{'='*70}\n")
+        self._log(f"{'='*70}")
+        self._log(f"DAILY SUMMARY")
+        self._log(f"{'='*70}")
+        self._log(summary_text)
+        self._log(f"{'='*70}\n")
         
         return {
             'status': 'success',
@@ -131,23 +344,20 @@ class FinancialAnalystAgent:
             'summary_text': summary_text
         }
     
-    def _analyze_budget_health(self, user_id: str) -> List[Dict]:
+    def _analyze_budget_health(self, user_id: str, current_spending: List[Dict],
+                               run_cache: _RunCache) -> List[Recommendation]:
         recommendations = []
         
         try:
-            tool = self.toolbox_client.load_tool('get-current-month-spending')
-            current_spending = tool(user_id=user_id)
-            
-            if isinstance(current_spending, str):
-                current_spending = json.loads(current_spending)
-            
             if not current_spending:
                 return recommendations
             
+            self._prefetch_histories(run_cache, user_id, [c['category'] for c in current_spending])
+            
             for category_data in current_spending:
                 category = category_data['category']
                 current = float(category_data['total_amount'])
-                baseline = self._get_category_baseline(user_id, category)
+                baseline = self._get_category_baseline(run_cache, user_id, category)
                 
                 if baseline > 0:
                     utilization = (current / baseline) * 100
@@ -155,96 +365,86 @@ class FinancialAnalystAgent:
                     if utilization > 120:
                         potential_savings = current - baseline
                         
-                        rec = {
-                            'tool_name': 'budget_analyzer',
-                            'recommendation_type': 'budget_alert',
-                            'title': f'Over Budget in {category}',
-                            'description': f'You\'ve spent ${current:.2f} in {category} this month, which is {utilization:.0f}% of your typical spending (${baseline:.2f}).',
-                            'potential_savings': potential_savings,
-                            'annual_savings': potential_savings * 12,
-                            'priority': 1,
-                            'urgency': 'high',
-                            'related_category': category
-                        }
+                        rec = Recommendation(
+                            tool_name='budget_analyzer',
+                            recommendation_type='budget_alert',
+                            title=f'Over Budget in {category}',
+                            description=f'You\'ve spent ${current:.2f} in {category} this month, which is {utilization:.0f}% of your typical spending (${baseline:.2f}).',
+                            potential_savings=potential_savings,
+                            priority=1,
+                            urgency='high',
+                            related_category=category
+                        )
                         
                         recommendations.append(rec)
-                        self._save_recommendation(user_id, rec)
                     
                     elif utilization > 100:
                         potential_savings = current - baseline
                         
-                        rec = {
-                            'tool_name': 'budget_analyzer',
-                            'recommendation_type': 'budget_warning',
-                            'title': f'{category} Spending Above Average',
-                            'description': f'You\'re at {utilization:.0f}% of typical {category} spending.',
-                            'potential_savings': potential_savings,
-                            'annual_savings': potential_savings * 12,
-                            'priority': 2,
-                            'urgency': 'medium',
-                            'related_category': category
-                        }
+                        rec = Recommendation(
+                            tool_name='budget_analyzer',
+                            recommendation_type='budget_warning',
+                            title=f'{category} Spending Above Average',
+                            description=f'You\'re at {utilization:.0f}% of typical {category} spending.',
+                            potential_savings=potential_savings,
+                            priority=2,
+                            urgency='medium',
+                            related_category=category
+                        )
                         
                         recommendations.append(rec)
-                        self._save_recommendation(user_id, rec)
         
         except Exception as e:
-            print(f"Error analyzing budget: {e}")
+            self._log(f"Error analyzing budget: {e}")
         
         return recommendations
     
-    def _find_savings_opportunities(self, user_id: str) -> List[Dict]:
+    def _find_savings_opportunities(self, user_id: str, current_spending: List[Dict],
+                                    run_cache: _RunCache) -> List[Recommendation]:
         recommendations = []
         
         try:
-            tool = self.toolbox_client.load_tool('get-current-month-spending')
-            current_spending = tool(user_id=user_id)
-            
-            if isinstance(current_spending, str):
-                current_spending = json.loads(current_spending)
-            
             if not current_spending:
                 return recommendations
             
+            self._prefetch_histories(run_cache, user_id, [
+                c['category'] for c in current_spending
+                if c['category'] in ['Dining', 'Shopping', 'Entertainment']
+            ])
+            
             for category_data in current_spending:
                 category = category_data['category']
                 current = float(category_data['total_amount'])
                 
                 if category in ['Dining', 'Shopping', 'Entertainment']:
-                    baseline = self._get_category_baseline(user_id, category)
+                    baseline = self._get_category_baseline(run_cache, user_id, category)
                     
                     if baseline > 0 and current > baseline * 1.2:
                         potential_savings = (current - baseline) * 0.5
                         
-                        rec = {
-                            'tool_name': 'savings_finder',
-                            'recommendation_type': 'reduce_spending',
-                            'title': f'Save on {category}',
-                            'description': f'You\'re spending ${current:.2f}/month on {category}, above baseline of ${baseline:.2f}.',
-                            'potential_savings': potential_savings,
-                            'annual_savings': potential_savings * 12,
-                            'priority': 3,
-                            'urgency': 'low',
-                            'related_category': category
-                        }
+                        rec = Recommendation(
+                            tool_name='savings_finder',
+                            recommendation_type='reduce_spending',
+                            title=f'Save on {category}',
+                            description=f'You\'re spending ${current:.2f}/month on {category}, above baseline of ${baseline:.2f}.',
+                            potential_savings=potential_savings,
+                            priority=3,
+                            urgency='low',
+                            related_category=category
+                        )
                         
                         recommendations.append(rec)
-                        self._save_recommendation(user_id, rec)
         
         except Exception as e:
-            print(f"Error finding savings: {e}")
+            self._log(f"Error finding savings: {e}")
         
         return recommendations
     
-    def _optimize_subscriptions(self, user_id: str) -> List[Dict]:
+    def _optimize_subscriptions(self, user_id: str) -> List[Recommendation]:
         recommendations = []
         
         try:
-            tool = self.toolbox_client.load_tool('get-user-subscriptions')
-            subscriptions = tool(user_id=user_id)
-            
-            if isinstance(subscriptions, str):
-                subscriptions = json.loads(subscriptions)
+            subscriptions = self._call('get-user-subscriptions', user_id=user_id)
             
             if not subscriptions:
                 return recommendations
@@ -252,195 +452,270 @@ class FinancialAnalystAgent:
             total_monthly = sum(float(s.get('amount', 0)) for s in subscriptions)
             
             if total_monthly > 100:
-                rec = {
-                    'tool_name': 'subscription_optimizer',
-                    'recommendation_type': 'reduce_subscriptions',
-                    'title': 'High Subscription Spending',
-                    'description': f'You\'re spending ${total_monthly:.2f}/month on {len(subscriptions)} subscriptions.',
-                    'potential_savings': total_monthly * 0.3,
-                    'annual_savings': total_monthly * 12 * 0.3,
-                    'priority': 2,
-                    'urgency': 'medium',
-                    'related_category': 'Subscriptions'
-                }
+                rec = Recommendation(
+                    tool_name='subscription_optimizer',
+                    recommendation_type='reduce_subscriptions',
+                    title='High Subscription Spending',
+                    description=f'You\'re spending ${total_monthly:.2f}/month on {len(subscriptions)} subscriptions.',
+                    potential_savings=total_monthly * 0.3,
+                    priority=2,
+                    urgency='medium',
+                    related_category='Subscriptions'
+                )
                 recommendations.append(rec)
-                self._save_recommendation(user_id, rec)
             
             for sub in subscriptions:
                 amount = float(sub.get('amount', 0))
                 merchant = sub.get('merchant_standardized', '')
                 
                 if amount > 50:
-                    rec = {
-                        'tool_name': 'subscription_optimizer',
-                        'recommendation_type': 'expensive_subscription',
-                        'title': f'Review {merchant} Subscription',
-                        'description': f'{merchant} costs ${amount:.2f}/month (${amount * 12:.2f}/year).',
-                        'potential_savings': amount,
-                        'annual_savings': amount * 12,
-                        'priority': 3,
-                        'urgency': 'low',
-                        'related_merchant': merchant,
-                        'related_category': 'Subscriptions'
-                    }
+                    rec = Recommendation(
+                        tool_name='subscription_optimizer',
+                        recommendation_type='expensive_subscription',
+                        title=f'Review {merchant} Subscription',
+                        description=f'{merchant} costs ${amount:.2f}/month (${amount * 12:.2f}/year).',
+                        potential_savings=amount,
+                        priority=3,
+                        urgency='low',
+                        related_merchant=merchant,
+                        related_category='Subscriptions'
+                    )
                     recommendations.append(rec)
-                    self._save_recommendation(user_id, rec)
         
         except Exception as e:
-            print(f"Error optimizing subscriptions: {e}")
+            self._log(f"Error optimizing subscriptions: {e}")
         
         return recommendations
     
-    def _predict_spending_trends(self, user_id: str) -> List[Dict]:
+    def _predict_spending_trends(self, user_id: str, current_spending: List[Dict],
+                                 run_cache: _RunCache) -> List[Recommendation]:
         recommendations = []
         
         try:
-            tool = self.toolbox_client.load_tool('get-user-categories')
-            categories = tool(user_id=user_id)
+            # This month's spending already names the active categories; only
+            # ask for the full category list when there's none yet
+            categories = current_spending
+            if not categories:
+                categories = self._call('get-user-categories', user_id=user_id)
+            
+            histories = self._prefetch_histories(run_cache, user_id, [c['category'] for c in categories])
             
-            if isinstance(categories, str):
-                categories = json.loads(categories)
+            # (category, monthly amounts, most recent first) for categories with enough history
+            series = [
+                (cat_data['category'], [float(h['total_amount']) for h in histories[cat_data['category']]])
+                for cat_data in categories
+                if len(histories[cat_data['category']]) >= 2
+            ]
             
-            for cat_data in categories:
-                category = cat_data['category']
-                history = self._get_category_history(user_id, category, months=3)
+            for category, recent_amount, avg_amount in self._rising_trends(series):
+                predicted_next = recent_amount * 1.1
                 
-                if len(history) >= 2:
-                    amounts = [float(h['total_amount']) for h in history]
-                    avg_amount = sum(amounts) / len(amounts)
-                    recent_amount = amounts[0]
-                    
-                    if recent_amount > avg_amount * 1.2:
-                        predicted_next = recent_amount * 1.1
-                        
-                        rec = {
-                            'tool_name': 'trend_predictor',
-                            'recommendation_type': 'trend_alert',
-                            'title': f'{category} Spending Trending Up',
-                            'description': f'Last month: ${recent_amount:.2f}, predicted: ${predicted_next:.2f}.',
-                            'potential_savings': predicted_next - avg_amount,
-                            'annual_savings': (predicted_next - avg_amount) * 12,
-                            'priority': 2,
-                            'urgency': 'medium',
-                            'related_category': category
-                        }
-                        
-                        recommendations.append(rec)
-                        self._save_recommendation(user_id, rec)
+                rec = Recommendation(
+                    tool_name='trend_predictor',
+                    recommendation_type='trend_alert',
+                    title=f'{category} Spending Trending Up',
+                    description=f'Last month: ${recent_amount:.2f}, predicted: ${predicted_next:.2f}.',
+                    potential_savings=predicted_next - avg_amount,
+                    priority=2,
+                    urgency='medium',
+                    related_category=category
+                )
+                
+                recommendations.append(rec)
         
         except Exception as e:
-            print(f"Error predicting trends: {e}")
+            self._log(f"Error predicting trends: {e}")
         
         return recommendations
     
-    def _get_category_baseline(self, user_id: str, category: str) -> float:
+    def _rising_trends(self, series: List[tuple]) -> List[tuple]:
+        """
+        (category, recent_amount, avg_amount) for every series whose most
+        recent month is more than 20% above its average, in input order
+        """
+        if not series:
+            return []
+        
+        if not NUMPY_AVAILABLE:
+            rising = []
+            for category, amounts in series:
+                avg_amount = sum(amounts) / len(amounts)
+                if amounts[0] > avg_amount * 1.2:
+                    rising.append((category, amounts[0], avg_amount))
+            return rising
+        
+        # One (categories x months) array, NaN-padded where a history is shorter
+        width = max(len(amounts) for _, amounts in series)
+        arr = np.full((len(series), width), np.nan)
+        for i, (_, amounts) in enumerate(series):
+            arr[i, :len(amounts)] = amounts
+        
+        means = np.nanmean(arr, axis=1)
+        recent = arr[:, 0]
+        mask = recent > means * 1.2
+        
+        return [(series[i][0], float(recent[i]), float(means[i])) for i in np.flatnonzero(mask)]
+    
+    def _get_current_month_spending(self, user_id: str) -> List[Dict]:
         try:
-            history = self._get_category_history(user_id, category, months=3)
-            if history:
-                amounts = [float(h['total_amount']) for h in history]
-                return sum(amounts) / len(amounts)
-            return 0.0
-        except:
+            result = self._call('get-current-month-spending', user_id=user_id)
+            return result if isinstance(result, list) else []
+        except Exception as e:
+            self._log(f"Error fetching current month spending: {e}")
+            return []
+    
+    @staticmethod
+    def _total_spent(current_spending: List[Dict]) -> float:
+        # spending_patterns.total_amount is nullable
+        return sum(float(c.get('total_amount') or 0) for c in current_spending)
+    
+    def _prefetch_histories(self, run_cache: _RunCache, user_id: str, categories: List[str],
+                            months: int = 3) -> Dict[str, List[Dict]]:
+        """Fetch the history of every category concurrently into the run cache"""
+        categories = list(dict.fromkeys(categories))
+        histories = {
+            c: run_cache.histories[(user_id, c, months)]
+            for c in categories if (user_id, c, months) in run_cache.histories
+        }
+        missing = [c for c in categories if c not in histories]
+        
+        # Failed fetches aren't cached, so take their [] from the map rather
+        # than asking _get_category_history again
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(HISTORY_FETCH_WORKERS, len(missing))) as executor:
+                fetched = executor.map(lambda c: self._get_category_history(run_cache, user_id, c, months), missing)
+                histories.update(zip(missing, fetched))
+        
+        return {c: histories[c] for c in categories}
+    
+    def _get_category_baseline(self, run_cache: _RunCache, user_id: str, category: str) -> float:
+        """Average monthly spend from the prefetched 3-month history (0.0 without one)"""
+        history = run_cache.histories.get((user_id, category, 3))
+        if not history:
             return 0.0
+        return sum(float(h['total_amount']) for h in history) / len(history)
     
-    def _get_category_history(self, user_id: str, category: str, months: int = 3) -> List[Dict]:
-        try:
-            tool = self.toolbox_client.load_tool('get-category-history')
-            result = tool(user_id=user_id, category=category, months=months)
+    def _get_category_history(self, run_cache: _RunCache, user_id: str, category: str,
+                              months: int = 3) -> List[Dict]:
+        key = (user_id, category, months)
+        if key in run_cache.histories:
+            return run_cache.histories[key]
+        
+        with run_cache.locks_guard:
+            key_lock = run_cache.locks.setdefault(key, threading.Lock())
+        
+        with key_lock:
+            if key in run_cache.histories:
+                return run_cache.histories[key]
             
-            if isinstance(result, str):
-                result = json.loads(result)
+            try:
+                result = self._call('get-category-history', user_id=user_id, category=category, months=months)
+                history = result if isinstance(result, list) else []
+            except Exception as e:
+                # Toolbox tool errors are raised as plain Exceptions
+                self._log(f"Error fetching {category} history: {e}")
+                return []
             
-            return result if isinstance(result, list) else []
-        except:
-            return []
+            run_cache.histories[key] = history
+            return history
     
-    def _save_recommendation(self, user_id: str, rec: Dict):
+    def _save_recommendations(self, user_id: str, recs: List[Recommendation]):
+        if not recs:
+            return
+        
+        # annual_savings is derived from potential_savings by the insert itself
+        rows = [asdict(rec) for rec in recs]
+        
         try:
-            tool = self.toolbox_client.load_tool('insert-recommendation')
-            tool(
-                user_id=user_id,
-                tool_name=rec['tool_name'],
-                recommendation_type=rec['recommendation_type'],
-                title=rec['title'],
-                description=rec['description'],
-                potential_savings=str(rec['potential_savings']),
-                annual_savings=str(rec['annual_savings']),
-                priority=rec['priority'],
-                urgency=rec['urgency'],
-                related_category=rec.get('related_category', ''),
-                related_merchant=rec.get('related_merchant', '')
-            )
+            self._call('insert-recommendations-bulk', user_id=user_id, recommendations=_json_dumps(rows))
         except Exception as e:
-            print(f"Error saving recommendation: {e}")
+            self._log(f"Error saving recommendations: {e}")
     
     def _get_transactions_for_date(self, user_id: str, date_str: str) -> List[Dict]:
         try:
-            tool = self.toolbox_client.load_tool('get-user-transactions')
-            result = tool(user_id=user_id, start_date=date_str, end_date=date_str)
-            
-            if isinstance(result, str):
-                result = json.loads(result)
-            
+            result = self._call('get-user-transactions', user_id=user_id, start_date=date_str, end_date=date_str)
             return result if isinstance(result, list) else []
-        except:
+        except Exception as e:
+            self._log(f"Error fetching transactions for {date_str}: {e}")
             return []
     
     def _analyze_spending_by_category(self, transactions: List[Dict]) -> Dict[str, float]:
+        if PANDAS_AVAILABLE and len(transactions) >= PANDAS_MIN_ROWS:
+            return self._analyze_spending_by_category_df(transactions)
+        
         spending = defaultdict(float)
         
         for txn in transactions:
+            amt = txn.get('amount')
+            if amt is None:
+                continue
             try:
-                amount = abs(float(txn.get('amount', 0)))
-                category = txn.get('category', 'Other')
-                
-                if amount > 0 and txn.get('transaction_type') != 'credit':
-                    spending[category] += amount
-            except:
+                amount = abs(float(amt))
+            except (TypeError, ValueError):
                 continue
+            
+            if amount > 0 and txn.get('transaction_type') != 'credit':
+                spending[txn.get('category', 'Other')] += amount
         
         return dict(spending)
     
-    def _check_budget_status(self, user_id: str) -> List[str]:
+    def _analyze_spending_by_category_df(self, transactions: List[Dict]) -> Dict[str, float]:
+        """Vectorized _analyze_spending_by_category for large transaction lists"""
+        df = pd.DataFrame(transactions)
+        if 'amount' not in df:
+            return {}
+        
+        amounts = pd.to_numeric(df['amount'], errors='coerce').abs()
+        keep = amounts > 0
+        if 'transaction_type' in df:
+            keep &= df['transaction_type'] != 'credit'
+        
+        categories = df['category'].fillna('Other') if 'category' in df else pd.Series('Other', index=df.index)
+        totals = amounts[keep].groupby(categories[keep], sort=False).sum()
+        return {category: float(total) for category, total in totals.items()}
+    
+    def _check_budget_status(self, user_id: str, run_cache: _RunCache) -> List[str]:
         alerts = []
         
         try:
-            tool = self.toolbox_client.load_tool('get-current-month-spending')
-            current_spending = tool(user_id=user_id)
+            current_spending = self._get_current_month_spending(user_id)
             
-            if isinstance(current_spending, str):
-                current_spending = json.loads(current_spending)
+            self._prefetch_histories(run_cache, user_id, [c['category'] for c in current_spending])
             
             for category_data in current_spending:
                 category = category_data['category']
                 current = float(category_data['total_amount'])
-                baseline = self._get_category_baseline(user_id, category)
+                baseline = self._get_category_baseline(run_cache, user_id, category)
                 
                 if baseline > 0 and current > baseline * 1.2:
                     alerts.append(f"{category}: ${current:.2f} (120% of baseline)")
         
-        except:
-            pass
+        except (KeyError, TypeError, ValueError) as e:
+            self._log(f"Error checking budget status: {e}")
         
         return alerts
     
-    def _get_subscriptions_charged_today(self, user_id: str, date_str: str) -> List[Dict]:
+    def _get_subscriptions_charged_today(self, user_id: str, date_str: str,
+                                         transactions: Optional[List[Dict]] = None) -> List[Dict]:
         subscriptions_charged = []
         
-        try:
+        if transactions is None:
             transactions = self._get_transactions_for_date(user_id, date_str)
+        
+        for txn in transactions:
+            merchant = txn.get('merchant_name') or txn.get('name') or ''
             
-            for txn in transactions:
-                merchant = (txn.get('merchant_name') or txn.get('name', '')).upper()
+            # Only matching merchants are uppercased for the report
+            if self.SUBSCRIPTION_KEYWORD_RE.search(merchant):
+                try:
+                    amount = abs(float(txn.get('amount') or 0))
+                except (TypeError, ValueError):
+                    continue
                 
-                if any(word in merchant for word in ['SPOTIFY', 'NETFLIX', 'LINKEDIN', 'PRIME', 'DISNEY', 'GYM']):
-                    subscriptions_charged.append({
-                        'merchant': merchant,
-                        'amount': abs(float(txn.get('amount', 0)))
-                    })
-        
-        except:
-            pass
+                subscriptions_charged.append({
+                    'merchant': merchant.upper(),
+                    'amount': amount
+                })
         
         return subscriptions_charged
     
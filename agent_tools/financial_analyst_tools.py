@@ -6,27 +6,58 @@ These functions are designed to be wrapped with FunctionTool for Google ADK.
 Each function has clear docstrings that the LLM can use to understand when to call them.
 """
 
-import json
+import copy
 import logging
-from datetime import datetime, timedelta
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from itertools import zip_longest
 from typing import Dict, Any, List, Optional
-from collections import defaultdict
+from agent_tools.toolbox_wrapper import TTLCache, _json_dumps
+
+# NumPy (a pandas dependency) computes trend statistics for all categories at once
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
 
 logger = logging.getLogger(__name__)
 
+# Categories find_savings_opportunities suggests cutting back on
+_DISCRETIONARY_CATEGORIES = frozenset({'Dining', 'Shopping', 'Entertainment', 'Travel', 'Recreation'})
+
+# Concurrent get-category-history calls when the batched history tool is unavailable
+HISTORY_FETCH_WORKERS = 8
+
+# Category histories are reused across tool calls for this many seconds, so
+# budget, savings and trend analysis in one agent turn share their fetches
+HISTORY_CACHE_TTL = 300
+HISTORY_CACHE_MAXSIZE = 4096
+
+# (user_id, category, months) -> history and (user_id, months) -> {category: baseline}
+_history_cache = TTLCache(HISTORY_CACHE_MAXSIZE, HISTORY_CACHE_TTL)
+
 # Lazy-loaded toolbox to avoid connection issues at import time
 _toolbox = None
 
+# After a failed connection, tools go straight to sample data for this many
+# seconds instead of retrying (and logging) on every call
+TOOLBOX_RETRY_INTERVAL = 60
+_toolbox_unavailable_until = 0.0
+
 def _get_toolbox():
     """Get or create toolbox wrapper (lazy initialization)"""
-    global _toolbox
-    if _toolbox is None:
+    global _toolbox, _toolbox_unavailable_until
+    if _toolbox is None and time.monotonic() >= _toolbox_unavailable_until:
         try:
             from agent_tools.toolbox_wrapper import get_toolbox
             _toolbox = get_toolbox()
         except Exception as e:
-            logger.warning(f"Could not connect to MCP Toolbox: {e}")
+            logger.warning("Could not connect to MCP Toolbox: %s", e)
             _toolbox = None
+            _toolbox_unavailable_until = time.monotonic() + TOOLBOX_RETRY_INTERVAL
     return _toolbox
 
 
@@ -47,7 +78,7 @@ def analyze_budget_health(user_id: str) -> Dict[str, Any]:
         - recommendations: List of specific recommendations with potential savings
         - summary: Text summary of budget health
     """
-    logger.info(f"Analyzing budget health for user {user_id}")
+    logger.info("Analyzing budget health for user %s", user_id)
     
     toolbox = _get_toolbox()
     if not toolbox:
@@ -64,59 +95,66 @@ def analyze_budget_health(user_id: str) -> Dict[str, Any]:
             return {"status": "error", "message": "Failed to fetch spending data"}
         
         current_spending = result.get('data', [])
-        if isinstance(current_spending, str):
-            current_spending = json.loads(current_spending)
         
-        for category_data in current_spending:
-            category = category_data.get('category', 'Unknown')
-            current = float(category_data.get('total_amount', 0))
-            
-            # Get baseline (3-month average)
-            baseline = _get_category_baseline(toolbox, user_id, category)
+        # (category, amount) parsed once for both the baseline query and the loop
+        spending = [
+            (category_data.get('category', 'Unknown'), float(category_data.get('total_amount', 0)))
+            for category_data in current_spending
+        ]
+        
+        # Every category's 3-month average in one query
+        baselines = _get_category_baselines(toolbox, user_id, [category for category, _ in spending], months=3)
+        
+        alerts_append = alerts.append
+        recommendations_append = recommendations.append
+        high_count = 0
+        
+        for category, current in spending:
+            baseline = baselines.get(category, 0.0)
             
             if baseline > 0:
                 utilization = (current / baseline) * 100
+                potential_savings = current - baseline
                 
                 if utilization > 120:
                     # Critical - over 120% of baseline
-                    potential_savings = current - baseline
-                    alerts.append({
+                    high_count += 1
+                    alerts_append({
                         "category": category,
                         "severity": "high",
                         "message": f"Over budget by {utilization - 100:.0f}%"
                     })
-                    recommendations.append({
-                        "type": "budget_alert",
-                        "title": f"Over Budget in {category}",
-                        "description": f"You've spent ${current:.2f} in {category} this month, which is {utilization:.0f}% of your typical spending (${baseline:.2f}).",
-                        "potential_savings": potential_savings,
-                        "priority": 1,
-                        "urgency": "high",
-                        "category": category
-                    })
+                    recommendations_append(_mk_rec(
+                        type="budget_alert",
+                        title=f"Over Budget in {category}",
+                        description=f"You've spent ${current:.2f} in {category} this month, which is {utilization:.0f}% of your typical spending (${baseline:.2f}).",
+                        potential_savings=potential_savings,
+                        priority=1,
+                        urgency="high",
+                        category=category
+                    ))
                     
                 elif utilization > 100:
                     # Warning - between 100-120%
-                    potential_savings = current - baseline
-                    alerts.append({
+                    alerts_append({
                         "category": category,
                         "severity": "medium",
                         "message": f"Slightly over baseline ({utilization:.0f}%)"
                     })
-                    recommendations.append({
-                        "type": "budget_warning",
-                        "title": f"{category} Spending Above Average",
-                        "description": f"You're at {utilization:.0f}% of typical {category} spending.",
-                        "potential_savings": potential_savings,
-                        "priority": 2,
-                        "urgency": "medium",
-                        "category": category
-                    })
+                    recommendations_append(_mk_rec(
+                        type="budget_warning",
+                        title=f"{category} Spending Above Average",
+                        description=f"You're at {utilization:.0f}% of typical {category} spending.",
+                        potential_savings=potential_savings,
+                        priority=2,
+                        urgency="medium",
+                        category=category
+                    ))
         
         # Generate summary
         if not alerts:
             summary = "Great news! All your spending categories are within normal ranges."
-        elif len([a for a in alerts if a['severity'] == 'high']) > 0:
+        elif high_count > 0:
             summary = f"Budget Alert: You have {len(alerts)} categories requiring attention."
         else:
             summary = f"Minor Budget Notice: {len(alerts)} categories slightly above average."
@@ -130,7 +168,7 @@ def analyze_budget_health(user_id: str) -> Dict[str, Any]:
         }
         
     except Exception as e:
-        logger.error(f"Error analyzing budget: {e}")
+        logger.error("Error analyzing budget: %s", e)
         return {"status": "error", "message": str(e)}
 
 
@@ -151,14 +189,13 @@ def find_savings_opportunities(user_id: str) -> Dict[str, Any]:
         - total_potential_savings: Total monthly savings possible
         - summary: Text summary of findings
     """
-    logger.info(f"Finding savings opportunities for user {user_id}")
+    logger.info("Finding savings opportunities for user %s", user_id)
     
     toolbox = _get_toolbox()
     if not toolbox:
         return _mock_savings_opportunities(user_id)
     
     opportunities = []
-    discretionary_categories = ['Dining', 'Shopping', 'Entertainment', 'Travel', 'Recreation']
     
     try:
         result = toolbox.call_tool('get-current-month-spending', user_id=user_id)
@@ -167,32 +204,38 @@ def find_savings_opportunities(user_id: str) -> Dict[str, Any]:
             return {"status": "error", "message": "Failed to fetch spending data"}
         
         current_spending = result.get('data', [])
-        if isinstance(current_spending, str):
-            current_spending = json.loads(current_spending)
         
-        for category_data in current_spending:
-            category = category_data.get('category', 'Unknown')
-            current = float(category_data.get('total_amount', 0))
+        # Only discretionary categories are considered, so the rest are
+        # dropped before parsing or asking for baselines
+        spending = [
+            (category_data['category'], float(category_data.get('total_amount', 0)))
+            for category_data in current_spending
+            if category_data.get('category') in _DISCRETIONARY_CATEGORIES
+        ]
+        
+        baselines = _get_category_baselines(toolbox, user_id, [category for category, _ in spending], months=3)
+        
+        opportunities_append = opportunities.append
+        
+        for category, current in spending:
+            baseline = baselines.get(category, 0.0)
             
-            if category in discretionary_categories:
-                baseline = _get_category_baseline(toolbox, user_id, category)
+            if baseline > 0 and current > baseline * 1.2:
+                # Suggest reducing to baseline + 10%
+                target = baseline * 1.1
+                potential_savings = current - target
                 
-                if baseline > 0 and current > baseline * 1.2:
-                    # Suggest reducing to baseline + 10%
-                    target = baseline * 1.1
-                    potential_savings = current - target
-                    
-                    opportunities.append({
-                        "type": "reduce_spending",
-                        "title": f"Save on {category}",
-                        "description": f"You're spending ${current:.2f}/month on {category}, above your baseline of ${baseline:.2f}. Consider reducing to ${target:.2f}.",
-                        "current_spending": current,
-                        "target_spending": target,
-                        "potential_savings": potential_savings,
-                        "annual_savings": potential_savings * 12,
-                        "priority": 3,
-                        "category": category
-                    })
+                opportunities_append({
+                    "type": "reduce_spending",
+                    "title": f"Save on {category}",
+                    "description": f"You're spending ${current:.2f}/month on {category}, above your baseline of ${baseline:.2f}. Consider reducing to ${target:.2f}.",
+                    "current_spending": current,
+                    "target_spending": target,
+                    "potential_savings": potential_savings,
+                    "annual_savings": potential_savings * 12,
+                    "priority": 3,
+                    "category": category
+                })
         
         total_savings = sum(o['potential_savings'] for o in opportunities)
         
@@ -205,7 +248,7 @@ def find_savings_opportunities(user_id: str) -> Dict[str, Any]:
         }
         
     except Exception as e:
-        logger.error(f"Error finding savings: {e}")
+        logger.error("Error finding savings: %s", e)
         return {"status": "error", "message": str(e)}
 
 
@@ -227,7 +270,7 @@ def optimize_subscriptions(user_id: str) -> Dict[str, Any]:
         - total_monthly_cost: Total subscription spending per month
         - summary: Text summary of subscription health
     """
-    logger.info(f"Optimizing subscriptions for user {user_id}")
+    logger.info("Optimizing subscriptions for user %s", user_id)
     
     toolbox = _get_toolbox()
     if not toolbox:
@@ -242,8 +285,6 @@ def optimize_subscriptions(user_id: str) -> Dict[str, Any]:
             return {"status": "error", "message": "Failed to fetch subscriptions"}
         
         subscriptions = result.get('data', [])
-        if isinstance(subscriptions, str):
-            subscriptions = json.loads(subscriptions)
         
         if not subscriptions:
             return {
@@ -254,49 +295,54 @@ def optimize_subscriptions(user_id: str) -> Dict[str, Any]:
                 "summary": "No subscriptions detected yet. Keep using the app to track your recurring charges."
             }
         
-        total_monthly = sum(float(s.get('amount', 0)) for s in subscriptions)
-        
-        # High total subscription spending
-        if total_monthly > 100:
-            recommendations.append({
-                "type": "reduce_subscriptions",
-                "title": "High Subscription Spending",
-                "description": f"You're spending ${total_monthly:.2f}/month on {len(subscriptions)} subscriptions. Consider reviewing which ones you actively use.",
-                "potential_savings": total_monthly * 0.3,  # Assume 30% can be cut
-                "annual_savings": total_monthly * 12 * 0.3,
-                "priority": 2,
-                "urgency": "medium"
-            })
-        
-        # Flag expensive individual subscriptions
+        # One pass totals the subscriptions and flags the expensive ones
+        total_monthly = 0.0
+        expensive = []
         for sub in subscriptions:
             amount = float(sub.get('amount', 0))
-            merchant = sub.get('merchant_standardized', sub.get('merchant', 'Unknown'))
+            total_monthly += amount
             
             if amount > 50:
-                recommendations.append({
-                    "type": "expensive_subscription",
-                    "title": f"Review {merchant} Subscription",
-                    "description": f"{merchant} costs ${amount:.2f}/month (${amount * 12:.2f}/year). Make sure you're getting value from this service.",
-                    "potential_savings": amount,
-                    "annual_savings": amount * 12,
-                    "priority": 3,
-                    "urgency": "low",
-                    "merchant": merchant
-                })
+                merchant = sub.get('merchant_standardized', sub.get('merchant', 'Unknown'))
+                annual = amount * 12
+                expensive.append(_mk_rec(
+                    type="expensive_subscription",
+                    title=f"Review {merchant} Subscription",
+                    description=f"{merchant} costs ${amount:.2f}/month (${annual:.2f}/year). Make sure you're getting value from this service.",
+                    potential_savings=amount,
+                    annual_savings=annual,
+                    priority=3,
+                    urgency="low",
+                    merchant=merchant
+                ))
+        
+        annual_cost = total_monthly * 12
+        
+        # High total subscription spending comes first, then the individual ones
+        if total_monthly > 100:
+            recommendations.append(_mk_rec(
+                type="reduce_subscriptions",
+                title="High Subscription Spending",
+                description=f"You're spending ${total_monthly:.2f}/month on {len(subscriptions)} subscriptions. Consider reviewing which ones you actively use.",
+                potential_savings=total_monthly * 0.3,  # Assume 30% can be cut
+                annual_savings=annual_cost * 0.3,
+                priority=2,
+                urgency="medium"
+            ))
+        recommendations.extend(expensive)
         
         return {
             "status": "success",
             "subscriptions": subscriptions,
             "recommendations": recommendations,
             "total_monthly_cost": total_monthly,
-            "annual_cost": total_monthly * 12,
+            "annual_cost": annual_cost,
             "subscription_count": len(subscriptions),
-            "summary": f"You have {len(subscriptions)} subscriptions costing ${total_monthly:.2f}/month (${total_monthly * 12:.2f}/year)"
+            "summary": f"You have {len(subscriptions)} subscriptions costing ${total_monthly:.2f}/month (${annual_cost:.2f}/year)"
         }
         
     except Exception as e:
-        logger.error(f"Error optimizing subscriptions: {e}")
+        logger.error("Error optimizing subscriptions: %s", e)
         return {"status": "error", "message": str(e)}
 
 
@@ -318,7 +364,7 @@ def predict_spending_trends(user_id: str) -> Dict[str, Any]:
         - alerts: Categories with concerning upward trends
         - summary: Text summary of spending trajectory
     """
-    logger.info(f"Predicting spending trends for user {user_id}")
+    logger.info("Predicting spending trends for user %s", user_id)
     
     toolbox = _get_toolbox()
     if not toolbox:
@@ -336,69 +382,59 @@ def predict_spending_trends(user_id: str) -> Dict[str, Any]:
             return {"status": "error", "message": "Failed to fetch categories"}
         
         categories = result.get('data', [])
-        if isinstance(categories, str):
-            categories = json.loads(categories)
         
+        histories = _get_categories_history_bulk(
+            toolbox, user_id, [c.get('category', 'Unknown') for c in categories], months=3
+        )
+        
+        # (category, monthly amounts, most recent first) for categories with enough history
+        series = []
         for cat_data in categories:
             category = cat_data.get('category', 'Unknown')
-            
-            # Get 3-month history
-            history = _get_category_history(toolbox, user_id, category, months=3)
-            
+            history = histories.get(category, [])
             if len(history) >= 2:
-                amounts = [float(h.get('total_amount', 0)) for h in history]
-                avg_amount = sum(amounts) / len(amounts)
-                recent_amount = amounts[0] if amounts else 0
-                
-                # Calculate trend
-                if avg_amount > 0:
-                    trend_pct = ((recent_amount - avg_amount) / avg_amount) * 100
-                else:
-                    trend_pct = 0
-                
-                # Predict next month (simple linear projection)
-                if len(amounts) >= 2:
-                    monthly_change = amounts[0] - amounts[1]
-                    predicted_next = max(0, amounts[0] + monthly_change)
-                else:
-                    predicted_next = recent_amount
+                series.append((category, [float(h.get('total_amount', 0)) for h in history]))
+        
+        up_trends = 0
+        down_trends = 0
+        
+        for (category, _), (recent_amount, avg_amount, trend_pct, predicted_next) in zip(series, _trend_stats(series)):
+            predictions[category] = predicted_next
+            
+            if trend_pct > 20:
+                # Spending trending up significantly
+                up_trends += 1
+                trends.append({
+                    "category": category,
+                    "direction": "up",
+                    "change_percent": trend_pct,
+                    "current": recent_amount,
+                    "average": avg_amount,
+                    "predicted_next": predicted_next
+                })
                 
-                predictions[category] = predicted_next
+                alerts.append(_mk_rec(
+                    type="trend_alert",
+                    title=f"{category} Spending Trending Up",
+                    description=f"Your {category} spending increased {trend_pct:.0f}% above average. Last month: ${recent_amount:.2f}, predicted next: ${predicted_next:.2f}.",
+                    potential_savings=predicted_next - avg_amount,
+                    priority=2,
+                    category=category
+                ))
                 
-                if trend_pct > 20:
-                    # Spending trending up significantly
-                    trends.append({
-                        "category": category,
-                        "direction": "up",
-                        "change_percent": trend_pct,
-                        "current": recent_amount,
-                        "average": avg_amount,
-                        "predicted_next": predicted_next
-                    })
-                    
-                    alerts.append({
-                        "type": "trend_alert",
-                        "title": f"{category} Spending Trending Up",
-                        "description": f"Your {category} spending increased {trend_pct:.0f}% above average. Last month: ${recent_amount:.2f}, predicted next: ${predicted_next:.2f}.",
-                        "potential_savings": predicted_next - avg_amount,
-                        "priority": 2,
-                        "category": category
-                    })
-                    
-                elif trend_pct < -20:
-                    # Spending trending down (good!)
-                    trends.append({
-                        "category": category,
-                        "direction": "down",
-                        "change_percent": trend_pct,
-                        "current": recent_amount,
-                        "average": avg_amount,
-                        "predicted_next": predicted_next
-                    })
+            elif trend_pct < -20:
+                # Spending trending down (good!)
+                down_trends += 1
+                trends.append({
+                    "category": category,
+                    "direction": "down",
+                    "change_percent": trend_pct,
+                    "current": recent_amount,
+                    "average": avg_amount,
+                    "predicted_next": predicted_next
+                })
         
         total_predicted = sum(predictions.values())
-        up_trends = len([t for t in trends if t['direction'] == 'up'])
-        down_trends = len([t for t in trends if t['direction'] == 'down'])
         
         if up_trends > down_trends:
             summary = f"Heads up: {up_trends} categories show increasing spending. Predicted total next month: ${total_predicted:.2f}"
@@ -417,7 +453,7 @@ def predict_spending_trends(user_id: str) -> Dict[str, Any]:
         }
         
     except Exception as e:
-        logger.error(f"Error predicting trends: {e}")
+        logger.error("Error predicting trends: %s", e)
         return {"status": "error", "message": str(e)}
 
 
@@ -443,9 +479,9 @@ def generate_daily_summary(user_id: str, summary_date: Optional[str] = None) ->
         - summary_text: Human-readable summary
     """
     if not summary_date:
-        summary_date = datetime.now().date().isoformat()
+        summary_date = _today_iso()
     
-    logger.info(f"Generating daily summary for user {user_id} on {summary_date}")
+    logger.info("Generating daily summary for user %s on %s", user_id, summary_date)
     
     toolbox = _get_toolbox()
     if not toolbox:
@@ -468,7 +504,7 @@ def generate_daily_summary(user_id: str, summary_date: Optional[str] = None) ->
         }
         
     except Exception as e:
-        logger.error(f"Error generating daily summary: {e}")
+        logger.error("Error generating daily summary: %s", e)
         return {"status": "error", "message": str(e)}
 
 
@@ -493,33 +529,59 @@ def save_recommendation(user_id: str, recommendation: Dict[str, Any]) -> Dict[st
     Returns:
         Dictionary with status of save operation
     """
-    logger.info(f"Saving recommendation for user {user_id}")
+    return save_recommendations_bulk(user_id, [recommendation])
+
+
+def save_recommendations_bulk(user_id: str, recommendations: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Save several financial recommendations to the database in one insert.
+    
+    Prefer this over calling save_recommendation once per recommendation when
+    storing the results of an analysis.
+    
+    Args:
+        user_id: The unique identifier of the user
+        recommendations: List of recommendation dictionaries, each with the
+            same fields as save_recommendation's recommendation
+        
+    Returns:
+        Dictionary with status of save operation and the number saved
+    """
+    logger.info("Saving %d recommendations for user %s", len(recommendations), user_id)
     
     toolbox = _get_toolbox()
     if not toolbox:
-        logger.warning("Toolbox not available, recommendation not saved to DB")
-        return {"status": "success", "message": "Recommendation recorded (DB unavailable)"}
+        logger.warning("Toolbox not available, recommendations not saved to DB")
+        return {"status": "success", "message": "Recommendations recorded (DB unavailable)"}
+    
+    if not recommendations:
+        return {"status": "success", "saved": 0}
     
     try:
-        result = toolbox.call_tool(
-            'insert-recommendation',
-            user_id=user_id,
-            tool_name=recommendation.get('tool_name', 'financial_analyst'),
-            recommendation_type=recommendation.get('type', recommendation.get('recommendation_type', 'general')),
-            title=recommendation.get('title', ''),
-            description=recommendation.get('description', ''),
-            potential_savings=str(recommendation.get('potential_savings', 0)),
-            annual_savings=str(recommendation.get('annual_savings', recommendation.get('potential_savings', 0) * 12)),
-            priority=recommendation.get('priority', 3),
-            urgency=recommendation.get('urgency', 'medium'),
-            related_category=recommendation.get('category', recommendation.get('related_category', '')),
-            related_merchant=recommendation.get('merchant', recommendation.get('related_merchant', ''))
-        )
+        # annual_savings is derived from potential_savings by the insert itself
+        rows = [
+            {
+                "tool_name": rec.get('tool_name', 'financial_analyst'),
+                "recommendation_type": rec.get('type', rec.get('recommendation_type', 'general')),
+                "title": rec.get('title', ''),
+                "description": rec.get('description', ''),
+                "potential_savings": float(rec.get('potential_savings', 0)),
+                "priority": rec.get('priority', 3),
+                "urgency": rec.get('urgency', 'medium'),
+                "related_category": rec.get('category', rec.get('related_category', '')),
+                "related_merchant": rec.get('merchant', rec.get('related_merchant', ''))
+            }
+            for rec in recommendations
+        ]
         
-        return {"status": "success" if result.get('success') else "error", "result": result}
+        result = toolbox.call_tool('insert-recommendations-bulk', user_id=user_id, recommendations=_json_dumps(rows))
+        
+        if not result.get('success'):
+            return {"status": "error", "result": result}
+        return {"status": "success", "saved": len(rows), "result": result}
         
     except Exception as e:
-        logger.error(f"Error saving recommendation: {e}")
+        logger.error("Error saving recommendations: %s", e)
         return {"status": "error", "message": str(e)}
 
 
@@ -527,136 +589,300 @@ def save_recommendation(user_id: str, recommendation: Dict[str, Any]) -> Dict[st
 # HELPER FUNCTIONS (not exposed as tools)
 # ============================================================================
 
-def _get_category_baseline(toolbox, user_id: str, category: str) -> float:
-    """Get 3-month average spending for a category"""
-    try:
-        history = _get_category_history(toolbox, user_id, category, months=3)
-        if history:
-            amounts = [float(h.get('total_amount', 0)) for h in history]
-            return sum(amounts) / len(amounts)
-        return 0.0
-    except:
-        return 0.0
+def invalidate_history_cache(user_id: str) -> None:
+    """Drop a user's cached category histories (e.g. after new transactions are ingested)"""
+    for key in _history_cache.keys():
+        if key[0] == user_id:
+            _history_cache.pop(key)
+
+
+def _get_cached(key: tuple) -> Optional[Any]:
+    """Return a fresh cached history or baselines map, or None on a miss"""
+    return _history_cache.get(key)
+
+
+def _store_cached(key: tuple, value: Any) -> None:
+    """Store a history or baselines map"""
+    _history_cache.set(key, value)
 
 
 def _get_category_history(toolbox, user_id: str, category: str, months: int = 3) -> List[Dict]:
     """Get spending history for a category"""
+    key = (user_id, category, months)
+    cached = _get_cached(key)
+    if cached is not None:
+        return cached
+    
     try:
         result = toolbox.call_tool('get-category-history', user_id=user_id, category=category, months=months)
         
         if result.get('success'):
             data = result.get('data', [])
-            if isinstance(data, str):
-                data = json.loads(data)
-            return data if isinstance(data, list) else []
+            history = data if isinstance(data, list) else []
+            _store_cached(key, history)
+            return history
         return []
-    except:
+    except (ValueError, KeyError, TypeError, ConnectionError) as e:
+        # Anything else propagates to the calling tool's error response
+        logger.debug("History fetch for %s failed: %s", category, e)
+        return []
+
+
+def _get_categories_history_bulk(toolbox, user_id: str, categories: List[str], months: int = 3) -> Dict[str, List[Dict]]:
+    """Get spending history for several categories, most recent month first (cached ones aren't refetched)"""
+    histories = {}
+    missing = []
+    for category in dict.fromkeys(categories):
+        cached = _get_cached((user_id, category, months))
+        if cached is None:
+            missing.append(category)
+        else:
+            histories[category] = cached
+    
+    if missing:
+        histories.update(_fetch_categories_history(toolbox, user_id, missing, months))
+    return histories
+
+
+def _fetch_categories_history(toolbox, user_id: str, categories: List[str], months: int) -> Dict[str, List[Dict]]:
+    """Fetch the histories of several categories in one call"""
+    result = toolbox.call_tool(
+        'get-multi-category-history', user_id=user_id, categories=_json_dumps(categories), months=months
+    )
+    
+    if not result.get('success'):
+        # Toolbox deployments without the batched tool get one call per category,
+        # issued concurrently since each is a blocking round-trip
+        with ThreadPoolExecutor(max_workers=min(HISTORY_FETCH_WORKERS, len(categories))) as executor:
+            histories = executor.map(lambda c: _get_category_history(toolbox, user_id, c, months), categories)
+            return dict(zip(categories, histories))
+    
+    data = result.get('data', [])
+    
+    histories = {category: [] for category in categories}
+    for row in data if isinstance(data, list) else []:
+        if row.get('category') in histories:
+            histories[row['category']].append(row)
+    
+    for category, history in histories.items():
+        _store_cached((user_id, category, months), history)
+    return histories
+
+
+def _get_category_baselines(toolbox, user_id: str, categories: List[str], months: int = 3) -> Dict[str, float]:
+    """Average monthly spending over the latest months for each category, computed in SQL"""
+    key = (user_id, months)
+    baselines = _get_cached(key)
+    if baselines is None:
+        result = toolbox.call_tool('get-category-baselines', user_id=user_id, months=months)
+        
+        if not result.get('success'):
+            # Without the aggregate tool, average the fetched histories instead
+            histories = _get_categories_history_bulk(toolbox, user_id, categories, months)
+            return {category: _average_total_amount(history) for category, history in histories.items()}
+        
+        data = result.get('data', [])
+        
+        baselines = {
+            row['category']: float(row.get('baseline') or 0)
+            for row in (data if isinstance(data, list) else [])
+        }
+        _store_cached(key, baselines)
+    
+    return {category: baselines.get(category, 0.0) for category in categories}
+
+
+def _today_iso() -> str:
+    """Today's date as YYYY-MM-DD, recomputed at most once a minute"""
+    return _today_iso_for_minute(int(time.time() // 60))
+
+
+@lru_cache(maxsize=1)
+def _today_iso_for_minute(minute: int) -> str:
+    # Local midnight falls on a minute boundary, so the date can't change within a minute
+    return datetime.now().date().isoformat()
+
+
+# Fields every recommendation carries; _mk_rec fills in the rest
+_BASE_REC = {
+    "type": "",
+    "title": "",
+    "description": "",
+    "potential_savings": 0.0,
+    "priority": 3,
+    "urgency": "medium",
+    "category": ""
+}
+
+
+def _mk_rec(**fields) -> Dict[str, Any]:
+    """Build a recommendation dict from the shared defaults and the given fields"""
+    rec = _BASE_REC.copy()
+    rec.update(fields)
+    return rec
+
+
+def _trend_stats(series: List[tuple]) -> List[tuple]:
+    """
+    (recent, average, trend_pct, predicted_next) for each (category, amounts)
+    series, where amounts has at least two months, most recent first
+    """
+    if not series:
         return []
+    
+    if not NUMPY_AVAILABLE:
+        stats = []
+        for _, amounts in series:
+            avg_amount = sum(amounts) / len(amounts)
+            recent_amount = amounts[0]
+            trend_pct = ((recent_amount - avg_amount) / avg_amount) * 100 if avg_amount > 0 else 0
+            # Simple linear projection of the last month-over-month change
+            predicted_next = max(0, amounts[0] + (amounts[0] - amounts[1]))
+            stats.append((recent_amount, avg_amount, trend_pct, predicted_next))
+        return stats
+    
+    # One (categories x months) array, NaN-padded where a history is shorter,
+    # built column-wise in one call rather than row by row
+    arr = np.array(
+        list(zip_longest(*(amounts for _, amounts in series), fillvalue=np.nan)), dtype=np.float64
+    ).T
+    
+    avg = np.nanmean(arr, axis=1)
+    recent = arr[:, 0]
+    # Guarded divide and clamp without per-element branches
+    trend_pct = np.zeros_like(avg)
+    np.divide(recent - avg, avg, out=trend_pct, where=avg > 0)
+    trend_pct *= 100
+    predicted = np.clip(recent + (recent - arr[:, 1]), 0.0, None)
+    
+    return list(zip(recent.tolist(), avg.tolist(), trend_pct.tolist(), predicted.tolist()))
+
+
+def _average_total_amount(history: List[Dict]) -> float:
+    """Average monthly total_amount of a history (0.0 when empty)"""
+    if not history:
+        return 0.0
+    return sum(float(h.get('total_amount', 0)) for h in history) / len(history)
 
 
 # ============================================================================
 # MOCK FUNCTIONS (used when MCP Toolbox is not available)
 # ============================================================================
 
+# Sample payloads are built once at import; the mock functions hand out deep
+# copies so a caller editing its result can't change later ones
+_MOCK_BUDGET_ANALYSIS = {
+    "status": "success",
+    "alerts": [
+        {"category": "Dining", "severity": "medium", "message": "Slightly above baseline (110%)"}
+    ],
+    "recommendations": [
+        {
+            "type": "budget_warning",
+            "title": "Dining Spending Above Average",
+            "description": "You're at 110% of typical Dining spending. Consider cooking at home more often.",
+            "potential_savings": 50.00,
+            "priority": 2,
+            "urgency": "medium",
+            "category": "Dining"
+        }
+    ],
+    "summary": "Minor Budget Notice: 1 category slightly above average.",
+    "total_recommendations": 1,
+    "note": "Using sample data - MCP Toolbox not connected"
+}
+
+_MOCK_SAVINGS_OPPORTUNITIES = {
+    "status": "success",
+    "opportunities": [
+        {
+            "type": "reduce_spending",
+            "title": "Save on Entertainment",
+            "description": "Your entertainment spending is above average. Consider free activities.",
+            "current_spending": 200.00,
+            "target_spending": 150.00,
+            "potential_savings": 50.00,
+            "annual_savings": 600.00,
+            "priority": 3,
+            "category": "Entertainment"
+        }
+    ],
+    "total_potential_savings": 50.00,
+    "annual_potential_savings": 600.00,
+    "summary": "Found 1 savings opportunity totaling $50.00/month ($600.00/year)",
+    "note": "Using sample data - MCP Toolbox not connected"
+}
+
+_MOCK_SUBSCRIPTION_OPTIMIZATION = {
+    "status": "success",
+    "subscriptions": [
+        {"merchant": "Netflix", "amount": 15.99},
+        {"merchant": "Spotify", "amount": 9.99},
+        {"merchant": "Amazon Prime", "amount": 14.99}
+    ],
+    "recommendations": [],
+    "total_monthly_cost": 40.97,
+    "annual_cost": 491.64,
+    "subscription_count": 3,
+    "summary": "You have 3 subscriptions costing $40.97/month ($491.64/year)",
+    "note": "Using sample data - MCP Toolbox not connected"
+}
+
+_MOCK_TREND_PREDICTIONS = {
+    "status": "success",
+    "trends": [],
+    "predictions": {
+        "Groceries": 450.00,
+        "Dining": 180.00,
+        "Transportation": 120.00
+    },
+    "alerts": [],
+    "total_predicted_next_month": 750.00,
+    "summary": "Your spending is relatively stable across categories.",
+    "note": "Using sample data - MCP Toolbox not connected"
+}
+
+_MOCK_DAILY_SUMMARY = {
+    "status": "success",
+    "total_spent": 85.50,
+    "transaction_count": 5,
+    "spending_by_category": {
+        "Dining": 35.00,
+        "Transportation": 25.50,
+        "Shopping": 25.00
+    },
+    "top_category": "Dining",
+    "budget_alerts": [],
+    "subscriptions_charged": [],
+    "note": "Using sample data - MCP Toolbox not connected"
+}
+
+
 def _mock_budget_analysis(user_id: str) -> Dict[str, Any]:
     """Return mock budget analysis when toolbox unavailable"""
-    return {
-        "status": "success",
-        "alerts": [
-            {"category": "Dining", "severity": "medium", "message": "Slightly above baseline (110%)"}
-        ],
-        "recommendations": [
-            {
-                "type": "budget_warning",
-                "title": "Dining Spending Above Average",
-                "description": "You're at 110% of typical Dining spending. Consider cooking at home more often.",
-                "potential_savings": 50.00,
-                "priority": 2,
-                "urgency": "medium",
-                "category": "Dining"
-            }
-        ],
-        "summary": "Minor Budget Notice: 1 category slightly above average.",
-        "total_recommendations": 1,
-        "note": "Using sample data - MCP Toolbox not connected"
-    }
+    return copy.deepcopy(_MOCK_BUDGET_ANALYSIS)
 
 
 def _mock_savings_opportunities(user_id: str) -> Dict[str, Any]:
     """Return mock savings when toolbox unavailable"""
-    return {
-        "status": "success",
-        "opportunities": [
-            {
-                "type": "reduce_spending",
-                "title": "Save on Entertainment",
-                "description": "Your entertainment spending is above average. Consider free activities.",
-                "current_spending": 200.00,
-                "target_spending": 150.00,
-                "potential_savings": 50.00,
-                "annual_savings": 600.00,
-                "priority": 3,
-                "category": "Entertainment"
-            }
-        ],
-        "total_potential_savings": 50.00,
-        "annual_potential_savings": 600.00,
-        "summary": "Found 1 savings opportunity totaling $50.00/month ($600.00/year)",
-        "note": "Using sample data - MCP Toolbox not connected"
-    }
+    return copy.deepcopy(_MOCK_SAVINGS_OPPORTUNITIES)
 
 
 def _mock_subscription_optimization(user_id: str) -> Dict[str, Any]:
     """Return mock subscription data when toolbox unavailable"""
-    return {
-        "status": "success",
-        "subscriptions": [
-            {"merchant": "Netflix", "amount": 15.99},
-            {"merchant": "Spotify", "amount": 9.99},
-            {"merchant": "Amazon Prime", "amount": 14.99}
-        ],
-        "recommendations": [],
-        "total_monthly_cost": 40.97,
-        "annual_cost": 491.64,
-        "subscription_count": 3,
-        "summary": "You have 3 subscriptions costing $40.97/month ($491.64/year)",
-        "note": "Using sample data - MCP Toolbox not connected"
-    }
+    return copy.deepcopy(_MOCK_SUBSCRIPTION_OPTIMIZATION)
 
 
 def _mock_trend_predictions(user_id: str) -> Dict[str, Any]:
     """Return mock trend data when toolbox unavailable"""
-    return {
-        "status": "success",
-        "trends": [],
-        "predictions": {
-            "Groceries": 450.00,
-            "Dining": 180.00,
-            "Transportation": 120.00
-        },
-        "alerts": [],
-        "total_predicted_next_month": 750.00,
-        "summary": "Your spending is relatively stable across categories.",
-        "note": "Using sample data - MCP Toolbox not connected"
-    }
+    return copy.deepcopy(_MOCK_TREND_PREDICTIONS)
 
 
 def _mock_daily_summary(user_id: str, date: str) -> Dict[str, Any]:
     """Return mock daily summary when toolbox unavailable"""
     return {
-        "status": "success",
+        **copy.deepcopy(_MOCK_DAILY_SUMMARY),
         "summary_date": date,
-        "total_spent": 85.50,
-        "transaction_count": 5,
-        "spending_by_category": {
-            "Dining": 35.00,
-            "Transportation": 25.50,
-            "Shopping": 25.00
-        },
-        "top_category": "Dining",
-        "budget_alerts": [],
-        "subscriptions_charged": [],
-        "summary_text": f"Daily Summary for {date}\n\nSpending Today: $85.50\nTransactions: 5\nTop Category: Dining\n\nNo budget alerts - you're on track!",
-        "note": "Using sample data - MCP Toolbox not connected"
+        "summary_text": f"Daily Summary for {date}\n\nSpending Today: $85.50\nTransactions: 5\nTop Category: Dining\n\nNo budget alerts - you're on track!"
     }
 
@@ -3,25 +3,109 @@ Tool 4: Advanced Fraud Detection
 Personalized multi-factor risk analysis considering user profile and behavior patterns
 """
 
+import asyncio
+import atexit
 import logging
-from typing import Dict, Any, Optional
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Set, Tuple
 from datetime import datetime, timedelta
-from agent_tools.toolbox_wrapper import get_toolbox
+from agent_tools.toolbox_wrapper import ToolboxCache, TTLCache, _json_dumps, _json_loads, get_toolbox
 import json
 from dotenv import load_dotenv
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# NumPy (a pandas dependency) computes history statistics for a whole batch at once
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# Instructions and few-shot examples shared by every fraud review. They are
+# the model's system instruction, so each request only carries the transaction.
+FRAUD_SYSTEM_PROMPT = """You are a fraud detection expert analyzing potentially suspicious transactions.
+
+**Your Task:**
+Assess the fraud risk of each transaction you are given based on:
+1. Merchant reputation and legitimacy
+2. Transaction context and reasonableness
+3. Amount appropriateness for merchant type
+4. Time/day pattern analysis
+
+**Consider:**
+- Is this merchant known and legitimate?
+- Is the amount reasonable for this merchant?
+- Does timing raise red flags?
+- Are there fraud patterns (e.g., testing, unusual merchant types)?
+
+**Response Format (JSON ONLY, reasoning under 20 words):**
+{
+  "fraud_risk_adjustment": -10 to +20,
+  "reasoning": "Brief explanation",
+  "merchant_reputation": "legitimate|suspicious|unknown",
+  "concerns": ["concern1", "concern2"],
+  "confidence": 0.8
+}
+
+**Examples:**
+
+Merchant: "Apple.com", $999, 10% of income, Tuesday 2PM
+{
+  "fraud_risk_adjustment": -10,
+  "reasoning": "Legitimate merchant, reasonable electronics amount, normal time",
+  "merchant_reputation": "legitimate",
+  "concerns": [],
+  "confidence": 0.95
+}
+
+Merchant: "Unknown Electronics LLC", $1500, 30% of income, Tuesday 3AM
+{
+  "fraud_risk_adjustment": +15,
+  "reasoning": "Unknown merchant, very high amount, suspicious late-night timing",
+  "merchant_reputation": "suspicious",
+  "concerns": ["unknown merchant", "late night", "high amount"],
+  "confidence": 0.85
+}
+
+Merchant: "Gift Card Depot", $500, 10% of income, Friday 11PM
+{
+  "fraud_risk_adjustment": +20,
+  "reasoning": "Gift cards are a common fraud indicator, suspicious late-night timing",
+  "merchant_reputation": "suspicious",
+  "concerns": ["gift cards common in fraud", "late night", "unusual merchant"],
+  "confidence": 0.90
+}"""
+
+# JSON shape Gemini is constrained to (structured output)
+FRAUD_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "fraud_risk_adjustment": {"type": "INTEGER"},
+        "reasoning": {"type": "STRING"},
+        "merchant_reputation": {"type": "STRING", "enum": ["legitimate", "suspicious", "unknown"]},
+        "concerns": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "confidence": {"type": "NUMBER"},
+    },
+    "required": ["fraud_risk_adjustment", "merchant_reputation", "concerns"],
+}
+
 # Import Gemini for contextual fraud analysis
 try:
     import google.generativeai as genai
-    import os
     
     GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
     if GEMINI_API_KEY:
         genai.configure(api_key=GEMINI_API_KEY)
-        llm_model = genai.GenerativeModel('gemini-flash-lite-latest')
+        llm_model = genai.GenerativeModel(
+            'gemini-flash-lite-latest',
+            system_instruction=FRAUD_SYSTEM_PROMPT
+        )
         LLM_AVAILABLE = True
         logger.info("✅ Gemini LLM initialized for fraud detection")
     else:
@@ -32,6 +116,52 @@ except ImportError:
     logger.warning("⚠️ google-generativeai not installed, using rule-based fraud detection only")
 
 
+# Concurrent per-user lookups in detect_fraud_batch
+FRAUD_LOOKUP_WORKERS = int(os.getenv("FRAUD_LOOKUP_WORKERS", "8"))
+
+# Maximum Gemini requests in flight while detect_fraud_batch reviews risky rows
+MAX_LLM_CONCURRENCY = int(os.getenv("FRAUD_MAX_LLM_CONCURRENCY", "8"))
+
+# Bounds of the LLM's score adjustment (the prompt asks for -10 to +20; answers
+# are clamped to it). Scores from 75 - (-10) = 85 up are "high" whatever the
+# LLM says, so they skip the review.
+LLM_MIN_ADJUSTMENT = -10
+LLM_MAX_ADJUSTMENT = 20
+
+# LLM reviews keyed by merchant signature (merchant, category, share of income
+# in 10% steps, 6-hour block of the day). Traffic concentrates on a few
+# merchants, so most risky transactions repeat an earlier review.
+# Only successful answers are cached.
+LLM_CACHE_TTL = float(os.getenv("FRAUD_LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAXSIZE = 8192
+_llm_cache = TTLCache(LLM_CACHE_MAXSIZE, LLM_CACHE_TTL)
+
+# User profiles change rarely, so fraud checks reuse a fetched profile for
+# this many seconds; users with no profile row are re-checked sooner
+PROFILE_CACHE_TTL = float(os.getenv("FRAUD_PROFILE_CACHE_TTL", "300"))
+PROFILE_CACHE_MISS_TTL = 30.0
+PROFILE_CACHE_MAXSIZE = 10_000
+
+# user_id -> profile, or None for a user with no profile row
+_profile_cache = TTLCache(PROFILE_CACHE_MAXSIZE, PROFILE_CACHE_TTL)
+
+# Velocity rule: the transaction dates last fetched for each user's window are
+# kept, so later checks inside that window are answered in memory. Transactions
+# scored since are added as they come; entries expire after this many seconds.
+VELOCITY_CACHE_TTL = float(os.getenv("FRAUD_VELOCITY_CACHE_TTL", "300"))
+VELOCITY_CACHE_MAXSIZE = 10_000
+
+# user_id -> (start_date, end_date, transaction_ids, dates); the lock guards
+# adding scored transactions to a cached window
+_velocity_cache = TTLCache(VELOCITY_CACHE_MAXSIZE, VELOCITY_CACHE_TTL)
+_velocity_window_lock = threading.Lock()
+
+# detect_fraud queues its processed_transactions rows and stores them with one
+# multi-row insert once this many are waiting, or this many seconds after the
+# first one was queued (store_processed_data also flushes before finalizing)
+FRAUD_WRITE_BATCH_SIZE = int(os.getenv("FRAUD_WRITE_BATCH_SIZE", "500"))
+FRAUD_WRITE_FLUSH_INTERVAL = float(os.getenv("FRAUD_WRITE_FLUSH_INTERVAL", "1.0"))
+
 # High-risk merchant patterns
 HIGH_RISK_CATEGORIES = [
     'electronics',
@@ -52,6 +182,31 @@ LEGITIMATE_HIGH_VALUE_MERCHANTS = [
     'hospital', 'medical', 'clinic', 'doctor'
 ]
 
+# Categories where a larger purchase is normal for students / families
+_STUDENT_NORMAL_CATEGORIES = frozenset({'Education', 'Travel', 'Shopping'})
+_FAMILY_NORMAL_CATEGORIES = frozenset({'Groceries', 'Shopping', 'Healthcare'})
+
+# Batches at least this large score the profile thresholds with NumPy arrays;
+# below it the per-row function is faster than building them
+BULK_SCORING_MIN_ROWS = 32
+
+# Each list compiled into one alternation, so a rule check is a single scan
+# of the merchant name instead of one substring search per pattern (two
+# searches beat one combined pattern with a group per list)
+_HIGH_RISK_RE = re.compile('|'.join(map(re.escape, HIGH_RISK_CATEGORIES)))
+_LEGITIMATE_MERCHANT_RE = re.compile('|'.join(map(re.escape, LEGITIMATE_HIGH_VALUE_MERCHANTS)))
+
+# detect_fraud approves a purchase without the remaining checks when the user's
+# profile is already cached, the amount is under this share of monthly income,
+# the merchant is a known legitimate one and the category isn't one fraud
+# concentrates in (electronics land in Shopping, wires in Transfer)
+TRIVIAL_AMOUNT_SHARE = 0.005
+_TRIVIAL_EXCLUDED_CATEGORIES = frozenset({'Shopping', 'Travel', 'Transfer'})
+
+# Round amounts typical of card testing, in integer cents so float
+# representation of the amount doesn't break the match
+_ROUND_CENTS = frozenset({100, 500, 1000, 2000, 5000, 10000, 50000, 100000})
+
 
 def detect_fraud(
     transaction_id: str,
@@ -97,151 +252,618 @@ def detect_fraud(
             "detection_method": "profile-aware", "behavioral", "rules", "llm", or "hybrid",
             "user_income_percentile": What % of monthly income this represents,
             "recommendation": Suggested action,
+            "persisted": False - the result is queued and stored by a later flush,
             "message": Status message
         }
     """
     
     try:
-        logger.info(f"🔍 Advanced fraud analysis for transaction {transaction_id}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("🔍 Advanced fraud analysis for transaction %s", transaction_id)
         
-        # Step 1: Get user profile
-        user_profile = _get_user_profile(user_id)
+        # Parsed once here; every helper below works on the datetime
+        transaction_dt = _parse_transaction_date(transaction_date)
         
-        if user_profile:
-            logger.info(f"   User Profile: Income=${user_profile.get('monthly_income', 0):.2f}, "
-                       f"Life Stage={user_profile.get('life_stage', 'unknown')}")
+        # Trivially small everyday purchase: approve without Steps 2-5
+        cached, cached_profile = _get_cached_profile(user_id)
+        if cached and _is_trivial_purchase(amount, merchant_name, category, cached_profile):
+            result, row = _classify_transaction(
+                transaction_id, user_id, amount, merchant_name, category,
+                UserContext.from_profile(cached_profile, amount),
+                {'risk_score': 0, 'risk_factors': [], 'detection_methods': ['trivial-amount']}
+            )
+            _result_writer.enqueue(get_toolbox(), row)
+            result['persisted'] = False
+            return result
         
-        # Initialize risk scoring
-        risk_score = 0
-        risk_factors = []
-        detection_methods_used = []
+        # Steps 1-4 lookups (profile, history, known merchants, velocity) in
+        # one get-fraud-context round-trip
+        context = None
+        if transaction_dt is not None:
+            context = _get_fraud_context(user_id, category, transaction_dt)
         
-        # Step 2: User Profile-Aware Analysis (Primary)
-        profile_risk = _analyze_with_user_profile(
-            user_profile, amount, category, transaction_date
-        )
-        risk_score += profile_risk['score']
-        if profile_risk['factors']:
-            risk_factors.extend(profile_risk['factors'])
-        detection_methods_used.append('profile-aware')
-        
-        # Step 3: Behavioral Pattern Analysis
-        behavioral_risk = _analyze_behavioral_patterns(
-            user_id, amount, category, merchant_name, transaction_date, user_profile
-        ) or {'score': 0, 'factors': []}
-        risk_score += behavioral_risk['score']
-        if behavioral_risk['factors']:
-            risk_factors.extend(behavioral_risk['factors'])
-        detection_methods_used.append('behavioral')
-        
-        # Step 4: Rule-Based Risk Factors
-        rules_risk = _analyze_with_rules(
-            user_id, amount, merchant_name, transaction_date, category, user_profile
-        )
-        risk_score += rules_risk['score']
-        if rules_risk['factors']:
-            risk_factors.extend(rules_risk['factors'])
-        detection_methods_used.append('rules')
-        
-        # Step 5: LLM Contextual Analysis (if available and high risk suspected)
-        llm_risk = None
-        if LLM_AVAILABLE and risk_score >= 30:  # Only use LLM for potentially risky transactions
-            llm_risk = _analyze_with_llm(
-                merchant_name, amount, category, transaction_date, user_profile
+        if context is not None:
+            user_profile = context['user_profile']
+            behavioral_risk = _behavioral_risk(
+                amount, category, _history_stats(context['category_history']), context['current_count']
             )
-            
-            if llm_risk:
-                # LLM can adjust score up or down based on context
-                risk_score += llm_risk['score_adjustment']
-                if llm_risk['factors']:
-                    risk_factors.extend(llm_risk['factors'])
-                detection_methods_used.append('llm')
-        
-        # Step 6: Classify risk level
-        if risk_score >= 75:
-            risk_level = "high"
-            is_anomaly = True
-            recommendation = "BLOCK transaction and notify user immediately"
-        elif risk_score >= 50:
-            risk_level = "medium"
-            is_anomaly = True
-            recommendation = "FLAG for review - send verification notification to user"
-        elif risk_score >= 30:
-            risk_level = "low-medium"
-            is_anomaly = True
-            recommendation = "MONITOR - log as suspicious but allow transaction"
+            known_merchants = context['known_merchants']
+            # A cached velocity window also holds the transactions scored since
+            # it was fetched, so it wins over the query's count when it covers
+            # this transaction's window
+            hit, recent_count = _get_cached_recent_count(user_id, transaction_dt, transaction_id)
+            if not hit:
+                recent_count = context['recent_count']
         else:
-            risk_level = "low"
-            is_anomaly = False
-            recommendation = "APPROVE - normal transaction"
+            # Without the fused tool the lookups only depend on each other
+            # through the user profile, so they run concurrently
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                profile_future = executor.submit(_get_user_profile, user_id)
+                behavioral_future = executor.submit(
+                    _analyze_behavioral_patterns,
+                    user_id, amount, category, merchant_name, transaction_dt, None
+                )
+                merchants_future = executor.submit(_get_known_merchants, user_id)
+                velocity_future = executor.submit(
+                    _count_recent_transactions, user_id, transaction_dt, None, transaction_id
+                )
+            
+            user_profile = profile_future.result()
+            behavioral_risk = behavioral_future.result()
+            known_merchants = merchants_future.result()
+            recent_count = velocity_future.result()
+        
+        # Step 1: User profile
+        if user_profile and logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "   User Profile: Income=$%.2f, Life Stage=%s",
+                user_profile.get('monthly_income', 0), user_profile.get('life_stage', 'unknown')
+            )
         
-        # Calculate what % of monthly income this represents
-        income_percentile = 0
-        if user_profile and user_profile.get('monthly_income', 0) > 0:
-            income_percentile = (amount / user_profile['monthly_income']) * 100
+        # Steps 2-6: score and classify
+        result, row = _assess_transaction(
+            transaction_id, user_id, amount, merchant_name, transaction_dt, category,
+            UserContext.from_profile(user_profile, amount),
+            behavioral_risk=behavioral_risk,
+            known_merchants=known_merchants,
+            recent_count=recent_count
+        )
         
-        # Update database
-        toolbox = get_toolbox()
+        # Update database (queued, stored with the next multi-row insert)
+        _result_writer.enqueue(get_toolbox(), row)
+        result['persisted'] = False
         
-        update_result = toolbox.call_tool(
-            "insert-processed-transaction",
-            transaction_id=transaction_id,
-            user_id=user_id,
-            category_ai=category,
-            merchant_standardized=merchant_name,
-            is_subscription=False,
-            subscription_confidence=None,
-            is_anomaly=is_anomaly,
-            anomaly_score=f"{risk_score:.2f}",
-            anomaly_reason="; ".join(risk_factors) if risk_factors else None,
-            is_bill=False,
-            bill_cycle_day=None,
-            tags=None,
-            notes=json.dumps({
-                'risk_level': risk_level,
-                'income_percentile': income_percentile,
-                'detection_methods': detection_methods_used,
-                'recommendation': recommendation
-            })
+        return result
+    
+    except Exception as e:
+        logger.error(f"❌ Error in fraud detection: {e}", exc_info=True)
+        
+        return {
+            "status": "error",
+            "transaction_id": transaction_id,
+            "message": f"Fraud detection failed: {str(e)}"
+        }
+
+
+async def detect_fraud_batch(transactions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Runs the same HYBRID fraud analysis as detect_fraud over MANY transactions.
+    Profiles, category histories and known merchants are fetched once for all
+    users in the batch, recent activity once per user, and every result is
+    stored with a single multi-row insert. Transactions that need an LLM
+    review are sent to Gemini concurrently. Prefer this tool over calling
+    detect_fraud in a loop (backfills, nightly re-scoring).
+    
+    Args:
+        transactions: List of transaction dicts. Each needs "transaction_id",
+            "user_id", "amount", "merchant_standardized" (or "merchant_name"),
+            "transaction_date" (or "date") and "category_ai" (or "category")
+            (required). Results of fetch_and_categorize_transactions can be
+            passed as-is: their categorized fields take precedence over the
+            fetched row under "transaction".
+    
+    Returns:
+        A dictionary containing:
+        {
+            "status": "success", "partial" or "error",
+            "analyzed_count": Number of transactions scored and stored,
+            "flagged_count": Number of transactions flagged as anomalies,
+            "results": Per-transaction results (same shape as detect_fraud),
+            "message": Status message
+        }
+    """
+    
+    try:
+        logger.info(f"🔍 Batch fraud analysis for {len(transactions)} transactions")
+        
+        prepared = [_prepare_batch_row(txn) for txn in transactions]
+        user_ids = sorted({txn['user_id'] for txn in prepared})
+        
+        # Every lookup in this run goes through one memoizing toolbox, so the
+        # per-user fallbacks below never repeat a query for the same user
+        toolbox = ToolboxCache(await asyncio.to_thread(get_toolbox))
+        
+        # Steps 1-4 lookups: one query per data set for the whole batch, all in flight at once
+        profiles, known_merchants, histories, recent_dates = await asyncio.gather(
+            asyncio.to_thread(_get_user_profiles_bulk, toolbox, user_ids),
+            asyncio.to_thread(_get_known_merchants_bulk, toolbox, user_ids),
+            asyncio.to_thread(_get_category_histories_bulk, toolbox, user_ids),
+            asyncio.to_thread(_get_recent_transaction_dates_bulk, toolbox, prepared),
         )
         
-        if not update_result['success']:
-            logger.warning(f"Failed to update fraud flags: {update_result.get('error')}")
+        for txn in prepared:
+            txn['user_context'] = UserContext.from_profile(profiles.get(txn['user_id']), txn['amount'])
         
-        logger.info(
-            f"✅ Fraud analysis: Risk={risk_level} (score={risk_score:.0f}/100, "
-            f"{income_percentile:.1f}% of income, methods={','.join(detection_methods_used)})"
+        # Steps 2-4 scoring (fallback lookups may still hit the toolbox, so off the event loop)
+        assessments = await asyncio.to_thread(
+            _score_batch, toolbox, prepared, profiles, known_merchants, histories, recent_dates
         )
         
+        # Step 5: LLM review of every potentially risky transaction, concurrently
+        if LLM_AVAILABLE:
+            risky = [
+                (txn, assessment) for txn, assessment in zip(prepared, assessments)
+                if not isinstance(assessment, Exception) and _needs_llm_review(assessment['risk_score'])
+            ]
+            semaphore = asyncio.Semaphore(MAX_LLM_CONCURRENCY)
+            
+            async def _bounded(txn: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+                async with semaphore:
+                    return await _aanalyze_with_llm(
+                        txn['merchant_name'], txn['amount'], txn['category'],
+                        txn['transaction_dt'], txn['user_context']
+                    )
+            
+            # Rows with the same merchant signature share one review
+            signatures = {}
+            for txn, _ in risky:
+                key = _llm_cache_key(
+                    txn['merchant_name'], txn['category'], txn['transaction_dt'], txn['user_context']
+                )
+                txn['llm_cache_key'] = key
+                signatures.setdefault(key, txn)
+            
+            reviews = await asyncio.gather(*[_bounded(txn) for txn in signatures.values()])
+            llm_risks = dict(zip(signatures, reviews))
+            for txn, assessment in risky:
+                _apply_llm_risk(assessment, llm_risks[txn['llm_cache_key']])
+        
+        # Step 6: Classify
+        results = []
+        rows = {}
+        for txn, assessment in zip(prepared, assessments):
+            if isinstance(assessment, Exception):
+                results.append({
+                    "status": "error",
+                    "transaction_id": txn['transaction_id'],
+                    "message": f"Fraud detection failed: {str(assessment)}"
+                })
+                continue
+            
+            result, row = _classify_transaction(
+                txn['transaction_id'], txn['user_id'], txn['amount'], txn['merchant_name'],
+                txn['category'], txn['user_context'], assessment
+            )
+            results.append(result)
+            # ON CONFLICT can't touch the same row twice in one statement - keep the last entry per ID
+            rows[txn['transaction_id']] = row
+        
+        # Step 7: Store every result with one multi-row insert (a write, so it
+        # bypasses the memoizing toolbox)
+        if rows:
+            store_result = await asyncio.to_thread(
+                toolbox.toolbox.call_tool,
+                "insert-processed-transactions-batch",
+                rows=_json_dumps(list(rows.values()))
+            )
+            
+            for result in results:
+                if result['status'] == 'success':
+                    result['persisted'] = store_result['success']
+            
+            if not store_result['success']:
+                logger.warning(f"Failed to update fraud flags: {store_result.get('error')}")
+                for result in results:
+                    if result['status'] == 'success':
+                        result.update(
+                            status="error",
+                            message=f"Failed to store fraud analysis: {store_result.get('error')}"
+                        )
+        
+        succeeded = sum(1 for r in results if r['status'] == 'success')
+        flagged = sum(1 for r in results if r['status'] == 'success' and r['is_anomaly'])
+        failed = len(results) - succeeded
+        
+        logger.info(f"   ✅ Batch complete: {succeeded} analyzed ({flagged} flagged), {failed} failed")
+        
         return {
-            "status": "success",
-            "transaction_id": transaction_id,
-            "is_anomaly": is_anomaly,
-            "risk_score": round(risk_score, 2),
-            "risk_level": risk_level,
-            "risk_factors": risk_factors,
-            "detection_method": "+".join(detection_methods_used),
-            "user_income_percentile": round(income_percentile, 2) if income_percentile else None,
-            "recommendation": recommendation,
-            "message": f"Risk: {risk_level} ({risk_score:.0f}/100) - {recommendation}"
+            "status": "success" if failed == 0 else "partial",
+            "analyzed_count": succeeded,
+            "flagged_count": flagged,
+            "results": results,
+            "message": f"Analyzed {succeeded}/{len(results)} transactions, {flagged} flagged"
         }
     
     except Exception as e:
-        logger.error(f"❌ Error in fraud detection: {e}", exc_info=True)
+        logger.error(f"❌ Error in batch fraud detection: {e}", exc_info=True)
         
         return {
             "status": "error",
-            "transaction_id": transaction_id,
-            "message": f"Fraud detection failed: {str(e)}"
+            "analyzed_count": 0,
+            "flagged_count": 0,
+            "results": [],
+            "message": f"Batch fraud detection failed: {str(e)}"
         }
 
 
+class ResultWriter:
+    """
+    Buffers processed_transactions rows and stores them with a single
+    insert-processed-transactions-batch call per flush. A flush happens when
+    flush_every rows are queued, flush_interval seconds after the first row
+    of a buffer was queued, at interpreter exit, or on an explicit flush().
+    """
+    
+    def __init__(self, flush_every: int, flush_interval: float):
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        # transaction_id -> row; ON CONFLICT can't touch a row twice in one
+        # statement, so a re-queued transaction replaces its earlier row
+        self._rows: Dict[str, Dict[str, Any]] = {}
+        self._toolbox = None
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+    
+    def enqueue(self, toolbox, row: Dict[str, Any]) -> None:
+        """Queue a row to store with the given toolbox"""
+        with self._lock:
+            self._toolbox = toolbox
+            self._rows.pop(row['transaction_id'], None)
+            self._rows[row['transaction_id']] = row
+            full = len(self._rows) >= self.flush_every
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        
+        if full:
+            self.flush()
+    
+    def flush(self) -> bool:
+        """Store every queued row now; False if the insert failed (rows stay queued)"""
+        # Flushes run one at a time so rows reach the database in queue order
+        with self._flush_lock:
+            with self._lock:
+                rows = list(self._rows.values())
+                toolbox = self._toolbox
+                self._rows = {}
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            
+            if not rows:
+                return True
+            
+            try:
+                result = toolbox.call_tool(
+                    "insert-processed-transactions-batch",
+                    rows=_json_dumps(rows)
+                )
+                if result['success']:
+                    return True
+                error = result.get('error')
+            except Exception as e:
+                error = e
+            
+            logger.warning(f"Failed to update fraud flags for {len(rows)} transactions: {error}")
+            # Kept for the next flush or the atexit retry; rows queued since win
+            with self._lock:
+                retained = {r['transaction_id']: r for r in rows if r['transaction_id'] not in self._rows}
+                self._rows = {**retained, **self._rows}
+            return False
+
+
+_result_writer = ResultWriter(FRAUD_WRITE_BATCH_SIZE, FRAUD_WRITE_FLUSH_INTERVAL)
+atexit.register(_result_writer.flush)
+
+
+def flush_fraud_results() -> bool:
+    """Store every fraud result detect_fraud has queued (False if the insert failed)"""
+    return _result_writer.flush()
+
+
+def _score_batch(
+    toolbox,
+    prepared: List[Dict[str, Any]],
+    profiles: Dict[str, Dict[str, Any]],
+    known_merchants: Optional[Dict[str, Set[str]]],
+    histories: Optional[tuple],
+    recent_dates: Dict[str, List[str]]
+) -> List[Any]:
+    """
+    Rule, profile and behavioral scores for every batch row from the bulk
+    lookups (falling back to per-user queries where a bulk tool failed).
+    Each entry is an assessment dict, or the exception that row raised.
+    """
+    
+    # Step 2 for the whole batch at once when it is large enough
+    profile_risks = [None] * len(prepared)
+    if NUMPY_AVAILABLE and len(prepared) >= BULK_SCORING_MIN_ROWS:
+        try:
+            profile_risks = _analyze_with_user_profile_bulk(
+                [txn['user_context'] for txn in prepared],
+                [txn['amount'] for txn in prepared],
+                [txn['category'] for txn in prepared]
+            )
+        except Exception as e:
+            logger.debug(f"Bulk profile scoring error, scoring rows one by one: {e}")
+    
+    assessments = []
+    for txn, profile_risk in zip(prepared, profile_risks):
+        user_id = txn['user_id']
+        try:
+            if histories is not None:
+                history_stats, current_counts = histories
+                behavioral_risk = _behavioral_risk(
+                    txn['amount'], txn['category'],
+                    history_stats.get((user_id, txn['category'])),
+                    current_counts.get((user_id, txn['category']))
+                )
+            else:
+                behavioral_risk = _analyze_behavioral_patterns(
+                    user_id, txn['amount'], txn['category'], txn['merchant_name'],
+                    txn['transaction_dt'], profiles.get(user_id), toolbox=toolbox
+                )
+            
+            if known_merchants is not None:
+                merchants = known_merchants.get(user_id)
+            else:
+                merchants = _get_known_merchants(user_id, toolbox=toolbox)
+            
+            dates = recent_dates.get(user_id)
+            recent_count = None
+            if dates is not None:
+                recent_count = _count_in_window(dates, txn['transaction_dt'])
+            
+            assessments.append(_score_transaction(
+                txn['amount'], txn['merchant_name'], txn['transaction_dt'], txn['category'],
+                txn['user_context'],
+                behavioral_risk=behavioral_risk,
+                known_merchants=merchants,
+                recent_count=recent_count,
+                profile_risk=profile_risk
+            ))
+        except Exception as e:
+            logger.error(f"❌ Error in fraud detection for {txn['transaction_id']}: {e}", exc_info=True)
+            assessments.append(e)
+    
+    return assessments
+
+
+def _is_trivial_purchase(
+    amount: float,
+    merchant_name: str,
+    category: str,
+    user_profile: Optional[Dict]
+) -> bool:
+    """Whether a purchase is too small and ordinary to need the full analysis"""
+    if not user_profile or category in _TRIVIAL_EXCLUDED_CATEGORIES:
+        return False
+    if abs(amount) >= max(user_profile.get('monthly_income', 0), 1) * TRIVIAL_AMOUNT_SHARE:
+        return False
+    merchant_lower = merchant_name.lower()
+    return bool(_LEGITIMATE_MERCHANT_RE.search(merchant_lower)) and not _HIGH_RISK_RE.search(merchant_lower)
+
+
+def _parse_transaction_date(transaction_date: Any) -> Optional[datetime]:
+    """ISO transaction date as a datetime, or None when it can't be parsed"""
+    if isinstance(transaction_date, datetime):
+        return transaction_date
+    try:
+        return datetime.fromisoformat(str(transaction_date))
+    except ValueError:
+        logger.debug(f"Time parsing error: {transaction_date!r}")
+        return None
+
+
+def _assess_transaction(
+    transaction_id: str,
+    user_id: str,
+    amount: float,
+    merchant_name: str,
+    transaction_dt: Optional[datetime],
+    category: str,
+    ctx: 'UserContext',
+    behavioral_risk: Optional[Dict],
+    known_merchants: Optional[Set[str]],
+    recent_count: Optional[int]
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Combine the detection methods for one transaction whose lookups are done.
+    Returns the tool response and the processed_transactions row to store.
+    """
+    
+    assessment = _score_transaction(
+        amount, merchant_name, transaction_dt, category, ctx,
+        behavioral_risk=behavioral_risk,
+        known_merchants=known_merchants,
+        recent_count=recent_count
+    )
+    
+    # Step 5: LLM Contextual Analysis (if available and the review can change the outcome)
+    if LLM_AVAILABLE and _needs_llm_review(assessment['risk_score']):
+        _apply_llm_risk(assessment, _analyze_with_llm(
+            merchant_name, amount, category, transaction_dt, ctx
+        ))
+    
+    return _classify_transaction(
+        transaction_id, user_id, amount, merchant_name, category, ctx, assessment
+    )
+
+
+def _score_transaction(
+    amount: float,
+    merchant_name: str,
+    transaction_dt: Optional[datetime],
+    category: str,
+    ctx: 'UserContext',
+    behavioral_risk: Optional[Dict],
+    known_merchants: Optional[Set[str]],
+    recent_count: Optional[int],
+    profile_risk: Optional[Dict] = None
+) -> Dict[str, Any]:
+    """
+    Steps 2-4: profile, behavioral and rule scores summed into an assessment
+    (profile_risk may be precomputed by _analyze_with_user_profile_bulk)
+    """
+    
+    # Initialize risk scoring
+    risk_score = 0
+    risk_factors = []
+    detection_methods_used = []
+    
+    # Step 2: User Profile-Aware Analysis (Primary)
+    if profile_risk is None:
+        profile_risk = _analyze_with_user_profile(
+            ctx, amount, category, transaction_dt
+        )
+    risk_score += profile_risk['score']
+    if profile_risk['factors']:
+        risk_factors.extend(profile_risk['factors'])
+    detection_methods_used.append('profile-aware')
+    
+    # Step 3: Behavioral Pattern Analysis
+    behavioral_risk = behavioral_risk or {'score': 0, 'factors': []}
+    risk_score += behavioral_risk['score']
+    if behavioral_risk['factors']:
+        risk_factors.extend(behavioral_risk['factors'])
+    detection_methods_used.append('behavioral')
+    
+    # Step 4: Rule-Based Risk Factors
+    rules_risk = _analyze_with_rules(
+        amount, merchant_name, transaction_dt, category, ctx,
+        known_merchants=known_merchants,
+        recent_count=recent_count
+    )
+    risk_score += rules_risk['score']
+    if rules_risk['factors']:
+        risk_factors.extend(rules_risk['factors'])
+    detection_methods_used.append('rules')
+    
+    return {
+        'risk_score': risk_score,
+        'risk_factors': risk_factors,
+        'detection_methods': detection_methods_used
+    }
+
+
+def _needs_llm_review(risk_score: float) -> bool:
+    """
+    Step 5 gate: only potentially risky transactions (>= 30), and only while
+    an LLM adjustment could still move them out of the "high" level (>= 75)
+    """
+    return 30 <= risk_score < 75 - LLM_MIN_ADJUSTMENT
+
+
+def _apply_llm_risk(assessment: Dict[str, Any], llm_risk: Optional[Dict[str, Any]]) -> None:
+    """Step 5: fold an LLM review (if any) into an assessment"""
+    if llm_risk:
+        # LLM can adjust score up or down based on context
+        assessment['risk_score'] += llm_risk['score_adjustment']
+        if llm_risk['factors']:
+            assessment['risk_factors'].extend(llm_risk['factors'])
+        assessment['detection_methods'].append('llm')
+
+
+def _classify_transaction(
+    transaction_id: str,
+    user_id: str,
+    amount: float,
+    merchant_name: str,
+    category: str,
+    ctx: 'UserContext',
+    assessment: Dict[str, Any]
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Step 6: risk level for an assessment, as the tool response and the row to store"""
+    
+    risk_score = assessment['risk_score']
+    risk_factors = assessment['risk_factors']
+    detection_methods_used = assessment['detection_methods']
+    
+    # Step 6: Classify risk level
+    if risk_score >= 75:
+        risk_level = "high"
+        is_anomaly = True
+        recommendation = "BLOCK transaction and notify user immediately"
+    elif risk_score >= 50:
+        risk_level = "medium"
+        is_anomaly = True
+        recommendation = "FLAG for review - send verification notification to user"
+    elif risk_score >= 30:
+        risk_level = "low-medium"
+        is_anomaly = True
+        recommendation = "MONITOR - log as suspicious but allow transaction"
+    else:
+        risk_level = "low"
+        is_anomaly = False
+        recommendation = "APPROVE - normal transaction"
+    
+    # What % of monthly income this represents (only known with a profile)
+    income_percentile = ctx.income_pct if ctx.has_profile else 0
+    
+    row = {
+        "transaction_id": transaction_id,
+        "user_id": user_id,
+        "category_ai": category,
+        "merchant_standardized": merchant_name,
+        "is_subscription": False,
+        "subscription_confidence": None,
+        "is_anomaly": is_anomaly,
+        "anomaly_score": f"{risk_score:.2f}",
+        "anomaly_reason": "; ".join(risk_factors) if risk_factors else None,
+        "is_bill": False,
+        "bill_cycle_day": None,
+        "tags": None,
+        "notes": _json_dumps({
+            'risk_level': risk_level,
+            'income_percentile': income_percentile,
+            'detection_methods': detection_methods_used,
+            'recommendation': recommendation
+        })
+    }
+    
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "✅ Fraud analysis: Risk=%s (score=%.0f/100, %.1f%% of income, methods=%s)",
+            risk_level, risk_score, income_percentile, ','.join(detection_methods_used)
+        )
+    
+    result = {
+        "status": "success",
+        "transaction_id": transaction_id,
+        "is_anomaly": is_anomaly,
+        "risk_score": round(risk_score, 2),
+        "risk_level": risk_level,
+        "risk_factors": risk_factors,
+        "detection_method": "+".join(detection_methods_used),
+        "user_income_percentile": round(income_percentile, 2) if income_percentile else None,
+        "recommendation": recommendation,
+        "message": f"Risk: {risk_level} ({risk_score:.0f}/100) - {recommendation}"
+    }
+    
+    return result, row
+
 # ============================================================================
 # METHOD 1: USER PROFILE-AWARE ANALYSIS
 # ============================================================================
 
 def _get_user_profile(user_id: str) -> Optional[Dict[str, Any]]:
-    """Fetch user profile from database"""
+    """Fetch user profile from database (cached for PROFILE_CACHE_TTL seconds)"""
+    
+    hit, profile = _get_cached_profile(user_id)
+    if hit:
+        return profile
     
     try:
         toolbox = get_toolbox()
@@ -252,26 +874,87 @@ def _get_user_profile(user_id: str) -> Optional[Dict[str, Any]]:
             user_id=user_id
         )
         
-        if result['success'] and result['data']:
-            profile = result['data'][0] if isinstance(result['data'], list) else result['data']
-            return {
-                'monthly_income': float(profile.get('monthly_income', 0)),
-                'life_stage': profile.get('life_stage', 'unknown'),
-                'dependents': int(profile.get('dependents', 0)),
-                'location': profile.get('location', 'unknown'),
-                'budget_alert_threshold': float(profile.get('budget_alert_threshold', 1.0))
-            }
+        if result['success']:
+            profile = None
+            if result['data']:
+                data = result['data'][0] if isinstance(result['data'], list) else result['data']
+                profile = _parse_user_profile(data)
+            _cache_profile(user_id, profile)
+            return profile
     except Exception as e:
         logger.warning(f"Could not fetch user profile: {e}")
     
     return None
 
 
+def invalidate_user_profile(user_id: str) -> None:
+    """Drop a user's cached profile (call after the profile is updated)"""
+    _profile_cache.pop(str(user_id))
+
+
+_PROFILE_MISS = object()
+
+
+def _get_cached_profile(user_id: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """Return (hit, profile); a hit may carry None for a user with no profile"""
+    profile = _profile_cache.get(user_id, _PROFILE_MISS)
+    if profile is _PROFILE_MISS:
+        return False, None
+    return True, profile
+
+
+def _cache_profile(user_id: str, profile: Optional[Dict[str, Any]]) -> None:
+    """Store a profile, or a missing-profile marker that expires sooner"""
+    _profile_cache.set(user_id, profile, None if profile is not None else PROFILE_CACHE_MISS_TTL)
+
+
+def _parse_user_profile(profile: Dict[str, Any]) -> Dict[str, Any]:
+    """Normalize a users row into the profile dict the analyses expect"""
+    return {
+        'monthly_income': float(profile.get('monthly_income', 0)),
+        'life_stage': profile.get('life_stage', 'unknown'),
+        'dependents': int(profile.get('dependents', 0)),
+        'location': profile.get('location', 'unknown'),
+        'budget_alert_threshold': float(profile.get('budget_alert_threshold', 1.0))
+    }
+
+
+@dataclass(slots=True)
+class UserContext:
+    """Profile figures and income-based thresholds for one transaction, derived once"""
+    has_profile: bool
+    monthly_income: float  # 5000 when there is no profile
+    income_pct: float  # amount as % of monthly_income (0 if income isn't positive)
+    life_stage: str  # lowercased
+    dependents: int
+    budget_alert_threshold: Optional[float]
+    location: Optional[str]
+    late_night_threshold: float  # 10% of monthly income
+    new_merchant_threshold: float  # 8% of monthly income
+    
+    @classmethod
+    def from_profile(cls, user_profile: Optional[Dict], amount: float) -> 'UserContext':
+        """Context for a transaction of this amount (user_profile may be None)"""
+        profile = user_profile or {}
+        monthly_income = profile.get('monthly_income', 5000) if profile else 5000
+        return cls(
+            has_profile=bool(profile),
+            monthly_income=monthly_income,
+            income_pct=(amount / monthly_income * 100) if monthly_income > 0 else 0,
+            life_stage=(profile.get('life_stage') or '').lower(),
+            dependents=profile.get('dependents', 0),
+            budget_alert_threshold=profile.get('budget_alert_threshold'),
+            location=profile.get('location'),
+            late_night_threshold=monthly_income * 0.10,
+            new_merchant_threshold=monthly_income * 0.08
+        )
+
+
 def _analyze_with_user_profile(
-    user_profile: Optional[Dict],
+    ctx: UserContext,
     amount: float,
     category: str,
-    transaction_date: str
+    transaction_dt: Optional[datetime]
 ) -> Dict[str, Any]:
     """
     Personalized risk analysis based on user profile
@@ -281,12 +964,8 @@ def _analyze_with_user_profile(
     score = 0
     factors = []
     
-    # If no profile, use conservative defaults
-    if not user_profile or user_profile.get('monthly_income', 0) == 0:
-        # Default to moderate income assumptions
-        monthly_income = 5000  # Assume $5k/month if unknown
-    else:
-        monthly_income = user_profile['monthly_income']
+    # If no profile (or no income on it), use conservative defaults
+    monthly_income = ctx.monthly_income or 5000  # Assume $5k/month if unknown
     
     # Calculate personalized thresholds
     # Rich person: Income $10k/month can spend $1000 easily
@@ -310,8 +989,8 @@ def _analyze_with_user_profile(
         )
     
     # Threshold 2: Consider budget alert threshold (user-defined)
-    if user_profile and user_profile.get('budget_alert_threshold'):
-        threshold_multiplier = user_profile['budget_alert_threshold']
+    if ctx.has_profile and ctx.budget_alert_threshold:
+        threshold_multiplier = ctx.budget_alert_threshold
         
         # User set aggressive alerts (e.g., 0.8 = alert at 80% of baseline)
         if threshold_multiplier < 1.0:
@@ -321,17 +1000,17 @@ def _analyze_with_user_profile(
                 factors.append(f"Exceeds user's conservative budget threshold")
     
     # Threshold 3: Life stage consideration
-    if user_profile:
-        life_stage = user_profile.get('life_stage', '').lower()
+    if ctx.has_profile:
+        life_stage = ctx.life_stage
         
         # Students: Lower income, but occasional large purchases (tuition, textbooks) are normal
         if life_stage == 'student':
-            if category in ['Education', 'Travel', 'Shopping'] and amount > 200:
+            if category in _STUDENT_NORMAL_CATEGORIES and amount > 200:
                 score -= 5  # Reduce risk score - more normal for students
         
         # Families with dependents: Larger purchases more common
-        elif user_profile.get('dependents', 0) > 0:
-            if category in ['Groceries', 'Shopping', 'Healthcare'] and amount > 300:
+        elif ctx.dependents > 0:
+            if category in _FAMILY_NORMAL_CATEGORIES and amount > 300:
                 score -= 5  # Normal family expenses
         
         # Retirees: Fixed income, large purchases more suspicious
@@ -346,6 +1025,75 @@ def _analyze_with_user_profile(
     }
 
 
+def _analyze_with_user_profile_bulk(
+    contexts: List[UserContext],
+    amounts: List[float],
+    categories: List[str]
+) -> List[Dict[str, Any]]:
+    """
+    _analyze_with_user_profile for a whole batch: the income thresholds and
+    life-stage adjustments are evaluated as NumPy array expressions (one
+    column per input), and only the factor messages are built per row
+    """
+    
+    n = len(amounts)
+    amount = np.fromiter(amounts, dtype=np.float64, count=n)
+    income = np.fromiter((c.monthly_income or 5000 for c in contexts), dtype=np.float64, count=n)
+    strict_alerts = np.fromiter(
+        (bool(c.has_profile and c.budget_alert_threshold and c.budget_alert_threshold < 1.0)
+         for c in contexts),
+        dtype=bool, count=n
+    )
+    # 1 = student, 2 = has dependents, 3 = retiree (first match, as in the per-row rules)
+    life_code = np.fromiter((_life_stage_code(c) for c in contexts), dtype=np.int8, count=n)
+    student_category = np.fromiter((c in _STUDENT_NORMAL_CATEGORIES for c in categories), dtype=bool, count=n)
+    family_category = np.fromiter((c in _FAMILY_NORMAL_CATEGORIES for c in categories), dtype=bool, count=n)
+    
+    # Threshold 1: 3 = very large (>20% of income), 2 = large (>10%), 1 = notable (>5%)
+    notable = amount > income * 0.05
+    tier = np.select([amount > income * 0.20, amount > income * 0.10, notable], [3, 2, 1], 0)
+    score = np.array([0, 10, 20, 35])[tier]
+    
+    # Threshold 2: strict user-defined budget alerts
+    strict_hit = strict_alerts & notable
+    score += 5 * strict_hit
+    
+    # Threshold 3: life stage
+    score -= 5 * ((life_code == 1) & student_category & (amount > 200))
+    score -= 5 * ((life_code == 2) & family_category & (amount > 300))
+    retiree_hit = (life_code == 3) & (amount > income * 0.15)
+    score += 10 * retiree_hit
+    
+    labels = (None, "Notable", "Large", "Very large")
+    results = []
+    for i in range(n):
+        factors = []
+        if tier[i]:
+            factors.append(
+                f"{labels[tier[i]]} transaction: ${amounts[i]:.2f} is "
+                f"{(amounts[i]/income[i]*100):.1f}% of monthly income"
+            )
+        if strict_hit[i]:
+            factors.append(f"Exceeds user's conservative budget threshold")
+        if retiree_hit[i]:
+            factors.append("Large purchase unusual for retiree on fixed income")
+        results.append({'score': int(score[i]), 'factors': factors})
+    return results
+
+
+def _life_stage_code(ctx: UserContext) -> int:
+    """Which life-stage rule of _analyze_with_user_profile applies (0 = none)"""
+    if not ctx.has_profile:
+        return 0
+    if ctx.life_stage == 'student':
+        return 1
+    if ctx.dependents > 0:
+        return 2
+    if ctx.life_stage in ('retired', 'retiree'):
+        return 3
+    return 0
+
+
 # ============================================================================
 # METHOD 2: BEHAVIORAL PATTERN ANALYSIS
 # ============================================================================
@@ -355,19 +1103,18 @@ def _analyze_behavioral_patterns(
     amount: float,
     category: str,
     merchant_name: str,
-    transaction_date: str,
-    user_profile: Optional[Dict]
+    transaction_dt: Optional[datetime],
+    user_profile: Optional[Dict],
+    toolbox=None
 ) -> Dict[str, Any]:
     """
     Analyze user's historical behavior patterns
     Detects deviations from normal spending habits
     """
     
-    score = 0
-    factors = []
-    
     try:
-        toolbox = get_toolbox()
+        if toolbox is None:
+            toolbox = get_toolbox()
         
         # Get user's spending history for this category
         history_result = toolbox.call_tool(
@@ -377,38 +1124,6 @@ def _analyze_behavioral_patterns(
             months=6
         )
         
-        if history_result['success'] and history_result['data']:
-            # Calculate user's typical spending in this category
-            historical_data = history_result['data']
-            
-            # Calculate average transaction amount in this category
-            total_amounts = []
-            total_counts = []
-            
-            for row in historical_data:
-                if float(row.get('transaction_count', 0)) > 0:
-                    avg_per_txn = float(row['total_amount']) / float(row['transaction_count'])
-                    total_amounts.append(avg_per_txn)
-                    total_counts.append(int(row['transaction_count']))
-            
-            if total_amounts:
-                user_avg_amount = sum(total_amounts) / len(total_amounts)
-                user_max_amount = max(total_amounts)
-                
-                # Compare current transaction to user's history
-                if amount > user_max_amount * 2:
-                    score += 30
-                    factors.append(
-                        f"2x higher than user's historical maximum in {category} "
-                        f"(${amount:.2f} vs max ${user_max_amount:.2f})"
-                    )
-                elif amount > user_max_amount * 1.5:
-                    score += 20
-                    factors.append(f"50% higher than typical maximum for this category")
-                elif amount > user_avg_amount * 4:
-                    score += 15
-                    factors.append(f"4x higher than user's typical {category} spending")
-        
         # Check spending frequency in this category
         # Sudden spike in transaction count could indicate compromised card
         current_month_result = toolbox.call_tool(
@@ -416,46 +1131,160 @@ def _analyze_behavioral_patterns(
             user_id=user_id
         )
         
-        if current_month_result['success'] and current_month_result['data']:
+        current_count = None
+        if current_month_result['success'] and current_month_result.get('data'):
             for cat_data in current_month_result['data']:
                 if cat_data['category'] == category:
                     current_count = int(cat_data.get('transaction_count', 0))
-                    
-                    # If user suddenly has 2x more transactions this month
-                    if history_result['data']:
-                        avg_monthly_count = sum([int(r.get('transaction_count', 0)) 
-                                                for r in history_result['data']]) / len(history_result['data'])
-                        
-                        if current_count > avg_monthly_count * 2:
-                            score += 15
-                            factors.append(
-                                f"Unusual spike in {category} transactions this month "
-                                f"({current_count} vs avg {avg_monthly_count:.0f})"
-                            )
+        
+        history = history_result.get('data') if history_result['success'] else None
+        return _behavioral_risk(amount, category, _history_stats(history or []), current_count)
         
     except Exception as e:
         logger.debug(f"Behavioral analysis error: {e}")
     
+    return {
+        'score': 0,
+        'factors': []
+    }
+
+
+def _behavioral_risk(
+    amount: float,
+    category: str,
+    stats: Optional[Tuple[Optional[float], Optional[float], float]],
+    current_count: Optional[int]
+) -> Dict[str, Any]:
+    """
+    Score a transaction against the user's history statistics for its
+    category (see _history_stats) and this month's transaction count in it
+    """
+    
+    score = 0
+    factors = []
+    
+    if stats:
+        user_avg_amount, user_max_amount, avg_monthly_count = stats
+        
+        if user_max_amount is not None:
+            # Compare current transaction to user's history
+            if amount > user_max_amount * 2:
+                score += 30
+                factors.append(
+                    f"2x higher than user's historical maximum in {category} "
+                    f"(${amount:.2f} vs max ${user_max_amount:.2f})"
+                )
+            elif amount > user_max_amount * 1.5:
+                score += 20
+                factors.append(f"50% higher than typical maximum for this category")
+            elif amount > user_avg_amount * 4:
+                score += 15
+                factors.append(f"4x higher than user's typical {category} spending")
+        
+        # If user suddenly has 2x more transactions this month
+        if current_count is not None:
+            if current_count > avg_monthly_count * 2:
+                score += 15
+                factors.append(
+                    f"Unusual spike in {category} transactions this month "
+                    f"({current_count} vs avg {avg_monthly_count:.0f})"
+                )
+    
     return {
         'score': score,
         'factors': factors
     }
 
 
+def _history_stats(
+    historical_data: List[Dict[str, Any]]
+) -> Optional[Tuple[Optional[float], Optional[float], float]]:
+    """
+    (average, maximum) per-transaction amount over the months with
+    transactions - both None if there are none - and the average monthly
+    transaction count. None for an empty history.
+    """
+    
+    if not historical_data:
+        return None
+    
+    per_txn_amounts = []
+    count_sum = 0
+    for row in historical_data:
+        count = int(row.get('transaction_count', 0))
+        count_sum += count
+        if count > 0:
+            per_txn_amounts.append(float(row['total_amount']) / count)
+    
+    avg_monthly_count = count_sum / len(historical_data)
+    if not per_txn_amounts:
+        return None, None, avg_monthly_count
+    return (
+        sum(per_txn_amounts) / len(per_txn_amounts),
+        max(per_txn_amounts),
+        avg_monthly_count
+    )
+
+
+def _history_stats_bulk(
+    histories: Dict[tuple, List[Dict[str, Any]]]
+) -> Dict[tuple, Tuple[Optional[float], Optional[float], float]]:
+    """_history_stats for every (user_id, category) history of a batch"""
+    
+    if not histories:
+        return {}
+    
+    if not NUMPY_AVAILABLE:
+        return {key: _history_stats(rows) for key, rows in histories.items()}
+    
+    # One flat array per column with each key's rows contiguous, so the
+    # grouped sums/max are single reduceat calls at the group offsets
+    keys = list(histories)
+    lengths = np.fromiter((len(histories[key]) for key in keys), dtype=np.int64, count=len(keys))
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    rows = [row for key in keys for row in histories[key]]
+    totals = np.fromiter((float(r['total_amount'] or 0) for r in rows), dtype=np.float64, count=len(rows))
+    counts = np.fromiter((int(r.get('transaction_count', 0)) for r in rows), dtype=np.float64, count=len(rows))
+    
+    has_txns = counts > 0
+    per_txn = np.divide(totals, counts, out=np.zeros_like(totals), where=has_txns)
+    months_with_txns = np.add.reduceat(has_txns.astype(np.int64), offsets)
+    per_txn_sum = np.add.reduceat(per_txn, offsets)
+    per_txn_max = np.maximum.reduceat(np.where(has_txns, per_txn, -np.inf), offsets)
+    avg_monthly_count = np.add.reduceat(counts, offsets) / lengths
+    
+    stats = {}
+    for i, key in enumerate(keys):
+        if months_with_txns[i]:
+            stats[key] = (
+                float(per_txn_sum[i] / months_with_txns[i]),
+                float(per_txn_max[i]),
+                float(avg_monthly_count[i])
+            )
+        else:
+            stats[key] = (None, None, float(avg_monthly_count[i]))
+    return stats
+
+
 # ============================================================================
 # METHOD 3: RULE-BASED ANALYSIS (Enhanced)
 # ============================================================================
 
 def _analyze_with_rules(
-    user_id: str,
     amount: float,
     merchant_name: str,
-    transaction_date: str,
+    transaction_dt: Optional[datetime],
     category: str,
-    user_profile: Optional[Dict]
+    ctx: UserContext,
+    known_merchants: Optional[Set[str]] = None,
+    recent_count: Optional[int] = None
 ) -> Dict[str, Any]:
     """
     Enhanced rule-based fraud detection with user profile awareness
+    
+    known_merchants and recent_count come from _get_known_merchants and
+    _count_recent_transactions; None (lookup failed) skips that rule, as
+    does a transaction_dt of None for the time rule.
     """
     
     score = 0
@@ -464,17 +1293,13 @@ def _analyze_with_rules(
     merchant_lower = merchant_name.lower()
     
     # Rule 1: Time-based anomaly (personalized)
-    try:
-        txn_datetime = datetime.fromisoformat(str(transaction_date))
-        hour = txn_datetime.hour
-        
-        # Personalized time risk based on income
-        monthly_income = user_profile.get('monthly_income', 5000) if user_profile else 5000
+    if transaction_dt is not None:
+        hour = transaction_dt.hour
         
         # Late night (2 AM - 5 AM)
         if 2 <= hour <= 5:
-            # Calculate personalized threshold (10% of monthly income)
-            late_night_threshold = monthly_income * 0.10
+            # Personalized threshold (10% of monthly income)
+            late_night_threshold = ctx.late_night_threshold
             
             if amount > late_night_threshold:
                 score += 20
@@ -485,22 +1310,64 @@ def _analyze_with_rules(
             elif amount > late_night_threshold * 0.5:
                 score += 10
                 factors.append(f"Late night transaction at {hour}:00")
-    except Exception as e:
-        logger.debug(f"Time parsing error: {e}")
     
     # Rule 2: High-risk merchant categories
-    if any(risk_cat in merchant_lower for risk_cat in HIGH_RISK_CATEGORIES):
+    if _HIGH_RISK_RE.search(merchant_lower):
         score += 25
         factors.append(f"High-risk merchant category detected")
     
     # Rule 3: Legitimate high-value merchant (reduce risk)
-    if any(legit in merchant_lower for legit in LEGITIMATE_HIGH_VALUE_MERCHANTS):
+    if _LEGITIMATE_MERCHANT_RE.search(merchant_lower):
         score -= 10  # Reduce suspicion for known legitimate merchants
-        logger.debug(f"   Recognized legitimate merchant: {merchant_name}")
+        logger.debug("   Recognized legitimate merchant: %s", merchant_name)
     
     # Rule 4: New merchant risk (personalized)
+    if known_merchants and merchant_lower not in known_merchants:
+        # New merchant - personalized threshold (8% of monthly income)
+        new_merchant_threshold = ctx.new_merchant_threshold
+        
+        if amount > new_merchant_threshold:
+            score += 25
+            factors.append(
+                f"First time with new merchant '{merchant_name}' for ${amount:.2f} "
+                f"(threshold: ${new_merchant_threshold:.2f})"
+            )
+        elif amount > new_merchant_threshold * 0.5:
+            score += 15
+            factors.append(f"New merchant: {merchant_name}")
+    
+    # Rule 5: Transaction velocity
+    if recent_count:
+        if recent_count >= 5:
+            score += 30
+            factors.append(f"Card testing pattern: {recent_count} transactions in 1 hour")
+        elif recent_count >= 3:
+            score += 15
+            factors.append(f"Rapid transactions: {recent_count} in last hour")
+    
+    # Rule 6: International/location anomaly (if location data available)
+    if ctx.has_profile and ctx.location:
+        # TODO: If merchant location differs significantly from user location
+        # Would need merchant location data or IP geolocation
+        pass
+    
+    # Rule 7: Round amount suspicion (card testing)
+    if round(amount * 100) in _ROUND_CENTS:
+        score += 5
+        factors.append(f"Round amount (${amount:.2f}) - possible card testing")
+    
+    return {
+        'score': score,
+        'factors': factors
+    }
+
+
+def _get_known_merchants(user_id: str, toolbox=None) -> Optional[Set[str]]:
+    """Lowercased merchants the user has shopped at (None if the lookup fails)"""
+    
     try:
-        toolbox = get_toolbox()
+        if toolbox is None:
+            toolbox = get_toolbox()
         
         top_result = toolbox.call_tool(
             "get-top-merchants",
@@ -509,68 +1376,341 @@ def _analyze_with_rules(
         )
         
         if top_result['success'] and top_result['data']:
-            known_merchants = [row['merchant_standardized'].lower() for row in top_result['data']]
-            
-            if merchant_lower not in known_merchants:
-                # New merchant - personalized threshold
-                monthly_income = user_profile.get('monthly_income', 5000) if user_profile else 5000
-                new_merchant_threshold = monthly_income * 0.08  # 8% of monthly income
-                
-                if amount > new_merchant_threshold:
-                    score += 25
-                    factors.append(
-                        f"First time with new merchant '{merchant_name}' for ${amount:.2f} "
-                        f"(threshold: ${new_merchant_threshold:.2f})"
-                    )
-                elif amount > new_merchant_threshold * 0.5:
-                    score += 15
-                    factors.append(f"New merchant: {merchant_name}")
-    except:
-        pass
+            return {row['merchant_standardized'].lower() for row in top_result['data']}
+    except Exception as e:
+        logger.debug(f"Top merchants lookup error: {e}")
+    
+    return None
+
+
+def _count_recent_transactions(
+    user_id: str,
+    transaction_dt: Optional[datetime],
+    toolbox=None,
+    transaction_id: Optional[str] = None
+) -> Optional[int]:
+    """Number of user transactions in the hour before transaction_dt (None if unknown)"""
+    
+    if transaction_dt is None:
+        return None
     
-    # Rule 5: Transaction velocity
     try:
-        txn_datetime = datetime.fromisoformat(str(transaction_date))
-        one_hour_ago = txn_datetime - timedelta(hours=1)
+        if toolbox is None:
+            toolbox = get_toolbox()
         
-        toolbox = get_toolbox()
+        start_date, end_date = _velocity_window(transaction_dt)
+        seen = {transaction_id: end_date} if transaction_id else {}
+        dates = _get_recent_dates(toolbox, user_id, start_date, end_date, seen)
         
-        recent_result = toolbox.call_tool(
-            "get-user-transactions",
+        if dates:
+            return len(dates)
+    except Exception as e:
+        logger.debug(f"Velocity lookup error: {e}")
+    
+    return None
+
+
+def _get_cached_recent_count(
+    user_id: str,
+    transaction_dt: datetime,
+    transaction_id: Optional[str] = None
+) -> Tuple[bool, Optional[int]]:
+    """Return (hit, count) from the velocity cache alone, counted like _count_recent_transactions"""
+    start_date, end_date = _velocity_window(transaction_dt)
+    seen = {transaction_id: end_date} if transaction_id else {}
+    dates = _get_cached_recent_dates(user_id, start_date, end_date, seen)
+    if dates is None:
+        return False, None
+    return True, len(dates) or None
+
+
+def _velocity_window(transaction_dt: datetime) -> Tuple[str, str]:
+    """Date range (YYYY-MM-DD) the velocity rule counts transactions in"""
+    return (
+        (transaction_dt - timedelta(hours=1)).strftime('%Y-%m-%d'),
+        transaction_dt.strftime('%Y-%m-%d')
+    )
+
+
+def _get_recent_dates(
+    toolbox,
+    user_id: str,
+    start_date: str,
+    end_date: str,
+    seen: Dict[str, str]
+) -> Optional[List[str]]:
+    """
+    Dates of the user's transactions from start_date to end_date (None if the
+    lookup fails). Answered from the velocity cache when its window covers the
+    range; seen (transaction_id -> date) are the transactions being scored,
+    added to a cached window they fall in since the DB may not have had them
+    when it was fetched.
+    """
+    
+    cached = _get_cached_recent_dates(user_id, start_date, end_date, seen)
+    if cached is not None:
+        return cached
+    
+    result = toolbox.call_tool(
+        "get-user-transactions",
+        user_id=user_id,
+        start_date=start_date,
+        end_date=end_date
+    )
+    if not result['success']:
+        return None
+    
+    rows = result.get('data') or []
+    transaction_ids = {str(row['transaction_id']) for row in rows if row.get('transaction_id')}
+    dates = [str(row.get('date'))[:10] for row in rows]
+    
+    _velocity_cache.set(user_id, (start_date, end_date, transaction_ids, dates))
+    
+    return list(dates)
+
+
+def _get_cached_recent_dates(
+    user_id: str,
+    start_date: str,
+    end_date: str,
+    seen: Dict[str, str]
+) -> Optional[List[str]]:
+    """Dates in the range from the velocity cache, or None when no cached window covers it"""
+    entry = _velocity_cache.get(user_id)
+    if entry is None or not (entry[0] <= start_date and end_date <= entry[1]):
+        return None
+    
+    cached_start, cached_end, transaction_ids, dates = entry
+    with _velocity_window_lock:
+        for transaction_id, date in seen.items():
+            if transaction_id not in transaction_ids and cached_start <= date <= cached_end:
+                transaction_ids.add(transaction_id)
+                dates.append(date)
+        return [d for d in dates if start_date <= d <= end_date]
+
+
+def _get_fraud_context(
+    user_id: str,
+    category: str,
+    transaction_dt: datetime,
+    toolbox=None
+) -> Optional[Dict[str, Any]]:
+    """
+    Profile, category history, current-month count, known merchants and
+    velocity count for one transaction from a single get-fraud-context call,
+    in the shapes the per-lookup helpers return (None if the tool fails)
+    """
+    
+    try:
+        if toolbox is None:
+            toolbox = get_toolbox()
+        
+        start_date, end_date = _velocity_window(transaction_dt)
+        result = toolbox.call_tool(
+            "get-fraud-context",
             user_id=user_id,
-            start_date=one_hour_ago.strftime('%Y-%m-%d'),
-            end_date=txn_datetime.strftime('%Y-%m-%d')
+            category=category,
+            months=6,
+            start_date=start_date,
+            end_date=end_date
         )
         
-        if recent_result['success'] and recent_result['data']:
-            count = len(recent_result['data'])
-            
-            if count >= 5:
-                score += 30
-                factors.append(f"Card testing pattern: {count} transactions in 1 hour")
-            elif count >= 3:
-                score += 15
-                factors.append(f"Rapid transactions: {count} in last hour")
-    except:
-        pass
+        if not result['success'] or not result.get('data'):
+            logger.debug(f"get-fraud-context unavailable: {result.get('error')}")
+            return None
+        
+        row = result['data'][0]
+        profile, history, merchants = (
+            _json_loads(row[key]) if isinstance(row[key], str) else row[key]
+            for key in ('profile', 'category_history', 'top_merchants')
+        )
+        
+        user_profile = _parse_user_profile(profile) if profile else None
+        _cache_profile(user_id, user_profile)
+        
+        current_count = row.get('current_count')
+        return {
+            'user_profile': user_profile,
+            'category_history': history or [],
+            'current_count': int(current_count) if current_count is not None else None,
+            'known_merchants': {m.lower() for m in merchants} if merchants else None,
+            'recent_count': int(row.get('recent_count') or 0) or None
+        }
+    except Exception as e:
+        logger.debug(f"Fraud context lookup error: {e}")
     
-    # Rule 6: International/location anomaly (if location data available)
-    if user_profile and user_profile.get('location'):
-        # TODO: If merchant location differs significantly from user location
-        # Would need merchant location data or IP geolocation
-        pass
+    return None
+
+
+def _prepare_batch_row(txn: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Normalize one detect_fraud_batch input. The AI category and standardized
+    merchant win over the raw bank columns, so scoring uses the same category
+    as spending_patterns and the stored row keeps the categorization.
+    """
+    # fetch_and_categorize_transactions results nest the fetched row; their
+    # top-level "category" is the categorization, the nested one the bank's
+    raw = txn.get('transaction') if isinstance(txn.get('transaction'), dict) else {}
     
-    # Rule 7: Round amount suspicion (card testing)
-    if amount in [1.00, 5.00, 10.00, 20.00, 50.00, 100.00, 500.00, 1000.00]:
-        score += 5
-        factors.append(f"Round amount (${amount:.2f}) - possible card testing")
+    def field(*keys):
+        for source in (txn, raw):
+            for key in keys:
+                if source.get(key) not in (None, ''):
+                    return source[key]
+        return None
     
     return {
-        'score': score,
-        'factors': factors
+        'transaction_id': field('transaction_id'),
+        'user_id': str(field('user_id')),
+        'amount': abs(float(field('amount') or 0)),
+        'merchant_name': field('merchant_standardized', 'merchant_name') or '',
+        'transaction_dt': _parse_transaction_date(field('transaction_date', 'date')),
+        'category': field('category_ai', 'category') or 'Other',
     }
 
 
+# ============================================================================
+# BATCH LOOKUPS (detect_fraud_batch)
+# ============================================================================
+
+def _get_user_profiles_bulk(toolbox, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Profiles for every user not already cached, in one query (per-user fallback)"""
+    
+    profiles = {}
+    missing = []
+    for user_id in user_ids:
+        hit, profile = _get_cached_profile(user_id)
+        if not hit:
+            missing.append(user_id)
+        elif profile is not None:
+            profiles[user_id] = profile
+    
+    if not missing:
+        return profiles
+    
+    try:
+        result = toolbox.call_tool(
+            "get-user-profiles-bulk",
+            user_ids=_json_dumps(missing)
+        )
+        
+        if result['success']:
+            fetched = {str(row['id']): _parse_user_profile(row) for row in result.get('data') or []}
+            for user_id in missing:
+                _cache_profile(user_id, fetched.get(user_id))
+            profiles.update(fetched)
+            return profiles
+        logger.debug(f"get-user-profiles-bulk unavailable: {result.get('error')}")
+    except Exception as e:
+        logger.debug(f"Bulk profile lookup error: {e}")
+    
+    for user_id in missing:
+        profile = _get_user_profile(user_id)
+        if profile:
+            profiles[user_id] = profile
+    return profiles
+
+
+def _get_known_merchants_bulk(toolbox, user_ids: List[str]) -> Optional[Dict[str, Set[str]]]:
+    """Each user's lowercased top merchants in one query (None if the bulk tool fails)"""
+    
+    try:
+        result = toolbox.call_tool(
+            "get-top-merchants-bulk",
+            user_ids=_json_dumps(user_ids),
+            limit=100
+        )
+        
+        if result['success']:
+            known_merchants = {}
+            for row in result.get('data') or []:
+                known_merchants.setdefault(str(row['user_id']), set()).add(
+                    row['merchant_standardized'].lower()
+                )
+            return known_merchants
+        logger.debug(f"get-top-merchants-bulk unavailable: {result.get('error')}")
+    except Exception as e:
+        logger.debug(f"Bulk top merchants lookup error: {e}")
+    
+    return None
+
+
+def _get_category_histories_bulk(
+    toolbox,
+    user_ids: List[str],
+    months: int = 6
+) -> Optional[Tuple[Dict[tuple, tuple], Dict[tuple, int]]]:
+    """
+    History statistics (see _history_stats) per (user_id, category), plus
+    this month's transaction count per (user_id, category) - both from one
+    query for all users. None if the bulk tool fails.
+    """
+    
+    try:
+        result = toolbox.call_tool(
+            "get-category-history-bulk",
+            user_ids=_json_dumps(user_ids),
+            months=months
+        )
+        
+        if result['success']:
+            histories = {}
+            current_counts = {}
+            today = datetime.now()
+            for row in result.get('data') or []:
+                key = (str(row['user_id']), row['category'])
+                histories.setdefault(key, []).append(row)
+                if int(row['year']) == today.year and int(row['month']) == today.month:
+                    current_counts[key] = int(row.get('transaction_count', 0))
+            return _history_stats_bulk(histories), current_counts
+        logger.debug(f"get-category-history-bulk unavailable: {result.get('error')}")
+    except Exception as e:
+        logger.debug(f"Bulk history lookup error: {e}")
+    
+    return None
+
+
+def _get_recent_transaction_dates_bulk(toolbox, prepared: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    """
+    Transaction dates for each user covering every velocity window in the
+    batch - one get-user-transactions call per user (run concurrently)
+    """
+    
+    windows = {}
+    seen = {}
+    for txn in prepared:
+        if txn['transaction_dt'] is None:
+            continue
+        start, end = _velocity_window(txn['transaction_dt'])
+        lo, hi = windows.get(txn['user_id'], (start, end))
+        windows[txn['user_id']] = (min(lo, start), max(hi, end))
+        seen.setdefault(txn['user_id'], {})[str(txn['transaction_id'])] = end
+    
+    def fetch(user_id: str) -> Optional[List[str]]:
+        try:
+            start_date, end_date = windows[user_id]
+            return _get_recent_dates(toolbox, user_id, start_date, end_date, seen[user_id])
+        except Exception as e:
+            logger.debug(f"Velocity lookup error: {e}")
+        return None
+    
+    if not windows:
+        return {}
+    
+    with ThreadPoolExecutor(max_workers=min(FRAUD_LOOKUP_WORKERS, len(windows))) as executor:
+        dates = dict(zip(windows, executor.map(fetch, windows)))
+    
+    return {user_id: d for user_id, d in dates.items() if d is not None}
+
+
+def _count_in_window(dates: List[str], transaction_dt: Optional[datetime]) -> Optional[int]:
+    """Count dates inside the same window _count_recent_transactions queries"""
+    if transaction_dt is None:
+        return None
+    start, end = _velocity_window(transaction_dt)
+    return sum(1 for d in dates if start <= d <= end)
+
+
 # ============================================================================
 # METHOD 4: LLM CONTEXTUAL ANALYSIS
 # ============================================================================
@@ -579,8 +1719,8 @@ def _analyze_with_llm(
     merchant_name: str,
     amount: float,
     category: str,
-    transaction_date: str,
-    user_profile: Optional[Dict]
+    transaction_dt: Optional[datetime],
+    ctx: UserContext
 ) -> Optional[Dict[str, Any]]:
     """
     Use LLM to understand merchant reputation and transaction context
@@ -590,21 +1730,123 @@ def _analyze_with_llm(
     if not LLM_AVAILABLE:
         return None
     
-    # Prepare context
-    monthly_income = user_profile.get('monthly_income', 5000) if user_profile else 5000
-    income_pct = (amount / monthly_income * 100) if monthly_income > 0 else 0
+    cache_key = _llm_cache_key(merchant_name, category, transaction_dt, ctx)
+    cached = _get_cached_llm_result(cache_key)
+    if cached is not None:
+        return cached
+    
+    prompt = _build_llm_prompt(merchant_name, amount, category, transaction_dt, ctx)
     
     try:
-        txn_datetime = datetime.fromisoformat(str(transaction_date))
-        hour = txn_datetime.hour
-        day_of_week = txn_datetime.strftime('%A')
-    except:
+        response = llm_model.generate_content(
+            prompt,
+            generation_config=_llm_generation_config()
+        )
+        
+        result = _parse_llm_response(response.text)
+        if result is not None:
+            _cache_llm_result(cache_key, result)
+        return result
+    
+    except Exception as e:
+        logger.error(f"   LLM: Analysis failed: {e}")
+        return None
+
+
+async def _aanalyze_with_llm(
+    merchant_name: str,
+    amount: float,
+    category: str,
+    transaction_dt: Optional[datetime],
+    ctx: UserContext
+) -> Optional[Dict[str, Any]]:
+    """
+    Async variant of _analyze_with_llm using generate_content_async,
+    so several Gemini requests can be in flight at once
+    """
+    
+    if not LLM_AVAILABLE:
+        return None
+    
+    cache_key = _llm_cache_key(merchant_name, category, transaction_dt, ctx)
+    cached = _get_cached_llm_result(cache_key)
+    if cached is not None:
+        return cached
+    
+    prompt = _build_llm_prompt(merchant_name, amount, category, transaction_dt, ctx)
+    
+    try:
+        response = await llm_model.generate_content_async(
+            prompt,
+            generation_config=_llm_generation_config()
+        )
+        
+        result = _parse_llm_response(response.text)
+        if result is not None:
+            _cache_llm_result(cache_key, result)
+        return result
+    
+    except Exception as e:
+        logger.error(f"   LLM: Analysis failed: {e}")
+        return None
+
+
+def _llm_cache_key(
+    merchant_name: str,
+    category: str,
+    transaction_dt: Optional[datetime],
+    ctx: UserContext
+) -> tuple:
+    """Merchant signature that groups transactions the LLM would judge alike"""
+    hour = transaction_dt.hour if transaction_dt is not None else 12
+    return (merchant_name.lower(), category, int(ctx.income_pct // 10), hour // 6)
+
+
+def _get_cached_llm_result(key: tuple) -> Optional[Dict[str, Any]]:
+    """Return a copy of a fresh cached LLM review, or None on a miss"""
+    result = _llm_cache.get(key)
+    if result is None:
+        return None
+    return {**result, 'factors': list(result['factors'])}
+
+
+def _cache_llm_result(key: tuple, result: Dict[str, Any]) -> None:
+    """Store a copy of an LLM review"""
+    _llm_cache.set(key, {**result, 'factors': list(result['factors'])})
+
+
+def _llm_generation_config():
+    """Generation settings shared by the sync and async LLM reviews"""
+    return genai.types.GenerationConfig(
+        temperature=0.2,
+        max_output_tokens=120,  # the JSON answer is well under 100 tokens
+        response_mime_type="application/json",
+        response_schema=FRAUD_RESPONSE_SCHEMA,
+    )
+
+
+def _build_llm_prompt(
+    merchant_name: str,
+    amount: float,
+    category: str,
+    transaction_dt: Optional[datetime],
+    ctx: UserContext
+) -> str:
+    """Per-transaction part of the fraud review prompt"""
+    
+    # Prepare context
+    monthly_income = ctx.monthly_income
+    income_pct = ctx.income_pct
+    
+    if transaction_dt is not None:
+        hour = transaction_dt.hour
+        day_of_week = transaction_dt.strftime('%A')
+    else:
         hour = 12
         day_of_week = "Unknown"
     
-    prompt = f"""You are a fraud detection expert analyzing a potentially suspicious transaction.
-
-**Transaction Details:**
+    # Instructions and examples come from FRAUD_SYSTEM_PROMPT
+    return f"""**Transaction Details:**
 - Merchant: {merchant_name}
 - Amount: ${amount:.2f}
 - Category: {category}
@@ -613,89 +1855,29 @@ def _analyze_with_llm(
 - User Monthly Income: ${monthly_income:.2f}
 - Transaction as % of Income: {income_pct:.1f}%
 
-**Your Task:**
-Assess the fraud risk of this transaction based on:
-1. Merchant reputation and legitimacy
-2. Transaction context and reasonableness
-3. Amount appropriateness for merchant type
-4. Time/day pattern analysis
+Now analyze this transaction:"""
 
-**Consider:**
-- Is this merchant known and legitimate?
-- Is the amount reasonable for this merchant?
-- Does timing raise red flags?
-- Are there fraud patterns (e.g., testing, unusual merchant types)?
 
-**Response Format (JSON ONLY):**
-{{
-  "fraud_risk_adjustment": -10 to +20,
-  "reasoning": "Brief explanation",
-  "merchant_reputation": "legitimate|suspicious|unknown",
-  "concerns": ["concern1", "concern2"],
-  "confidence": 0.8
-}}
-
-**Examples:**
-
-Merchant: "Apple.com", $999, 10% of income, Tuesday 2PM
-{{
-  "fraud_risk_adjustment": -10,
-  "reasoning": "Apple is legitimate merchant, amount reasonable for electronics purchase, normal time",
-  "merchant_reputation": "legitimate",
-  "concerns": [],
-  "confidence": 0.95
-}}
-
-Merchant: "Unknown Electronics LLC", $1500, 30% of income, Tuesday 3AM
-{{
-  "fraud_risk_adjustment": +15,
-  "reasoning": "Unknown merchant, very high amount, suspicious late-night timing",
-  "merchant_reputation": "suspicious",
-  "concerns": ["unknown merchant", "late night", "high amount"],
-  "confidence": 0.85
-}}
-
-Merchant: "Gift Card Depot", $500, 10% of income, Friday 11PM
-{{
-  "fraud_risk_adjustment": +20,
-  "reasoning": "Gift card purchases are common fraud indicator, late night timing suspicious",
-  "merchant_reputation": "suspicious",
-  "concerns": ["gift cards common in fraud", "late night", "unusual merchant"],
-  "confidence": 0.90
-}}
-
-Now analyze the transaction above:"""
+def _parse_llm_response(text: str) -> Optional[Dict[str, Any]]:
+    """Turn the model's JSON answer into a score adjustment (None if unusable)"""
     
     try:
-        response = llm_model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.2,
-                max_output_tokens=300,
-            )
-        )
-        
-        text = response.text.strip()
-        
-        if text.startswith('```'):
-            if '```json' in text:
-                text = text.split('```json')[1].split('```')[0].strip()
-            elif '```' in text:
-                text = text.split('```')[1].split('```')[0].strip()
-        
-        result = json.loads(text)
+        # Structured output mode returns bare JSON, no code fences
+        result = _json_loads(text)
         
         score_adjustment = int(result.get('fraud_risk_adjustment', 0))
+        score_adjustment = max(LLM_MIN_ADJUSTMENT, min(score_adjustment, LLM_MAX_ADJUSTMENT))
         concerns = result.get('concerns', [])
         
         factors = []
         if concerns:
             factors.append(f"LLM: {', '.join(concerns)} ({result.get('reasoning', '')})")
         
-        logger.info(
-            f"   LLM: {result.get('merchant_reputation', 'unknown')} merchant, "
-            f"risk adjustment: {score_adjustment:+d}"
-        )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "   LLM: %s merchant, risk adjustment: %+d",
+                result.get('merchant_reputation', 'unknown'), score_adjustment
+            )
         
         return {
             'score_adjustment': score_adjustment,
@@ -707,7 +1889,3 @@ Now analyze the transaction above:"""
     except json.JSONDecodeError as e:
         logger.error(f"   LLM: Failed to parse JSON: {e}")
         return None
-    
-    except Exception as e:
-        logger.error(f"   LLM: Analysis failed: {e}")
-        return None
\ No newline at end of file
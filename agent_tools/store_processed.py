@@ -4,7 +4,10 @@ Marks transactions as fully processed and handles completion tasks
 """
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Optional
+from agent_tools.financial_analyst_tools import invalidate_history_cache
+from agent_tools.fraud_detector import flush_fraud_results
 from agent_tools.toolbox_wrapper import get_toolbox
 from datetime import datetime
 import json
@@ -75,36 +78,58 @@ def store_processed_data(
         
         logger.info(f"💾 Finalizing processing for {len(transaction_ids)} transactions")
         
+        # One toolbox handle and timestamp shared by every step
         toolbox = get_toolbox()
+        now_iso = datetime.now().isoformat()
         
-        # Step 1: Update transaction status to 'fully_processed'
-        try:
-            result = toolbox.call_tool(
-                "mark-transactions-complete",
-                transaction_ids=",".join(transaction_ids)
-            )
+        # Fraud results detect_fraud queued must be stored before the batch
+        # is counted or marked complete
+        if not flush_fraud_results():
+            logger.warning("   ⚠️ Some queued fraud results could not be stored")
+        
+        # Steps 2 and 3 don't depend on the status update, so one lookup for
+        # stuck transactions and batch statistics runs while step 1 is in flight
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            context_future = executor.submit(_get_finalization_context, user_id, transaction_ids, toolbox)
+            
+            # Step 1: Update transaction status to 'fully_processed'
+            try:
+                result = toolbox.call_tool(
+                    "mark-transactions-complete",
+                    transaction_ids=",".join(transaction_ids)
+                )
+                
+                if result['success']:
+                    processed_count = len(transaction_ids)
+                    logger.info(f"   ✅ Marked {processed_count} transactions as fully_processed")
+                else:
+                    logger.warning(f"   ⚠️ Failed to update status: {result.get('error')}")
+                    processed_count = 0
+            except Exception as e:
+                logger.warning(f"   ⚠️ Could not update transaction status: {e}")
+                processed_count = len(transaction_ids)  # Assume success
             
-            if result['success']:
-                processed_count = len(transaction_ids)
-                logger.info(f"   ✅ Marked {processed_count} transactions as fully_processed")
-            else:
-                logger.warning(f"   ⚠️ Failed to update status: {result.get('error')}")
-                processed_count = 0
-        except Exception as e:
-            logger.warning(f"   ⚠️ Could not update transaction status: {e}")
-            processed_count = len(transaction_ids)  # Assume success
+            # Step 2: Check for any transactions that got stuck
+            context = context_future.result()
+            stuck_transactions = context['stuck']
         
-        # Step 2: Check for any transactions that got stuck
-        stuck_transactions = _find_stuck_transactions(user_id)
+        # New transactions change the histories and baselines the analyst caches
+        invalidate_history_cache(user_id)
+        
+        # The lookup may have run before this batch was marked complete
+        if processed_count:
+            finalized = set(transaction_ids)
+            stuck_transactions = [t for t in stuck_transactions if t not in finalized]
         
         # Step 3: Generate processing statistics
-        stats = _generate_processing_stats(transaction_ids, summary)
+        stats = _generate_processing_stats(transaction_ids, summary, now_iso=now_iso, details=context['stats'])
         
         # Step 4: Create audit log entry
         _log_processing_completion(
             user_id=user_id,
             transaction_count=processed_count,
-            summary=summary or stats
+            summary=summary or stats,
+            now_iso=now_iso
         )
         
         # Step 5: Optionally trigger notifications (if user wants them)
@@ -126,7 +151,7 @@ def store_processed_data(
                 "categorized": summary.get('categorized', 0) if summary else 0,
                 "subscriptions": summary.get('subscriptions_detected', 0) if summary else 0,
                 "anomalies": summary.get('anomalies_found', 0) if summary else 0,
-                "completion_time": datetime.now().isoformat()
+                "completion_time": now_iso
             },
             "message": f"Successfully finalized processing for {processed_count} transactions"
         }
@@ -152,13 +177,14 @@ def store_processed_data(
 # HELPER FUNCTIONS (All Synchronous)
 # ============================================================================
 
-def _find_stuck_transactions(user_id: str) -> List[str]:
+def _find_stuck_transactions(user_id: str, toolbox=None) -> List[str]:
     """
     Find transactions stuck in 'processing' state for too long
     These likely failed mid-pipeline and need retry
     """
     try:
-        toolbox = get_toolbox()
+        if toolbox is None:
+            toolbox = get_toolbox()
         
         # Find transactions marked as 'processing' for > 1 hour
         result = toolbox.call_tool(
@@ -181,9 +207,60 @@ def _find_stuck_transactions(user_id: str) -> List[str]:
     return []
 
 
+def _get_finalization_context(
+    user_id: str,
+    transaction_ids: List[str],
+    toolbox=None
+) -> Dict[str, Any]:
+    """
+    Stuck transaction IDs and statistics for the processed batch from a
+    single get-finalization-context call. Falls back to find-stuck-transactions
+    (without statistics) if the tool is unavailable.
+    """
+    try:
+        if toolbox is None:
+            toolbox = get_toolbox()
+        
+        result = toolbox.call_tool(
+            "get-finalization-context",
+            user_id=user_id,
+            transaction_ids=",".join(transaction_ids),
+            hours=1  # Stuck for more than 1 hour
+        )
+        
+        if result['success'] and result.get('data'):
+            row = result['data'][0]
+            stuck, breakdown = (
+                json.loads(row[key]) if isinstance(row[key], str) else row[key]
+                for key in ('stuck', 'category_breakdown')
+            )
+            stuck = stuck or []
+            
+            if stuck:
+                logger.warning(f"   ⚠️ Found {len(stuck)} stuck transactions for user {user_id}")
+                logger.warning(f"      Stuck IDs: {stuck[:5]}...")  # Show first 5
+            
+            return {
+                'stuck': stuck,
+                'stats': {
+                    'anomaly_count': int(row.get('anomaly_count') or 0),
+                    'subscription_count': int(row.get('subscription_count') or 0),
+                    'category_breakdown': breakdown or {}
+                }
+            }
+        
+        logger.debug(f"   get-finalization-context unavailable: {result.get('error')}")
+    except Exception as e:
+        logger.debug(f"   Could not load finalization context: {e}")
+    
+    return {'stuck': _find_stuck_transactions(user_id, toolbox), 'stats': None}
+
+
 def _generate_processing_stats(
     transaction_ids: List[str], 
-    provided_summary: Optional[Dict] = None
+    provided_summary: Optional[Dict] = None,
+    now_iso: Optional[str] = None,
+    details: Optional[Dict] = None
 ) -> Dict[str, Any]:
     """Generate statistics about processed transactions"""
     
@@ -194,26 +271,12 @@ def _generate_processing_stats(
     # Generate basic stats
     stats = {
         "total_processed": len(transaction_ids),
-        "timestamp": datetime.now().isoformat()
+        "timestamp": now_iso or datetime.now().isoformat()
     }
     
-    # Optionally query database for more details
-    try:
-        toolbox = get_toolbox()
-        
-        # You could add queries here to get:
-        # - Count of anomalies detected
-        # - Count of subscriptions found
-        # - Category breakdown
-        
-        # Example (if you add this tool to tools.yaml):
-        # result = toolbox.call_tool(
-        #     "get-processing-summary",
-        #     transaction_ids=",".join(transaction_ids)
-        # )
-        
-    except Exception as e:
-        logger.debug(f"   Could not generate detailed stats: {e}")
+    # Anomaly/subscription counts and category breakdown from the database
+    if details:
+        stats.update(details)
     
     return stats
 
@@ -221,7 +284,8 @@ def _generate_processing_stats(
 def _log_processing_completion(
     user_id: str, 
     transaction_count: int, 
-    summary: Dict
+    summary: Dict,
+    now_iso: Optional[str] = None
 ):
     """
     Create audit log entry for processing completion
@@ -231,7 +295,7 @@ def _log_processing_completion(
         log_entry = {
             'user_id': user_id,
             'transaction_count': transaction_count,
-            'completed_at': datetime.now().isoformat(),
+            'completed_at': now_iso or datetime.now().isoformat(),
             'summary': summary,
             'agent': 'agent1_data_processor'
         }
@@ -4,25 +4,57 @@ HYBRID approach: Pattern Analysis + LLM + Rule-based for maximum accuracy
 """
 
 import logging
-from typing import Dict, Any, List, Optional
+import os
+import re
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime, timedelta
 from collections import defaultdict
-from agent_tools.toolbox_wrapper import get_toolbox
+from functools import lru_cache
+from agent_tools.toolbox_wrapper import TTLCache, get_toolbox
 import json
 from dotenv import load_dotenv
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Structured output for the batched merchant classification: Gemini returns
+# the JSON array directly, so no markdown or prose needs stripping
+SUBSCRIPTION_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "index": {"type": "INTEGER"},
+            "merchant": {"type": "STRING"},
+            "is_subscription": {"type": "BOOLEAN"},
+            "confidence": {"type": "NUMBER"},
+            "subscription_type": {
+                "type": "STRING",
+                "enum": ["streaming", "music", "software", "fitness", "news", "cloud", "gaming", "meal-kit", "other"]
+            },
+            "expected_frequency": {"type": "STRING", "enum": ["weekly", "monthly", "quarterly", "yearly"]},
+            "reasoning": {"type": "STRING"},
+        },
+        "required": ["index", "is_subscription", "confidence"],
+    },
+}
+
 # Import Gemini for LLM analysis
 try:
     import google.generativeai as genai
-    import os
     
     GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
     if GEMINI_API_KEY:
         genai.configure(api_key=GEMINI_API_KEY)
-        llm_model = genai.GenerativeModel('gemini-flash-lite-latest')
+        # Built once; each call only adds its output token budget
+        llm_model = genai.GenerativeModel(
+            'gemini-flash-lite-latest',
+            generation_config={
+                'temperature': 0,
+                'response_mime_type': 'application/json',
+                'response_schema': SUBSCRIPTION_RESPONSE_SCHEMA,
+            }
+        )
         LLM_AVAILABLE = True
         logger.info("✅ Gemini LLM initialized for subscription detection")
     else:
@@ -32,6 +64,26 @@ except ImportError:
     LLM_AVAILABLE = False
     logger.warning("⚠️ google-generativeai not installed, using pattern analysis only")
 
+# NumPy (a pandas dependency) computes interval and amount statistics in C
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# Below this many transactions a plain loop beats building arrays
+PATTERN_NUMPY_MIN_ROWS = 64
+
+# Number of merchants sent to Gemini in one batched prompt; larger
+# user histories are split into several prompts of this size
+LLM_BATCH_SIZE = int(os.environ.get("SUBSCRIPTION_LLM_BATCH_SIZE", "30"))
+
+# LLM classifications by (merchant, amount, history size), shared across users
+# since the same services recur everywhere; None marks "not a subscription"
+LLM_CACHE_MAXSIZE = 50_000
+_llm_cache = TTLCache(LLM_CACHE_MAXSIZE)
+_CACHE_MISS = object()
+
 
 # Known subscription services (high confidence)
 KNOWN_SUBSCRIPTIONS = {
@@ -83,6 +135,24 @@ KNOWN_SUBSCRIPTIONS = {
     'uber eats': {'type': 'food-delivery', 'typical_amount': 9.99, 'frequency': 'monthly'},
 }
 
+# Known names compiled longest first into one lookahead alternation (as in
+# categorization's merchant scan), so a single finditer pass reports the
+# longest name starting at each position. A shorter name hidden behind it is
+# a substring of it, so each name maps to the first-listed name it contains;
+# the lowest-ranked hit is then the name the dict scan would return. Most
+# merchants contain no known name, so a plain search of the same
+# alternation rules them out first.
+_KNOWN_RANK = {name: rank for rank, name in enumerate(KNOWN_SUBSCRIPTIONS)}
+_KNOWN_FIRST_CONTAINED = {
+    name: min((other for other in KNOWN_SUBSCRIPTIONS if other in name), key=_KNOWN_RANK.__getitem__)
+    for name in KNOWN_SUBSCRIPTIONS
+}
+_KNOWN_ALTERNATION = '|'.join(
+    re.escape(name) for name in sorted(KNOWN_SUBSCRIPTIONS, key=len, reverse=True)
+)
+_KNOWN_NAME_RE = re.compile(_KNOWN_ALTERNATION)
+_KNOWN_SCAN_RE = re.compile('(?=(' + _KNOWN_ALTERNATION + '))')
+
 
 def detect_subscriptions(user_id: str) -> Dict[str, Any]:
     """
@@ -145,16 +215,17 @@ def detect_subscriptions(user_id: str) -> Dict[str, Any]:
         
         logger.info(f"   Analyzing {len(transactions)} transactions for patterns")
         
-        # Group by merchant
+        # Group by merchant (a DataFrame costs more to build than this whole pass)
         merchant_groups = defaultdict(list)
         for txn in transactions:
             merchant = txn.get('merchant_name', 'Unknown')
             if merchant and merchant != 'Unknown':
                 merchant_groups[merchant].append(txn)
         
-        detected_subscriptions = []
+        pending_upserts = []
         
         # Analyze each merchant group with HYBRID approach
+        analyzed = []
         for merchant, txns in merchant_groups.items():
             logger.info(f"   Analyzing: {merchant} ({len(txns)} transactions)")
             
@@ -164,11 +235,15 @@ def detect_subscriptions(user_id: str) -> Dict[str, Any]:
             # Method 2: Rule-based Known Subscriptions
             rules_result = _check_known_subscription(merchant, txns)
             
-            # Method 3: LLM Analysis (if available)
-            llm_result = None
-            if LLM_AVAILABLE and len(txns) >= 1:  # LLM can identify even with 1 transaction
-                llm_result = _analyze_with_llm(merchant, txns)
-            
+            analyzed.append((merchant, txns, pattern_result, rules_result))
+        
+        # Method 3: LLM Analysis (if available) for every merchant at once;
+        # the LLM can identify a subscription even with 1 transaction
+        llm_results = [None] * len(analyzed)
+        if LLM_AVAILABLE and analyzed:
+            llm_results = _analyze_batch_with_llm([(merchant, txns) for merchant, txns, _, _ in analyzed])
+        
+        for (merchant, txns, pattern_result, rules_result), llm_result in zip(analyzed, llm_results):
             # Combine all methods
             final_result = _combine_subscription_results(
                 pattern_result, 
@@ -179,19 +254,37 @@ def detect_subscriptions(user_id: str) -> Dict[str, Any]:
             )
             
             if final_result:
-                # Store subscription via MCP tool
-                store_result = toolbox.call_tool(
-                    "upsert-subscription",
-                    user_id=user_id,
-                    merchant_name=merchant,
-                    merchant_standardized=final_result['merchant_standardized'],
-                    amount=str(final_result['amount']),
-                    frequency=final_result['frequency'],
-                    start_date=final_result['start_date'],
-                    category=final_result.get('category', 'Subscriptions')
-                )
-                
-                if store_result['success']:
+                pending_upserts.append((merchant, final_result))
+        
+        # Merchants that standardize to the same name collapse into one
+        # subscription row; the last one wins, as in the batch upsert
+        pending_upserts = list({
+            (final_result['merchant_standardized'], final_result['frequency']): (merchant, final_result)
+            for merchant, final_result in pending_upserts
+        }.values())
+        
+        # Store every detected subscription in one round-trip
+        detected_subscriptions = []
+        if pending_upserts:
+            rows = [
+                {
+                    'merchant_name': merchant,
+                    'merchant_standardized': final_result['merchant_standardized'],
+                    'amount': str(final_result['amount']),
+                    'frequency': final_result['frequency'],
+                    'start_date': final_result['start_date'],
+                    'category': final_result.get('category', 'Subscriptions')
+                }
+                for merchant, final_result in pending_upserts
+            ]
+            store_result = toolbox.call_tool(
+                "upsert-subscriptions-batch",
+                user_id=user_id,
+                rows=json.dumps(rows)
+            )
+            
+            if store_result['success']:
+                for merchant, final_result in pending_upserts:
                     detected_subscriptions.append({
                         'merchant': final_result['merchant_standardized'],
                         'amount': final_result['amount'],
@@ -207,6 +300,10 @@ def detect_subscriptions(user_id: str) -> Dict[str, Any]:
                         f"(confidence: {final_result.get('confidence', 0.7):.2f}, "
                         f"method: {final_result.get('method', 'hybrid')})"
                     )
+            else:
+                logger.warning(
+                    f"⚠️ Failed to store {len(pending_upserts)} subscriptions: {store_result.get('error')}"
+                )
         
         logger.info(f"✅ Subscription detection complete: {len(detected_subscriptions)} found")
         
@@ -240,36 +337,33 @@ def _analyze_pattern(merchant: str, transactions: List[Dict]) -> Optional[Dict[s
     if len(transactions) < 2:
         return None
     
-    # Sort by date
-    transactions = sorted(transactions, key=lambda x: x['date'])
+    use_numpy = NUMPY_AVAILABLE and len(transactions) >= PATTERN_NUMPY_MIN_ROWS
     
-    # Calculate intervals between transactions
-    intervals = []
-    for i in range(1, len(transactions)):
-        try:
-            prev_date = datetime.fromisoformat(str(transactions[i-1]['date']))
-            curr_date = datetime.fromisoformat(str(transactions[i]['date']))
-            days = (curr_date - prev_date).days
-            intervals.append(days)
-        except:
-            continue
+    # Check amount consistency (±5%) first: it is cheap and rejects most
+    # merchants before any date is sorted or parsed
+    if use_numpy:
+        avg_amount, amount_variance = _amount_stats_numpy(transactions)
+    else:
+        avg_amount, amount_variance = _amount_stats(transactions)
     
-    if not intervals:
+    if amount_variance > 0.05:  # More than 5% variance
+        logger.debug(f"   Pattern: {merchant} - Amount variance too high ({amount_variance:.2%})")
         return None
     
-    # Check amount consistency (±5%)
-    amounts = [abs(float(txn['amount'])) for txn in transactions]
-    avg_amount = sum(amounts) / len(amounts)
-    amount_variance = max(abs(amt - avg_amount) / avg_amount for amt in amounts) if avg_amount > 0 else 0
+    # Sort by date
+    transactions = sorted(transactions, key=lambda x: x['date'])
     
-    if amount_variance > 0.05:  # More than 5% variance
-        logger.debug(f"   Pattern: {merchant} - Amount variance too high ({amount_variance:.2%})")
+    if use_numpy:
+        interval_stats = _interval_stats_numpy(transactions)
+    else:
+        interval_stats = _interval_stats(transactions)
+    
+    if interval_stats is None:
         return None
     
-    # Detect frequency
-    avg_interval = sum(intervals) / len(intervals)
-    interval_std = (sum((i - avg_interval) ** 2 for i in intervals) / len(intervals)) ** 0.5
+    avg_interval, interval_std = interval_stats
     
+    # Detect frequency
     frequency = _classify_frequency(avg_interval, interval_std)
     
     if not frequency:
@@ -294,6 +388,82 @@ def _analyze_pattern(merchant: str, transactions: List[Dict]) -> Optional[Dict[s
     }
 
 
+def _parse_date(value: Any) -> Optional[datetime]:
+    """Parse a transaction date, or None if it is not ISO formatted"""
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def _amount_stats(transactions: List[Dict]) -> Tuple[float, float]:
+    """Average amount and largest relative deviation from it"""
+    
+    amounts = [abs(float(txn['amount'])) for txn in transactions]
+    avg_amount = sum(amounts) / len(amounts)
+    amount_variance = max(abs(amt - avg_amount) / avg_amount for amt in amounts) if avg_amount > 0 else 0
+    
+    return avg_amount, amount_variance
+
+
+def _amount_stats_numpy(transactions: List[Dict]) -> Tuple[float, float]:
+    """Same as _amount_stats, with the reductions done on a NumPy array"""
+    
+    amounts = np.fromiter(
+        (abs(float(txn['amount'])) for txn in transactions),
+        dtype=np.float64,
+        count=len(transactions)
+    )
+    avg_amount = float(amounts.mean())
+    amount_variance = float(np.abs(amounts - avg_amount).max() / avg_amount) if avg_amount > 0 else 0
+    
+    return avg_amount, amount_variance
+
+
+def _interval_stats(transactions: List[Dict]) -> Optional[Tuple[float, float]]:
+    """
+    Average interval and interval std-dev in days of date-sorted transactions.
+    Each date is parsed once; intervals next to an unparseable date are
+    skipped, and None is returned when no interval is left.
+    """
+    
+    dates = [_parse_date(txn['date']) for txn in transactions]
+    intervals = [
+        (curr_date - prev_date).days
+        for prev_date, curr_date in zip(dates, dates[1:])
+        if prev_date is not None and curr_date is not None
+    ]
+    
+    if not intervals:
+        return None
+    
+    avg_interval = sum(intervals) / len(intervals)
+    interval_std = (sum((i - avg_interval) ** 2 for i in intervals) / len(intervals)) ** 0.5
+    
+    return avg_interval, interval_std
+
+
+def _interval_stats_numpy(transactions: List[Dict]) -> Optional[Tuple[float, float]]:
+    """Same as _interval_stats, with the reductions done on NumPy arrays"""
+    
+    # NumPy parses the ISO strings itself; if any is malformed, parse one by
+    # one so it becomes NaT and every interval touching it is dropped
+    try:
+        stamps = np.array([str(txn['date']) for txn in transactions], dtype='datetime64[us]')
+    except ValueError:
+        stamps = np.array([_parse_date(txn['date']) for txn in transactions], dtype='datetime64[us]')
+    gaps = np.diff(stamps)
+    gaps = gaps[~np.isnat(gaps)]
+    
+    if not gaps.size:
+        return None
+    
+    # Floor division matches timedelta.days for partial days
+    intervals = gaps // np.timedelta64(1, 'D')
+    
+    return float(intervals.mean()), float(intervals.std())
+
+
 def _classify_frequency(avg_interval: float, std_dev: float) -> Optional[str]:
     """Classify payment frequency based on intervals"""
     
@@ -358,80 +528,151 @@ def _check_known_subscription(merchant: str, transactions: List[Dict]) -> Option
     High confidence if name matches and amount/frequency align
     """
     
-    merchant_lower = merchant.lower()
+    match = _match_known_subscription(merchant.lower())
     
-    # Check against known subscriptions
-    for known_name, sub_info in KNOWN_SUBSCRIPTIONS.items():
-        if known_name in merchant_lower:
-            # Calculate average amount from transactions
-            amounts = [abs(float(txn['amount'])) for txn in transactions]
-            avg_amount = sum(amounts) / len(amounts) if amounts else 0
-            
-            # Check if amount is close to typical amount (±30% tolerance)
-            typical_amount = sub_info['typical_amount']
-            amount_diff_pct = abs(avg_amount - typical_amount) / typical_amount if typical_amount > 0 else 1
-            
-            # High confidence if amount matches
-            if amount_diff_pct < 0.30:  # Within 30%
-                confidence = 0.92
-            else:
-                confidence = 0.80  # Still high confidence based on name
-            
-            logger.info(
-                f"   Rules: {merchant} - Matched known subscription '{known_name}' "
-                f"(confidence: {confidence:.2f})"
-            )
-            
-            return {
-                'amount': avg_amount,
-                'frequency': sub_info['frequency'],
-                'confidence': confidence,
-                'method': 'rules',
-                'subscription_type': sub_info['type']
-            }
+    if match is None:
+        return None
     
-    return None
+    known_name, sub_info = match
+    
+    # Calculate average amount from transactions
+    amounts = [abs(float(txn['amount'])) for txn in transactions]
+    avg_amount = sum(amounts) / len(amounts) if amounts else 0
+    
+    # Check if amount is close to typical amount (±30% tolerance)
+    typical_amount = sub_info['typical_amount']
+    amount_diff_pct = abs(avg_amount - typical_amount) / typical_amount if typical_amount > 0 else 1
+    
+    # High confidence if amount matches
+    if amount_diff_pct < 0.30:  # Within 30%
+        confidence = 0.92
+    else:
+        confidence = 0.80  # Still high confidence based on name
+    
+    logger.info(
+        f"   Rules: {merchant} - Matched known subscription '{known_name}' "
+        f"(confidence: {confidence:.2f})"
+    )
+    
+    return {
+        'amount': avg_amount,
+        'frequency': sub_info['frequency'],
+        'confidence': confidence,
+        'method': 'rules',
+        'subscription_type': sub_info['type']
+    }
+
+
+@lru_cache(maxsize=4096)
+def _match_known_subscription(merchant_lower: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    First KNOWN_SUBSCRIPTIONS name contained in the merchant, with its info.
+    Memoized because the same merchants recur across users and runs.
+    """
+    
+    if _KNOWN_NAME_RE.search(merchant_lower) is None:
+        return None
+    
+    hits = {_KNOWN_FIRST_CONTAINED[m.group(1)] for m in _KNOWN_SCAN_RE.finditer(merchant_lower)}
+    known_name = min(hits, key=_KNOWN_RANK.__getitem__)
+    return known_name, KNOWN_SUBSCRIPTIONS[known_name]
 
 
 # ============================================================================
 # METHOD 3: LLM-BASED SUBSCRIPTION IDENTIFICATION
 # ============================================================================
 
-def _analyze_with_llm(merchant: str, transactions: List[Dict]) -> Optional[Dict[str, Any]]:
+def _analyze_batch_with_llm(candidates: List[Tuple[str, List[Dict]]]) -> List[Optional[Dict[str, Any]]]:
     """
-    Use LLM to identify if merchant is a subscription service
-    Even with limited transaction history
+    Use LLM to identify which merchants are subscription services, even with
+    limited transaction history. Merchants without a cached classification
+    share one prompt per LLM_BATCH_SIZE merchants; returns one result per
+    candidate (None where the merchant is not a subscription or the LLM gave
+    no usable answer).
     """
     
-    if not LLM_AVAILABLE:
-        return None
+    results: List[Optional[Dict[str, Any]]] = [None] * len(candidates)
     
-    # Prepare transaction summary
-    amounts = [abs(float(txn['amount'])) for txn in transactions]
-    avg_amount = sum(amounts) / len(amounts) if amounts else 0
+    if not LLM_AVAILABLE:
+        return results
+    
+    avg_amounts = []
+    for _, transactions in candidates:
+        amounts = [abs(float(txn['amount'])) for txn in transactions]
+        avg_amounts.append(sum(amounts) / len(amounts) if amounts else 0)
+    
+    # Merchants already classified (for any user) at the same amount skip the LLM
+    keys = []
+    misses = []
+    for i, (merchant, transactions) in enumerate(candidates):
+        keys.append(_llm_cache_key(merchant, avg_amounts[i], len(transactions)))
+        cached = _get_cached_llm_result(keys[i])
+        if cached is _CACHE_MISS:
+            misses.append(i)
+        elif cached is not None:
+            results[i] = {**cached, 'amount': avg_amounts[i]}
+    
+    for start in range(0, len(misses), LLM_BATCH_SIZE):
+        chunk = misses[start:start + LLM_BATCH_SIZE]
+        answers = _analyze_chunk_with_llm([candidates[i] for i in chunk], [avg_amounts[i] for i in chunk])
+        for pos, answer in answers.items():
+            i = chunk[pos]
+            _cache_llm_result(keys[i], answer)
+            if answer is not None:
+                results[i] = {**answer, 'amount': avg_amounts[i]}
+    
+    return results
+
+
+def _llm_cache_key(merchant: str, avg_amount: float, transaction_count: int) -> tuple:
+    """Cache key for a merchant's classification: name, amount in cents, history size (1, 2, 3+)"""
+    return merchant.lower(), round(avg_amount * 100), min(transaction_count, 3)
+
+
+def _get_cached_llm_result(key: tuple) -> Any:
+    """Return a copy of a cached classification (None if not a subscription), or _CACHE_MISS"""
+    result = _llm_cache.get(key, _CACHE_MISS)
+    if result is _CACHE_MISS:
+        return _CACHE_MISS
+    return dict(result) if result is not None else None
+
+
+def _cache_llm_result(key: tuple, result: Optional[Dict[str, Any]]) -> None:
+    """Store a copy of a classification"""
+    _llm_cache.set(key, dict(result) if result is not None else None)
+
+
+def _analyze_chunk_with_llm(
+    candidates: List[Tuple[str, List[Dict]]],
+    avg_amounts: List[float]
+) -> Dict[int, Optional[Dict[str, Any]]]:
+    """
+    Classify up to LLM_BATCH_SIZE merchants with a single Gemini call.
+    Returns the classification (None if not a subscription) by position for
+    every merchant the LLM answered; failed merchants are left out.
+    """
     
-    # Get dates
-    dates = []
-    for txn in transactions:
-        try:
-            dates.append(datetime.fromisoformat(str(txn['date'])))
-        except:
-            continue
+    results: Dict[int, Optional[Dict[str, Any]]] = {}
     
-    dates.sort()
-    date_range = f"{dates[0].strftime('%Y-%m-%d')} to {dates[-1].strftime('%Y-%m-%d')}" if dates else "Unknown"
+    # Prepare one summary line per merchant
+    merchant_lines = []
+    for i, ((merchant, transactions), avg_amount) in enumerate(zip(candidates, avg_amounts), start=1):
+        dates = sorted(d for d in (_parse_date(txn['date']) for txn in transactions) if d is not None)
+        date_range = f"{dates[0].strftime('%Y-%m-%d')} to {dates[-1].strftime('%Y-%m-%d')}" if dates else "Unknown"
+        
+        merchant_lines.append(
+            f"{i}. Merchant: {merchant} | Transactions: {len(transactions)} | "
+            f"Average Amount: ${avg_amount:.2f} | Date Range: {date_range}"
+        )
     
     # Build prompt
     prompt = f"""You are a financial analyst expert in identifying subscription services.
 
-**Merchant Analysis:**
-- Merchant Name: {merchant}
-- Number of Transactions: {len(transactions)}
-- Average Amount: ${avg_amount:.2f}
-- Date Range: {date_range}
+**Merchants:**
+{chr(10).join(merchant_lines)}
 
 **Your Task:**
-Determine if this merchant is a SUBSCRIPTION SERVICE (recurring billing service).
+For each merchant, determine if it is a SUBSCRIPTION SERVICE (recurring billing service).
 
 **Subscription Indicators:**
 - Streaming services (Netflix, Spotify, Hulu, etc.)
@@ -449,115 +690,92 @@ Determine if this merchant is a SUBSCRIPTION SERVICE (recurring billing service)
 - Irregular shopping (Amazon purchases that vary)
 - Occasional dining or groceries
 
-**Response Format (JSON ONLY):**
-{{
-  "is_subscription": true or false,
-  "confidence": 0.95,
-  "subscription_type": "streaming|software|fitness|news|cloud|gaming|meal-kit|other",
-  "expected_frequency": "weekly|monthly|quarterly|yearly",
-  "reasoning": "Brief explanation",
-  "typical_amount_range": "low|medium|high"
-}}
+**Response Format (JSON ARRAY ONLY, one object per merchant, same numbering):**
+[
+  {{
+    "index": 1,
+    "merchant": "Merchant name as given",
+    "is_subscription": true or false,
+    "confidence": 0.95,
+    "subscription_type": "streaming|software|fitness|news|cloud|gaming|meal-kit|other",
+    "expected_frequency": "weekly|monthly|quarterly|yearly",
+    "reasoning": "Brief explanation"
+  }}
+]
 
 **Examples:**
 
-Merchant: "Netflix.com", 3 transactions, $15.99 avg
-{{
-  "is_subscription": true,
-  "confidence": 0.99,
-  "subscription_type": "streaming",
-  "expected_frequency": "monthly",
-  "reasoning": "Netflix is a well-known streaming subscription service",
-  "typical_amount_range": "medium"
-}}
-
-Merchant: "Amazon.com", 5 transactions, $42.30 avg
-{{
-  "is_subscription": false,
-  "confidence": 0.85,
-  "reasoning": "Amazon shows variable amounts typical of shopping, not recurring subscription",
-  "typical_amount_range": "variable"
-}}
-
-Merchant: "Spotify", 2 transactions, $10.99 avg
-{{
-  "is_subscription": true,
-  "confidence": 0.98,
-  "subscription_type": "music",
-  "expected_frequency": "monthly",
-  "reasoning": "Spotify is a music streaming subscription service",
-  "typical_amount_range": "low"
-}}
-
-Merchant: "Planet Fitness", 4 transactions, $10.00 avg
-{{
-  "is_subscription": true,
-  "confidence": 0.95,
-  "subscription_type": "fitness",
-  "expected_frequency": "monthly",
-  "reasoning": "Planet Fitness is a gym with monthly membership fees",
-  "typical_amount_range": "medium"
-}}
+1. Merchant: "Netflix.com", 3 transactions, $15.99 avg
+2. Merchant: "Amazon.com", 5 transactions, $42.30 avg
+3. Merchant: "Planet Fitness", 4 transactions, $10.00 avg
+[
+  {{"index": 1, "merchant": "Netflix.com", "is_subscription": true, "confidence": 0.99, "subscription_type": "streaming", "expected_frequency": "monthly", "reasoning": "Netflix is a well-known streaming subscription service"}},
+  {{"index": 2, "merchant": "Amazon.com", "is_subscription": false, "confidence": 0.85, "reasoning": "Variable amounts typical of shopping, not a recurring subscription"}},
+  {{"index": 3, "merchant": "Planet Fitness", "is_subscription": true, "confidence": 0.95, "subscription_type": "fitness", "expected_frequency": "monthly", "reasoning": "Planet Fitness is a gym with monthly membership fees"}}
+]
 
 **IMPORTANT:**
-- Respond with ONLY the JSON object
+- Respond with ONLY the JSON array
+- Return exactly {len(candidates)} objects, "index" must match the merchant number
 - Be conservative: if uncertain, set is_subscription to false
 - High confidence (0.9+) only for well-known services
 - Consider merchant name patterns carefully
 
-Now analyze the merchant above:"""
+Now analyze the merchants above:"""
     
     try:
         response = llm_model.generate_content(
             prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.1,
-                max_output_tokens=300,
-            )
+            generation_config={'max_output_tokens': 100 * len(candidates)}
         )
         
-        # Parse JSON
-        text = response.text.strip()
-        
-        if text.startswith('```'):
-            if '```json' in text:
-                text = text.split('```json')[1].split('```')[0].strip()
-            elif '```' in text:
-                text = text.split('```')[1].split('```')[0].strip()
-        
-        result = json.loads(text)
-        
-        # Validate
-        is_subscription = result.get('is_subscription', False)
-        
-        if not is_subscription:
-            logger.info(f"   LLM: {merchant} - Not a subscription (confidence: {result.get('confidence', 0):.2f})")
-            return None
-        
-        confidence = float(result.get('confidence', 0.7))
-        frequency = result.get('expected_frequency', 'monthly')
-        
-        logger.info(
-            f"   LLM: {merchant} - Identified as {result.get('subscription_type', 'subscription')} "
-            f"(confidence: {confidence:.2f}, frequency: {frequency})"
-        )
+        parsed = json.loads(response.text)
         
-        return {
-            'amount': avg_amount,
-            'frequency': frequency,
-            'confidence': confidence,
-            'method': 'llm',
-            'subscription_type': result.get('subscription_type', 'other'),
-            'reasoning': result.get('reasoning', '')
-        }
+        if not isinstance(parsed, list):
+            logger.error("   LLM: Batch response is not a JSON array")
+            return results
     
     except json.JSONDecodeError as e:
         logger.error(f"   LLM: Failed to parse JSON response: {e}")
-        return None
+        return results
     
     except Exception as e:
         logger.error(f"   LLM: Analysis failed: {e}")
-        return None
+        return results
+    
+    for entry in parsed:
+        try:
+            index = int(entry['index']) - 1
+            if not 0 <= index < len(candidates):
+                continue
+            
+            merchant = candidates[index][0]
+            
+            # Validate
+            if not entry.get('is_subscription', False):
+                logger.info(f"   LLM: {merchant} - Not a subscription (confidence: {float(entry.get('confidence', 0)):.2f})")
+                results[index] = None
+                continue
+            
+            confidence = float(entry.get('confidence', 0.7))
+            frequency = entry.get('expected_frequency', 'monthly')
+            
+            logger.info(
+                f"   LLM: {merchant} - Identified as {entry.get('subscription_type', 'subscription')} "
+                f"(confidence: {confidence:.2f}, frequency: {frequency})"
+            )
+            
+            results[index] = {
+                'frequency': frequency,
+                'confidence': confidence,
+                'method': 'llm',
+                'subscription_type': entry.get('subscription_type', 'other'),
+                'reasoning': entry.get('reasoning', '')
+            }
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"   LLM: Skipping malformed batch entry: {e}")
+    
+    return results
 
 
 # ============================================================================
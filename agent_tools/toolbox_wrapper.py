@@ -3,8 +3,12 @@ MCP Toolbox Wrapper
 Simplified interface to call tools defined in tools.yaml
 """
 
+import json
 import logging
-from typing import Dict, Any
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Hashable, List, Optional
 # from dotenv import load_dotenv
 # load_dotenv()
 
@@ -17,6 +21,29 @@ CLIENT_URL = os.getenv("CLIENT_URL", "https://toolbox-service-440584682160.us-ce
 
 logger = logging.getLogger(__name__)
 
+# Use orjson for tool results and payloads when installed (stdlib fallback).
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so handlers are shared.
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+
+def _decode_result(result: Any) -> Any:
+    """Decode a JSON text tool result into Python objects (other values pass through)"""
+    if isinstance(result, (str, bytes)):
+        try:
+            return _json_loads(result)
+        except ValueError:
+            return result
+    return result
+
 
 class ToolboxWrapper:
     """Wrapper for MCP Toolbox client"""
@@ -83,9 +110,9 @@ class ToolboxWrapper:
         try:
             logger.info(f"Calling tool: {tool_name} with params {kwargs}")
 
-            # Load the specific tool and call it
+            # Load the specific tool and call it; callers always get decoded data
             tool = self.client.load_tool(tool_name)
-            result = tool(**kwargs)
+            result = _decode_result(tool(**kwargs))
 
             return {
                 "success": True,
@@ -103,6 +130,88 @@ class ToolboxWrapper:
             }
 
 
+class ToolboxCache:
+    """
+    Memoizing view of a toolbox for one pipeline run (a batch or a request).
+    Successful call_tool results are reused for identical (tool_name, kwargs);
+    create a fresh instance per run so data is never stale across runs.
+    """
+
+    def __init__(self, toolbox: ToolboxWrapper):
+        self.toolbox = toolbox
+        self._results: Dict[tuple, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def call_tool(self, tool_name: str, **kwargs) -> Dict[str, Any]:
+        """Call tool once per distinct arguments (failures are not cached)"""
+        key = (tool_name, tuple(sorted(kwargs.items())))
+        with self._lock:
+            cached = self._results.get(key)
+        if cached is not None:
+            return cached
+
+        result = self.toolbox.call_tool(tool_name, **kwargs)
+        if result.get("success"):
+            with self._lock:
+                self._results[key] = result
+        return result
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache shared across runs. Entries expire ttl seconds after
+    they are set (never when ttl is None); the least recently used entry is
+    evicted once more than maxsize are held.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expires_at or None, value), least recently used first
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return a fresh value, or default on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Store a value (ttl overrides the cache default for this entry)"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Drop an entry, returning its value (or default)"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[1] if entry is not None else default
+
+    def keys(self) -> List[Hashable]:
+        """Snapshot of the cached keys, expired ones included"""
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
 # GLOBAL INSTANCE
 _toolbox = None
 
@@ -9,9 +9,13 @@ from google.adk.sessions import Session # Import Session type for clarity
 
 # Assuming these tools are defined correctly elsewhere
 from agent_tools.fetch_transactions import fetch_transactions
-from agent_tools.categorization import categorize_transaction
+from agent_tools.categorization import (
+    categorize_transaction,
+    categorize_transactions_batch,
+    fetch_and_categorize_transactions,
+)
 from agent_tools.subscription_detector import detect_subscriptions
-from agent_tools.fraud_detector import detect_fraud
+from agent_tools.fraud_detector import detect_fraud, detect_fraud_batch
 from agent_tools.store_processed import store_processed_data
 
 logger = logging.getLogger(__name__)
@@ -25,8 +29,11 @@ agent1_data_processor = LlmAgent(
     model="gemini-flash-lite-latest",
     description="Agent 1: Data Processor for financial transactions, ",
     tools=[
+        FunctionTool(fetch_and_categorize_transactions),
         FunctionTool(fetch_transactions),
+        FunctionTool(categorize_transactions_batch),
         FunctionTool(categorize_transaction),
+        FunctionTool(detect_fraud_batch),
         FunctionTool(detect_fraud),
         FunctionTool(detect_subscriptions),
         FunctionTool(store_processed_data),
@@ -62,10 +69,13 @@ def process_user_transactions_agent1(user_id: str, limit: int = 50):
     prompt_text = f"""Process all unprocessed transactions for user: {user_id}
 
 Workflow:
-1. Fetch new transactions (limit: {limit})
-2. For each transaction:
-    a. Categorize it
-    b. Check for fraud
+1. Fetch and categorize new transactions in ONE call to fetch_and_categorize_transactions
+   (fall back to fetch_transactions with limit {limit} + categorize_transactions_batch if it fails)
+2. Check all of them for fraud in ONE call to detect_fraud_batch, passing its
+   "results" entries unchanged (they carry the AI category and standardized
+   merchant alongside the fetched "transaction" row). After the fallback, pass
+   the fetched rows with "category_ai" and "merchant_standardized" set from
+   the categorization results, never the bare fetched rows
 3. Detect subscription patterns
 4. Mark all as processed
 5. Provide summary
@@ -24,7 +24,8 @@ from agent_tools.financial_analyst_tools import (
     optimize_subscriptions,
     predict_spending_trends,
     generate_daily_summary,
-    save_recommendation
+    save_recommendation,
+    save_recommendations_bulk
 )
 
 logger = logging.getLogger(__name__)
@@ -50,6 +51,7 @@ agent2_financial_analyst = LlmAgent(
     3. Check subscription spending for optimization
     4. Look at spending trends to predict future issues
     5. Combine all insights into actionable recommendations
+    6. To store them, save all recommendations in one save_recommendations_bulk call
     
     When asked for a daily summary:
     1. Generate the daily summary for the requested date
@@ -65,6 +67,7 @@ agent2_financial_analyst = LlmAgent(
         FunctionTool(predict_spending_trends),
         FunctionTool(generate_daily_summary),
         FunctionTool(save_recommendation),
+        FunctionTool(save_recommendations_bulk),
     ]
 )
 
@@ -62,6 +62,7 @@ CREATE TABLE IF NOT EXISTS transactions (
 
 CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON transactions(user_id, date DESC);
 CREATE INDEX IF NOT EXISTS idx_transactions_status ON transactions(processing_status);
+CREATE INDEX IF NOT EXISTS idx_transactions_user_status_processed ON transactions(user_id, processing_status, last_processed_at);
 
 -- ==========================================================================
 -- PROCESSED TRANSACTIONS (AI-enhanced data)
@@ -3,6 +3,7 @@ Tests for Agent Tools (categorization, fraud detection, subscription detection)
 """
 import pytest
 from unittest.mock import patch, MagicMock, Mock
+import json
 import sys
 from pathlib import Path
 from datetime import datetime, timedelta
@@ -89,6 +90,158 @@ class TestCategorizationTool:
         
         assert "amazon" in result.get("merchant_standardized", "").lower()
         assert result["status"] == "success"
+    
+    def test_standardize_prefers_most_specific_merchant(self):
+        """Test that the longest matching merchant pattern wins"""
+        from agent_tools.categorization import _standardize_merchant_name
+        
+        assert _standardize_merchant_name("AMAZON PRIME*2K4LM") == "Amazon Prime"
+        assert _standardize_merchant_name("AMAZON.COM*MK1") == "Amazon"
+        assert _standardize_merchant_name("SQ *BLUE BOTTLE #123") == "Blue Bottle"
+    
+    def test_rules_short_keywords_match_whole_words(self):
+        """Test that short rule keywords don't match inside longer words"""
+        from agent_tools.categorization import _categorize_with_rules
+        
+        barber = _categorize_with_rules("JOES BARBER", "Joes Barber", -25.00, "haircut")
+        assert barber['category'] == "Personal Care"
+        
+        bar = _categorize_with_rules("CORNER BAR", "Corner Bar", -25.00, "")
+        assert bar['category'] == "Food & Dining"
+    
+    def test_categorize_known_merchant_skips_llm(self, mocker, mock_transaction):
+        """Test that a decisive rule match on a known merchant skips the LLM"""
+        # Mock toolbox
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.return_value = {"success": True}
+        mocker.patch('agent_tools.categorization.get_toolbox', return_value=mock_toolbox)
+        
+        # Mock LLM
+        mocker.patch('agent_tools.categorization.LLM_AVAILABLE', True)
+        mock_llm = MagicMock()
+        mocker.patch('agent_tools.categorization.llm_model', mock_llm, create=True)
+        
+        from agent_tools.categorization import categorize_transaction
+        
+        result = categorize_transaction(
+            transaction_id=mock_transaction["transaction_id"],
+            merchant_name="NETFLIX.COM",
+            amount=-15.99,
+            description="Netflix subscription",
+            user_id=mock_transaction["user_id"]
+        )
+        
+        assert result["status"] == "success"
+        assert result["category"] == "Subscriptions"
+        assert result["method"] == "rules"
+        mock_llm.generate_content.assert_not_called()
+    
+    def test_categorize_transactions_batch(self, mocker, mock_transactions_list):
+        """Test batch categorization of several transactions"""
+        # Mock toolbox
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.return_value = {"success": True}
+        mocker.patch('agent_tools.categorization.get_toolbox', return_value=mock_toolbox)
+        
+        mocker.patch('agent_tools.categorization.LLM_AVAILABLE', False)
+        
+        from agent_tools.categorization import categorize_transactions_batch
+        
+        result = categorize_transactions_batch(
+            transactions=mock_transactions_list,
+            user_id=mock_transactions_list[0]["user_id"]
+        )
+        
+        assert result["status"] == "success"
+        assert result["categorized_count"] == len(mock_transactions_list)
+        assert [r["transaction_id"] for r in result["results"]] == [
+            t["transaction_id"] for t in mock_transactions_list
+        ]
+        # All rows are stored with one multi-row insert
+        mock_toolbox.call_tool.assert_called_once()
+        assert mock_toolbox.call_tool.call_args[0][0] == "insert-processed-transactions-batch"
+    
+    def test_acategorize_transactions_concurrent(self, mocker, mock_transactions_list):
+        """Test concurrent async categorization keeps input order"""
+        import asyncio
+        
+        # Mock toolbox
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.return_value = {"success": True}
+        mocker.patch('agent_tools.categorization.get_toolbox', return_value=mock_toolbox)
+        
+        mocker.patch('agent_tools.categorization.LLM_AVAILABLE', False)
+        
+        from agent_tools.categorization import acategorize_transactions
+        
+        results = asyncio.run(acategorize_transactions(
+            transactions=mock_transactions_list,
+            user_id=mock_transactions_list[0]["user_id"],
+            max_concurrency=2
+        ))
+        
+        assert [r["status"] for r in results] == ["success"] * len(mock_transactions_list)
+        assert [r["transaction_id"] for r in results] == [
+            t["transaction_id"] for t in mock_transactions_list
+        ]
+    
+    def test_fetch_and_categorize_transactions_pipeline(self, mocker, mock_transactions_list):
+        """Test that paged fetching feeds categorization until the last page"""
+        import asyncio
+        
+        pages = [mock_transactions_list[:2], mock_transactions_list[2:]]
+        
+        def call_tool(tool_name, **kwargs):
+            if tool_name == "fetch-unprocessed-transactions-page":
+                return {"success": True, "data": pages.pop(0)}
+            return {"success": True}
+        
+        # Mock toolbox
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = call_tool
+        mocker.patch('agent_tools.categorization.get_toolbox', return_value=mock_toolbox)
+        mocker.patch('agent_tools.fetch_transactions.get_toolbox', return_value=mock_toolbox)
+        
+        mocker.patch('agent_tools.categorization.LLM_AVAILABLE', False)
+        
+        from agent_tools.categorization import fetch_and_categorize_transactions
+        
+        result = asyncio.run(fetch_and_categorize_transactions(
+            user_id=mock_transactions_list[0]["user_id"],
+            page_size=2,
+            max_concurrency=2
+        ))
+        
+        assert result["status"] == "success"
+        assert result["categorized_count"] == len(mock_transactions_list)
+        assert sorted(r["transaction_id"] for r in result["results"]) == sorted(
+            t["transaction_id"] for t in mock_transactions_list
+        )
+        # Second page continues after the last row of the first one
+        page_calls = [
+            c for c in mock_toolbox.call_tool.call_args_list
+            if c[0][0] == "fetch-unprocessed-transactions-page"
+        ]
+        assert len(page_calls) == 2
+        assert page_calls[1][1]["after_transaction_id"] == mock_transactions_list[1]["transaction_id"]
+        
+    
+    def test_streamed_json_drains_the_rest_of_the_stream(self):
+        """Test the stream is resolved after an early parse and an empty stream fails to parse"""
+        from agent_tools.categorization import _read_streamed_json
+        
+        response = MagicMock()
+        response.__iter__.return_value = iter([
+            MagicMock(text='{"category": '), MagicMock(text='"Groceries"}'), MagicMock(text='\n')
+        ])
+        
+        assert _read_streamed_json(response) == {"category": "Groceries"}
+        response.resolve.assert_called_once()
+        
+        empty = MagicMock()
+        empty.__iter__.return_value = iter([])
+        with pytest.raises(json.JSONDecodeError):
+            _read_streamed_json(empty)
 
 
 class TestFraudDetectionTool:
@@ -181,6 +334,554 @@ class TestFraudDetectionTool:
         
         assert result["status"] == "success"
         assert "is_anomaly" in result
+    
+    def test_detect_fraud_runs_lookups_concurrently(self, mocker, mock_transaction):
+        """Test the profile, history, merchant and velocity lookups overlap"""
+        import threading
+        
+        # Each first-wave lookup waits for the other three, so a sequential
+        # pipeline would break the barrier and lose their results
+        barrier = threading.Barrier(4, timeout=2)
+        responses = {
+            "get-user-profile": [{"monthly_income": 4000}],
+            "get-category-history": [],
+            "get-top-merchants": [{"merchant_standardized": "Amazon"}],
+            "get-user-transactions": [{}] * 5,
+        }
+        
+        def call_tool(name, **kwargs):
+            if name in responses:
+                barrier.wait()
+                return {"success": True, "data": responses[name]}
+            return {"success": True, "data": []}
+        
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = call_tool
+        mocker.patch('agent_tools.fraud_detector.get_toolbox', return_value=mock_toolbox)
+        mocker.patch('agent_tools.fraud_detector.LLM_AVAILABLE', False)
+        
+        from agent_tools.fraud_detector import detect_fraud, _profile_cache, _velocity_cache
+        _profile_cache.clear()
+        _velocity_cache.clear()
+        
+        result = detect_fraud(
+            transaction_id=mock_transaction["transaction_id"],
+            user_id=mock_transaction["user_id"],
+            amount=45.67,
+            merchant_name="Amazon",
+            transaction_date=mock_transaction["date"],
+            category="Shopping"
+        )
+        
+        assert result["status"] == "success"
+        assert result["user_income_percentile"] == round(45.67 / 4000 * 100, 2)
+        assert any("Card testing pattern: 5" in f for f in result["risk_factors"])
+        assert not any("New merchant" in f for f in result["risk_factors"])
+    
+    def test_detect_fraud_uses_fused_context_lookup(self, mocker, mock_transaction):
+        """Test one get-fraud-context call replaces the separate lookups"""
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = lambda name, **kwargs: {
+            "get-fraud-context": {"success": True, "data": [{
+                "profile": json.dumps({"monthly_income": 4000, "life_stage": "professional"}),
+                "category_history": [{"total_amount": 300, "transaction_count": 3}],
+                "current_count": 10,
+                "top_merchants": ["Costco"],
+                "recent_count": 5,
+            }]},
+            "insert-processed-transactions-batch": {"success": True},
+        }[name]
+        mocker.patch('agent_tools.fraud_detector.get_toolbox', return_value=mock_toolbox)
+        mocker.patch('agent_tools.fraud_detector.LLM_AVAILABLE', False)
+        
+        from agent_tools.fraud_detector import detect_fraud, flush_fraud_results, _profile_cache, _velocity_cache
+        _profile_cache.clear()
+        _velocity_cache.clear()
+        flush_fraud_results()
+        
+        result = detect_fraud(
+            transaction_id=mock_transaction["transaction_id"],
+            user_id=mock_transaction["user_id"],
+            amount=300.0,
+            merchant_name="Amazon",
+            transaction_date=mock_transaction["date"],
+            category="Shopping"
+        )
+        
+        assert flush_fraud_results()
+        tool_names = [c[0][0] for c in mock_toolbox.call_tool.call_args_list]
+        assert tool_names == ["get-fraud-context", "insert-processed-transactions-batch"]
+        assert result["user_income_percentile"] == 7.5
+        assert result["persisted"] is False
+        assert any("Card testing pattern: 5" in f for f in result["risk_factors"])
+        assert any("New merchant" in f for f in result["risk_factors"])
+        assert any("historical maximum" in f for f in result["risk_factors"])
+        assert any("Unusual spike" in f for f in result["risk_factors"])
+    
+    def test_detect_fraud_approves_trivial_purchases_without_lookups(self, mocker, mock_user_id):
+        """Test a tiny purchase at a legitimate merchant skips the analysis for a cached profile"""
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.return_value = {"success": True, "data": []}
+        mocker.patch('agent_tools.fraud_detector.get_toolbox', return_value=mock_toolbox)
+        mocker.patch('agent_tools.fraud_detector.LLM_AVAILABLE', False)
+        
+        from agent_tools.fraud_detector import (
+            detect_fraud, flush_fraud_results, _cache_profile, _profile_cache
+        )
+        _profile_cache.clear()
+        flush_fraud_results()
+        _cache_profile(mock_user_id, {"monthly_income": 10000, "life_stage": "professional"})
+        
+        def check(txn_id, merchant, amount, category):
+            return detect_fraud(
+                transaction_id=txn_id, user_id=mock_user_id, amount=amount,
+                merchant_name=merchant, transaction_date="2024-12-01", category=category
+            )
+        
+        result = check("txn_small", "Whole Foods Market", 18.50, "Groceries")
+        assert result["risk_level"] == "low"
+        assert result["detection_method"] == "trivial-amount"
+        assert mock_toolbox.call_tool.call_count == 0
+        
+        # Too large, not a known merchant, or a riskier category: full analysis
+        check("txn_large", "Whole Foods Market", 80.0, "Groceries")
+        check("txn_unknown", "Corner Bakery", 5.0, "Food & Dining")
+        check("txn_travel", "Marriott", 18.50, "Travel")
+        tool_names = [c[0][0] for c in mock_toolbox.call_tool.call_args_list]
+        assert tool_names.count("get-fraud-context") == 3
+        
+        assert flush_fraud_results()
+        rows = json.loads(mock_toolbox.call_tool.call_args_list[-1][1]["rows"])
+        assert [r["transaction_id"] for r in rows] == ["txn_small", "txn_large", "txn_unknown", "txn_travel"]
+    
+    def test_result_writer_stores_rows_in_batches(self):
+        """Test queued rows are stored with one multi-row insert per flush"""
+        from agent_tools.fraud_detector import ResultWriter
+        
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.return_value = {"success": True}
+        writer = ResultWriter(flush_every=3, flush_interval=60)
+        
+        for txn_id, score in [("t1", "10.00"), ("t2", "20.00"), ("t1", "15.00")]:
+            writer.enqueue(mock_toolbox, {"transaction_id": txn_id, "anomaly_score": score})
+        assert mock_toolbox.call_tool.call_count == 0
+        
+        writer.enqueue(mock_toolbox, {"transaction_id": "t3", "anomaly_score": "30.00"})
+        writer.enqueue(mock_toolbox, {"transaction_id": "t4", "anomaly_score": "40.00"})
+        assert writer.flush()
+        
+        batches = [json.loads(c[1]["rows"]) for c in mock_toolbox.call_tool.call_args_list]
+        assert [[r["transaction_id"] for r in rows] for rows in batches] == [["t2", "t1", "t3"], ["t4"]]
+        assert batches[0][1]["anomaly_score"] == "15.00"
+    
+    def test_result_writer_keeps_rows_after_a_failed_insert(self):
+        """Test a failed flush leaves its rows queued for the next flush"""
+        from agent_tools.fraud_detector import ResultWriter
+        
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = [
+            {"success": False, "error": "connection lost"},
+            {"success": True},
+        ]
+        writer = ResultWriter(flush_every=10, flush_interval=60)
+        
+        writer.enqueue(mock_toolbox, {"transaction_id": "t1", "anomaly_score": "10.00"})
+        writer.enqueue(mock_toolbox, {"transaction_id": "t2", "anomaly_score": "20.00"})
+        assert not writer.flush()
+        
+        writer.enqueue(mock_toolbox, {"transaction_id": "t2", "anomaly_score": "25.00"})
+        assert writer.flush()
+        
+        rows = json.loads(mock_toolbox.call_tool.call_args_list[-1][1]["rows"])
+        assert [(r["transaction_id"], r["anomaly_score"]) for r in rows] == [("t1", "10.00"), ("t2", "25.00")]
+        assert writer.flush()
+        assert mock_toolbox.call_tool.call_count == 2
+    
+    def test_velocity_counts_reuse_the_fetched_window(self):
+        """Test later velocity checks in a fetched window are answered in memory"""
+        from agent_tools.fraud_detector import _count_recent_transactions, _velocity_cache
+        _velocity_cache.clear()
+        
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.return_value = {"success": True, "data": [
+            {"transaction_id": "t1", "date": "2024-12-01"},
+            {"transaction_id": "t2", "date": "2024-12-01"},
+        ]}
+        
+        def count(transaction_id):
+            return _count_recent_transactions(
+                "user_123", datetime(2024, 12, 1, 15), mock_toolbox, transaction_id
+            )
+        
+        assert count("t2") == 2
+        assert count("t3") == 3  # scored since the fetch, added to the window
+        assert count("t3") == 3
+        assert mock_toolbox.call_tool.call_count == 1
+    
+    def test_detect_fraud_counts_velocity_from_cached_window(self, mocker, mock_user_id):
+        """Test a cached velocity window supplies the count over the fused context's"""
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = lambda name, **kwargs: {
+            "get-fraud-context": {"success": True, "data": [{
+                "profile": None, "category_history": [], "current_count": None,
+                "top_merchants": ["Amazon"], "recent_count": 0,
+            }]},
+            "get-user-transactions": {"success": True, "data": [
+                {"transaction_id": f"t{i}", "date": "2024-12-01"} for i in range(4)
+            ]},
+        }[name]
+        mocker.patch('agent_tools.fraud_detector.get_toolbox', return_value=mock_toolbox)
+        mocker.patch('agent_tools.fraud_detector._result_writer')
+        mocker.patch('agent_tools.fraud_detector.LLM_AVAILABLE', False)
+        
+        from agent_tools.fraud_detector import (
+            detect_fraud, _count_recent_transactions, _profile_cache, _velocity_cache
+        )
+        _profile_cache.clear()
+        _velocity_cache.clear()
+        _count_recent_transactions(mock_user_id, datetime(2024, 12, 1, 15), mock_toolbox)
+        
+        result = detect_fraud(
+            transaction_id="t_new", user_id=mock_user_id, amount=20.0,
+            merchant_name="Amazon", transaction_date="2024-12-01T15:30:00", category="Shopping"
+        )
+        
+        assert any("Card testing pattern: 5" in f for f in result["risk_factors"])
+    
+    def test_detect_fraud_batch_fetches_once_per_batch(self, mocker):
+        """Test batch fraud detection does one lookup per data set and one insert"""
+        import asyncio
+        
+        now = datetime.now()
+        responses = {
+            "get-user-profiles-bulk": [
+                {"id": "user_a", "monthly_income": 4000},
+                {"id": "user_b", "monthly_income": 400},
+            ],
+            "get-top-merchants-bulk": [
+                {"user_id": "user_a", "merchant_standardized": "Amazon"},
+                {"user_id": "user_b", "merchant_standardized": "Costco"},
+            ],
+            "get-category-history-bulk": [
+                {"user_id": "user_a", "category": "Shopping", "year": now.year, "month": now.month,
+                 "total_amount": 100, "transaction_count": 10},
+            ],
+            "get-user-transactions": [],
+            "insert-processed-transactions-batch": [],
+        }
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = lambda name, **kwargs: {
+            "success": True, "data": responses[name]
+        }
+        mocker.patch('agent_tools.fraud_detector.get_toolbox', return_value=mock_toolbox)
+        mocker.patch('agent_tools.fraud_detector.LLM_AVAILABLE', False)
+        
+        from agent_tools.fraud_detector import detect_fraud_batch, _profile_cache, _velocity_cache
+        from agent_tools.toolbox_wrapper import ToolboxCache
+        _profile_cache.clear()
+        _velocity_cache.clear()
+        cached_calls = mocker.spy(ToolboxCache, 'call_tool')
+        
+        transactions = [
+            {"transaction_id": f"txn_{i}", "user_id": user_id, "amount": -25.0,
+             "merchant_name": "Amazon", "date": "2024-12-01", "category": "Shopping"}
+            for i, user_id in enumerate(["user_a", "user_a", "user_b", "user_a"])
+        ]
+        result = asyncio.run(detect_fraud_batch(transactions))
+        
+        assert result["status"] == "success"
+        assert result["analyzed_count"] == 4
+        
+        tool_names = [c[0][0] for c in mock_toolbox.call_tool.call_args_list]
+        for name in ("get-user-profiles-bulk", "get-top-merchants-bulk",
+                     "get-category-history-bulk", "insert-processed-transactions-batch"):
+            assert tool_names.count(name) == 1
+        # The insert is a write, so it skips the memoizing toolbox
+        assert "insert-processed-transactions-batch" not in [c.args[1] for c in cached_calls.call_args_list]
+        assert tool_names.count("get-user-transactions") == 2  # once per user
+        assert "insert-processed-transaction" not in tool_names
+        
+        # user_b doesn't know Amazon, user_a does
+        by_id = {r["transaction_id"]: r for r in result["results"]}
+        assert any("New merchant" in f for f in by_id["txn_2"]["risk_factors"])
+        assert not any("New merchant" in f for f in by_id["txn_0"]["risk_factors"])
+        
+        rows = json.loads(mock_toolbox.call_tool.call_args_list[-1][1]["rows"])
+        assert [r["transaction_id"] for r in rows] == ["txn_0", "txn_1", "txn_2", "txn_3"]
+    
+    def test_detect_fraud_batch_uses_categorization_of_fetch_and_categorize_rows(self, mocker):
+        """Test that categorized fields win over the raw fetched row's bank columns"""
+        import asyncio
+        
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.return_value = {"success": True, "data": []}
+        mocker.patch('agent_tools.fraud_detector.get_toolbox', return_value=mock_toolbox)
+        mocker.patch('agent_tools.fraud_detector.LLM_AVAILABLE', False)
+        
+        from agent_tools.fraud_detector import detect_fraud_batch, _profile_cache, _velocity_cache
+        _profile_cache.clear()
+        _velocity_cache.clear()
+        
+        # One entry of fetch_and_categorize_transactions()["results"]
+        categorized = {
+            "status": "success",
+            "transaction_id": "txn_1",
+            "category": "Food & Dining",
+            "merchant_standardized": "Starbucks",
+            "transaction": {
+                "transaction_id": "txn_1", "user_id": "user_a", "amount": -6.5,
+                "merchant_name": "STARBUCKS #1234", "date": "2024-12-01",
+                "category": "FOOD_AND_DRINK"
+            }
+        }
+        result = asyncio.run(detect_fraud_batch([categorized]))
+        
+        assert result["analyzed_count"] == 1
+        insert = next(c for c in mock_toolbox.call_tool.call_args_list
+                      if c[0][0] == "insert-processed-transactions-batch")
+        row = json.loads(insert[1]["rows"])[0]
+        assert row["user_id"] == "user_a"
+        assert row["category_ai"] == "Food & Dining"
+        assert row["merchant_standardized"] == "Starbucks"
+    
+    def test_detect_fraud_batch_fallback_queries_each_user_once(self, mocker):
+        """Test per-user fallbacks share lookups when the bulk tools are missing"""
+        import asyncio
+        
+        bulk_tools = {"get-user-profiles-bulk", "get-top-merchants-bulk", "get-category-history-bulk"}
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = lambda name, **kwargs: (
+            {"success": False, "error": "unknown tool", "data": None} if name in bulk_tools
+            else {"success": True, "data": []}
+        )
+        mocker.patch('agent_tools.fraud_detector.get_toolbox', return_value=mock_toolbox)
+        mocker.patch('agent_tools.fraud_detector.LLM_AVAILABLE', False)
+        
+        from agent_tools.fraud_detector import detect_fraud_batch, _profile_cache, _velocity_cache
+        _profile_cache.clear()
+        _velocity_cache.clear()
+        
+        transactions = [
+            {"transaction_id": f"txn_{i}", "user_id": "user_a", "amount": 25.0,
+             "merchant_name": "Amazon", "date": "2024-12-01", "category": "Shopping"}
+            for i in range(5)
+        ]
+        result = asyncio.run(detect_fraud_batch(transactions))
+        
+        assert result["analyzed_count"] == 5
+        tool_names = [c[0][0] for c in mock_toolbox.call_tool.call_args_list]
+        for name in ("get-user-profile", "get-top-merchants", "get-category-history",
+                     "get-current-month-spending", "get-user-transactions"):
+            assert tool_names.count(name) == 1
+    
+    def test_detect_fraud_batch_reviews_risky_rows_concurrently(self, mocker):
+        """Test the batch sends only risky rows to the async LLM review"""
+        import asyncio
+        from unittest.mock import AsyncMock
+        
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.return_value = {"success": True, "data": []}
+        mocker.patch('agent_tools.fraud_detector.get_toolbox', return_value=mock_toolbox)
+        
+        mocker.patch('agent_tools.fraud_detector.LLM_AVAILABLE', True)
+        mocker.patch('agent_tools.fraud_detector.genai', MagicMock(), create=True)
+        mock_llm = MagicMock()
+        mock_llm.generate_content_async = AsyncMock(return_value=MagicMock(
+            text='{"fraud_risk_adjustment": 10, "concerns": ["unknown merchant"], "reasoning": "r"}'
+        ))
+        mocker.patch('agent_tools.fraud_detector.llm_model', mock_llm, create=True)
+        
+        from agent_tools.fraud_detector import detect_fraud_batch, _profile_cache, _velocity_cache, _llm_cache
+        _profile_cache.clear()
+        _velocity_cache.clear()
+        _llm_cache.clear()
+        
+        transactions = [
+            {"transaction_id": "txn_small", "user_id": "user_a", "amount": 20.0,
+             "merchant_name": "Cafe", "date": "2024-12-01", "category": "Food & Dining"},
+            {"transaction_id": "txn_large_1", "user_id": "user_a", "amount": 3000.0,
+             "merchant_name": "Crypto Exchange", "date": "2024-12-01", "category": "Other"},
+            {"transaction_id": "txn_large_2", "user_id": "user_b", "amount": 2500.0,
+             "merchant_name": "Gift Cards Plus", "date": "2024-12-01", "category": "Other"},
+            {"transaction_id": "txn_large_3", "user_id": "user_b", "amount": 2600.0,
+             "merchant_name": "Gift Cards Plus", "date": "2024-12-01", "category": "Other"},
+        ]
+        result = asyncio.run(detect_fraud_batch(transactions))
+        
+        assert result["status"] == "success"
+        assert mock_llm.generate_content_async.await_count == 2
+        mock_llm.generate_content.assert_not_called()
+        by_id = {r["transaction_id"]: r for r in result["results"]}
+        assert "llm" in by_id["txn_large_1"]["detection_method"]
+        assert "llm" not in by_id["txn_small"]["detection_method"]
+        # Same merchant signature -> one review shared by both rows
+        assert "llm" in by_id["txn_large_3"]["detection_method"]
+    
+    def test_llm_review_is_cached_by_merchant_signature(self, mocker):
+        """Test similar transactions at the same merchant reuse one LLM review"""
+        mocker.patch('agent_tools.fraud_detector.LLM_AVAILABLE', True)
+        mocker.patch('agent_tools.fraud_detector.genai', MagicMock(), create=True)
+        mock_llm = MagicMock()
+        mock_llm.generate_content.return_value = MagicMock(
+            text='{"fraud_risk_adjustment": -10, "concerns": [], "merchant_reputation": "legitimate"}'
+        )
+        mocker.patch('agent_tools.fraud_detector.llm_model', mock_llm, create=True)
+        
+        from agent_tools.fraud_detector import UserContext, _analyze_with_llm, _llm_cache
+        _llm_cache.clear()
+        
+        def review(merchant, amount, when):
+            ctx = UserContext.from_profile({"monthly_income": 5000}, amount)
+            return _analyze_with_llm(merchant, amount, "Shopping", when, ctx)
+        
+        first = review("Apple", 999.0, datetime(2024, 12, 1, 14))
+        second = review("APPLE", 950.0, datetime(2024, 12, 3, 15, 30))
+        other = review("Apple", 999.0, datetime(2024, 12, 1, 3))
+        
+        assert first["score_adjustment"] == second["score_adjustment"] == other["score_adjustment"] == -10
+        # The 3 AM purchase falls in a different time block
+        assert mock_llm.generate_content.call_count == 2
+    
+    def test_llm_review_skipped_when_score_is_decisive(self, mocker):
+        """Test scores the LLM adjustment can't move out of "high" skip the review"""
+        mocker.patch('agent_tools.fraud_detector.LLM_AVAILABLE', True)
+        mocker.patch('agent_tools.fraud_detector.genai', MagicMock(), create=True)
+        mock_llm = MagicMock()
+        mock_llm.generate_content.return_value = MagicMock(text='{"fraud_risk_adjustment": -50}')
+        mocker.patch('agent_tools.fraud_detector.llm_model', mock_llm, create=True)
+        
+        from agent_tools.fraud_detector import UserContext, _assess_transaction, _llm_cache
+        _llm_cache.clear()
+        
+        def assess(score):
+            mocker.patch(
+                'agent_tools.fraud_detector._score_transaction',
+                return_value={'risk_score': score, 'risk_factors': [], 'detection_methods': []}
+            )
+            result, _ = _assess_transaction(
+                "txn", "user", 100.0, f"Merchant {score}", None, "Shopping",
+                UserContext.from_profile(None, 100.0), None, None, None
+            )
+            return result
+        
+        assert assess(95)["risk_level"] == "high"
+        assert assess(20)["risk_level"] == "low"
+        assert mock_llm.generate_content.call_count == 0
+        
+        # An adjustment outside the prompt's range is clamped to -10
+        assert assess(80)["risk_score"] == 70
+        assert mock_llm.generate_content.call_count == 1
+    
+    def test_llm_prompt_carries_only_the_transaction(self):
+        """Test the few-shot instructions live in the system prompt, not each request"""
+        from agent_tools.fraud_detector import FRAUD_SYSTEM_PROMPT, UserContext, _build_llm_prompt
+        
+        prompt = _build_llm_prompt(
+            "Gift Card Depot", 500.0, "Shopping", datetime(2024, 12, 6, 23),
+            UserContext.from_profile({"monthly_income": 5000}, 500.0)
+        )
+        
+        assert "Merchant: Gift Card Depot" in prompt
+        assert "Day: Friday" in prompt
+        assert "10.0%" in prompt
+        assert "Examples" not in prompt
+        assert "Examples" in FRAUD_SYSTEM_PROMPT
+    
+    def test_rules_match_merchant_lists(self):
+        """Test the high-risk and legitimate merchant patterns adjust the rule score"""
+        from agent_tools.fraud_detector import UserContext, _analyze_with_rules
+        
+        def score(merchant):
+            return _analyze_with_rules(40.0, merchant, datetime(2024, 12, 1), "Shopping", UserContext.from_profile(None, 40.0))['score']
+        
+        assert score("Joe's Crypto ATM") == 25
+        assert score("Best Buy Electronics") == 15  # high-risk category at a legitimate merchant
+        assert score("Whole Foods Market") == -10
+        assert score("Corner Bakery") == 0
+    
+    def test_rules_flag_round_amounts_in_cents(self):
+        """Test round amounts are matched on cents, not exact float equality"""
+        from agent_tools.fraud_detector import UserContext, _analyze_with_rules
+        
+        def score(amount):
+            return _analyze_with_rules(amount, "Corner Bakery", datetime(2024, 12, 1), "Shopping", UserContext.from_profile(None, amount))['score']
+        
+        assert score(sum([0.1] * 200)) == 5  # 20.000000000000004
+        assert score(100.0) == 5
+        assert score(100.01) == 0
+        assert score(7.0) == 0
+    
+    def test_history_stats_bulk_matches_per_history_stats(self):
+        """Test the vectorized batch statistics agree with the per-history loop"""
+        from agent_tools.fraud_detector import _history_stats, _history_stats_bulk
+        
+        histories = {
+            ("u1", "Shopping"): [
+                {"total_amount": 300, "transaction_count": 3},
+                {"total_amount": 0, "transaction_count": 0},
+                {"total_amount": 500, "transaction_count": 2},
+            ],
+            ("u1", "Travel"): [{"total_amount": 0, "transaction_count": 0}],
+            ("u2", "Dining"): [{"total_amount": 90, "transaction_count": 9}],
+        }
+        
+        stats = _history_stats_bulk(histories)
+        
+        assert stats.keys() == histories.keys()
+        for key, rows in histories.items():
+            assert stats[key] == pytest.approx(_history_stats(rows))
+        assert stats[("u1", "Shopping")] == pytest.approx((175.0, 250.0, 5 / 3))
+        assert stats[("u1", "Travel")] == (None, None, 0.0)
+    
+    def test_bulk_profile_scoring_matches_per_row(self):
+        """Test the vectorized profile thresholds give the per-row scores and factors"""
+        from agent_tools.fraud_detector import (
+            UserContext, _analyze_with_user_profile, _analyze_with_user_profile_bulk
+        )
+        
+        profiles = [
+            None,
+            {"monthly_income": 0},
+            {"monthly_income": 3000, "life_stage": "student", "dependents": 0},
+            {"monthly_income": 6000, "life_stage": "professional", "dependents": 2},
+            {"monthly_income": 4000, "life_stage": "Retired", "dependents": 0,
+             "budget_alert_threshold": 0.8},
+            {"monthly_income": 9000, "life_stage": None, "budget_alert_threshold": 1.0},
+        ]
+        amounts = [25.0, 150.0, 250.0, 301.0, 599.99, 650.0, 1000.0, 2500.0]
+        categories = ["Shopping", "Groceries", "Education", "Travel"]
+        
+        rows = [
+            (UserContext.from_profile(profile, amount), amount, category)
+            for profile in profiles for amount in amounts for category in categories
+        ]
+        bulk = _analyze_with_user_profile_bulk(
+            [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows]
+        )
+        
+        assert bulk == [
+            _analyze_with_user_profile(ctx, amount, category, None)
+            for ctx, amount, category in rows
+        ]
+    
+    def test_user_profile_is_cached(self, mocker, mock_user_id):
+        """Test profiles (and missing profiles) are fetched once until invalidated"""
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.return_value = {"success": True, "data": [{"monthly_income": 4000}]}
+        mocker.patch('agent_tools.fraud_detector.get_toolbox', return_value=mock_toolbox)
+        
+        from agent_tools.fraud_detector import _get_user_profile, invalidate_user_profile, _profile_cache
+        _profile_cache.clear()
+        
+        assert _get_user_profile(mock_user_id)["monthly_income"] == 4000
+        assert _get_user_profile(mock_user_id)["monthly_income"] == 4000
+        assert mock_toolbox.call_tool.call_count == 1
+        
+        invalidate_user_profile(mock_user_id)
+        mock_toolbox.call_tool.return_value = {"success": True, "data": []}
+        assert _get_user_profile(mock_user_id) is None
+        assert _get_user_profile(mock_user_id) is None
+        assert mock_toolbox.call_tool.call_count == 2
 
 
 class TestSubscriptionDetectionTool:
@@ -248,6 +949,116 @@ class TestSubscriptionDetectionTool:
                           for sub in subscriptions)
         assert spotify_found
     
+    def test_detect_subscriptions_stores_all_in_one_batch(self, mocker):
+        """Test that detected subscriptions are upserted with a single batch call"""
+        transactions = [
+            {
+                "transaction_id": f"{merchant}_{i}",
+                "user_id": "user_123",
+                "amount": amount,
+                "merchant_name": merchant,
+                "date": (datetime.now() - timedelta(days=30*i)).strftime("%Y-%m-%d")
+            }
+            for merchant, amount in (("SPOTIFY", -9.99), ("NETFLIX", -15.99))
+            for i in range(4)
+        ]
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = lambda name, **kwargs: (
+            {"success": True, "data": transactions}
+            if name == "get-user-transactions" else {"success": True}
+        )
+        mocker.patch('agent_tools.subscription_detector.get_toolbox', return_value=mock_toolbox)
+        
+        mocker.patch('agent_tools.subscription_detector.LLM_AVAILABLE', False)
+        
+        from agent_tools.subscription_detector import detect_subscriptions
+        
+        result = detect_subscriptions(user_id="user_123")
+        
+        tool_names = [c.args[0] for c in mock_toolbox.call_tool.call_args_list]
+        assert tool_names == ["get-user-transactions", "upsert-subscriptions-batch"]
+        batch_kwargs = mock_toolbox.call_tool.call_args_list[1].kwargs
+        assert batch_kwargs["user_id"] == "user_123"
+        rows = json.loads(batch_kwargs["rows"])
+        assert [row["merchant_name"] for row in rows] == ["SPOTIFY", "NETFLIX"]
+        assert [sub["merchant"] for sub in result["subscriptions"]] == ["Spotify", "Netflix"]
+    
+    def test_detect_subscriptions_collapses_same_standardized_merchant(self, mocker):
+        """Test that merchants standardizing to one name are stored and reported once"""
+        transactions = [
+            {
+                "transaction_id": f"{merchant}_{i}",
+                "user_id": "user_123",
+                "amount": amount,
+                "merchant_name": merchant,
+                "date": (datetime.now() - timedelta(days=30*i)).strftime("%Y-%m-%d")
+            }
+            for merchant, amount in (("SPOTIFY #123", -9.99), ("SPOTIFY #456", -10.99))
+            for i in range(4)
+        ]
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = lambda name, **kwargs: (
+            {"success": True, "data": transactions}
+            if name == "get-user-transactions" else {"success": True}
+        )
+        mocker.patch('agent_tools.subscription_detector.get_toolbox', return_value=mock_toolbox)
+        
+        mocker.patch('agent_tools.subscription_detector.LLM_AVAILABLE', False)
+        
+        from agent_tools.subscription_detector import detect_subscriptions
+        
+        result = detect_subscriptions(user_id="user_123")
+        
+        rows = json.loads(mock_toolbox.call_tool.call_args_list[1].kwargs["rows"])
+        assert [row["merchant_name"] for row in rows] == ["SPOTIFY #456"]
+        assert result["subscriptions_detected"] == 1
+        assert result["subscriptions"][0]["merchant"] == "Spotify"
+    
+    def test_pattern_stats_numpy_matches_loop(self):
+        """Test that the NumPy pattern statistics match the plain loop"""
+        from agent_tools.subscription_detector import (
+            _amount_stats, _amount_stats_numpy, _interval_stats, _interval_stats_numpy
+        )
+        
+        transactions = [
+            {"amount": -10.0 - (i % 3) * 0.1, "date": (datetime(2024, 1, 1) + timedelta(days=30*i + i % 4)).strftime("%Y-%m-%d")}
+            for i in range(80)
+        ]
+        transactions.insert(5, {"amount": -10.0, "date": "not-a-date"})
+        
+        assert _amount_stats_numpy(transactions) == pytest.approx(_amount_stats(transactions))
+        assert _interval_stats_numpy(transactions) == pytest.approx(_interval_stats(transactions))
+    
+    def test_pattern_rejects_inconsistent_amounts_before_parsing_dates(self, mocker):
+        """Test that the amount check short-circuits date parsing"""
+        import agent_tools.subscription_detector as detector
+        
+        parse_date = mocker.spy(detector, '_parse_date')
+        transactions = [
+            {"amount": -10.0, "date": "2024-01-01"},
+            {"amount": -25.0, "date": "2024-02-01"},
+            {"amount": -10.0, "date": "2024-03-01"}
+        ]
+        
+        assert detector._analyze_pattern("CORNER STORE", transactions) is None
+        assert parse_date.call_count == 0
+    
+    def test_known_subscription_match_prefers_first_listed_name(self):
+        """Test that a merchant naming two services resolves like the dict scan"""
+        from agent_tools.subscription_detector import _match_known_subscription
+        
+        known_name, sub_info = _match_known_subscription("hulu spotify bundle")
+        
+        assert known_name == "spotify"
+        assert sub_info["type"] == "streaming"
+        # 'disney' is listed before 'disney+' and is contained in it
+        assert _match_known_subscription("disney+ monthly")[0] == "disney"
+        assert _match_known_subscription("whole foods market") is None
+        
+        hits = _match_known_subscription.cache_info().hits
+        _match_known_subscription("hulu spotify bundle")
+        assert _match_known_subscription.cache_info().hits == hits + 1
+    
     def test_detect_subscriptions_with_llm(self, mocker):
         """Test subscription detection with LLM"""
         # Mock toolbox
@@ -281,6 +1092,68 @@ class TestSubscriptionDetectionTool:
         
         assert result["status"] == "success"
 
+    
+    def test_detect_subscriptions_batches_llm_calls(self, mocker):
+        """Test that every merchant is classified by one batched LLM prompt"""
+        transactions = [
+            {"transaction_id": "t1", "user_id": "user_123", "amount": -42.30,
+             "merchant_name": "CORNER BAKERY", "date": datetime.now().strftime("%Y-%m-%d")},
+            {"transaction_id": "t2", "user_id": "user_123", "amount": -19.99,
+             "merchant_name": "MASTERCLASS", "date": datetime.now().strftime("%Y-%m-%d")}
+        ]
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = lambda name, **kwargs: (
+            {"success": True, "data": transactions}
+            if name == "get-user-transactions" else {"success": True}
+        )
+        mocker.patch('agent_tools.subscription_detector.get_toolbox', return_value=mock_toolbox)
+        
+        mocker.patch('agent_tools.subscription_detector.LLM_AVAILABLE', True)
+        mock_llm = MagicMock()
+        mock_llm.generate_content.return_value.text = json.dumps([
+            {"index": 1, "merchant": "CORNER BAKERY", "is_subscription": False, "confidence": 0.9},
+            {"index": 2, "merchant": "MASTERCLASS", "is_subscription": True, "confidence": 0.9,
+             "subscription_type": "other", "expected_frequency": "yearly"}
+        ])
+        mocker.patch('agent_tools.subscription_detector.llm_model', mock_llm, create=True)
+        
+        from agent_tools.subscription_detector import detect_subscriptions, _llm_cache
+        _llm_cache.clear()
+        
+        result = detect_subscriptions(user_id="user_123")
+        
+        assert mock_llm.generate_content.call_count == 1
+        prompt = mock_llm.generate_content.call_args.args[0]
+        assert "1. Merchant: CORNER BAKERY" in prompt
+        assert "2. Merchant: MASTERCLASS" in prompt
+        assert [(sub["merchant"], sub["frequency"]) for sub in result["subscriptions"]] == [("Masterclass", "yearly")]
+    
+    def test_llm_classifications_are_reused_across_users(self, mocker):
+        """Test that a merchant classified for one user skips the LLM for the next"""
+        mocker.patch('agent_tools.subscription_detector.LLM_AVAILABLE', True)
+        mock_llm = MagicMock()
+        mock_llm.generate_content.return_value.text = json.dumps([
+            {"index": 1, "merchant": "MASTERCLASS", "is_subscription": True, "confidence": 0.9,
+             "subscription_type": "other", "expected_frequency": "yearly"},
+            {"index": 2, "merchant": "CORNER BAKERY", "is_subscription": False, "confidence": 0.9}
+        ])
+        mocker.patch('agent_tools.subscription_detector.llm_model', mock_llm, create=True)
+        
+        from agent_tools.subscription_detector import _analyze_batch_with_llm, _llm_cache
+        _llm_cache.clear()
+        
+        candidates = [
+            ("MASTERCLASS", [{"amount": -19.99, "date": "2024-01-01"}]),
+            ("CORNER BAKERY", [{"amount": -4.50, "date": "2024-01-02"}])
+        ]
+        first = _analyze_batch_with_llm(candidates)
+        second = _analyze_batch_with_llm(candidates)
+        
+        assert mock_llm.generate_content.call_count == 1
+        assert first == second
+        assert second[0]["frequency"] == "yearly"
+        assert second[0]["amount"] == pytest.approx(19.99)
+        assert second[1] is None
 
 class TestFetchTransactionsTool:
     """Tests for fetch transactions tool"""
@@ -333,3 +1206,504 @@ class TestStoreProcessedTool:
         
         assert result["status"] == "success"
         assert "processed_count" in result
+
+    
+    def test_store_processed_ignores_batch_in_concurrent_stuck_lookup(self, mocker):
+        """Test that transactions finalized by this call are not reported as stuck"""
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = lambda name, **kwargs: (
+            {"success": True, "data": [{"transaction_id": "txn_1"}, {"transaction_id": "txn_old"}]}
+            if name == "find-stuck-transactions" else {"success": True, "data": []}
+        )
+        mocker.patch('agent_tools.store_processed.get_toolbox', return_value=mock_toolbox)
+        
+        from agent_tools.store_processed import store_processed_data
+        
+        result = store_processed_data(transaction_ids=["txn_1", "txn_2"], user_id="user_123")
+        
+        tool_names = {c.args[0] for c in mock_toolbox.call_tool.call_args_list}
+        assert {"mark-transactions-complete", "find-stuck-transactions"} <= tool_names
+        assert result["processed_count"] == 2
+        assert result["stuck_transactions"] == ["txn_old"]
+    
+    def test_store_processed_invalidates_cached_histories(self, mocker):
+        """Test that storing a batch drops the user's cached category histories"""
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.return_value = {"success": True, "data": []}
+        mocker.patch('agent_tools.store_processed.get_toolbox', return_value=mock_toolbox)
+        
+        from agent_tools import financial_analyst_tools
+        from agent_tools.store_processed import store_processed_data
+        
+        financial_analyst_tools._history_cache.clear()
+        financial_analyst_tools._store_cached(("user_123", "Dining", 3), [100.0])
+        financial_analyst_tools._store_cached(("user_456", "Dining", 3), [50.0])
+        
+        store_processed_data(transaction_ids=["txn_1"], user_id="user_123")
+        
+        assert financial_analyst_tools._get_cached(("user_123", "Dining", 3)) is None
+        assert financial_analyst_tools._get_cached(("user_456", "Dining", 3)) == [50.0]
+    
+    def test_store_processed_uses_fused_finalization_context(self, mocker):
+        """Test that stuck transactions and batch stats come from one lookup"""
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = lambda name, **kwargs: (
+            {"success": True, "data": [{
+                "stuck": '["txn_old"]',
+                "anomaly_count": 1,
+                "subscription_count": 0,
+                "category_breakdown": '{"Dining": 2}'
+            }]}
+            if name == "get-finalization-context" else {"success": True, "data": []}
+        )
+        mocker.patch('agent_tools.store_processed.get_toolbox', return_value=mock_toolbox)
+        audit = mocker.patch('agent_tools.store_processed._log_processing_completion')
+        
+        from agent_tools.store_processed import store_processed_data
+        
+        result = store_processed_data(transaction_ids=["txn_1", "txn_2"], user_id="user_123")
+        
+        tool_names = [c.args[0] for c in mock_toolbox.call_tool.call_args_list]
+        assert "find-stuck-transactions" not in tool_names
+        assert result["stuck_transactions"] == ["txn_old"]
+        stats = audit.call_args.kwargs["summary"]
+        assert stats["anomaly_count"] == 1
+        assert stats["category_breakdown"] == {"Dining": 2}
+
+class TestFinancialAnalystAgent:
+    """Tests for the financial analyst agent"""
+    
+    def _mock_toolbox_client(self, mocker, responses):
+        """Patch ToolboxSyncClient so each tool returns responses[name]; returns the call log"""
+        calls = []
+        
+        def load_tool(name):
+            def tool(**kwargs):
+                calls.append((name, kwargs))
+                return responses.get(name)
+            return tool
+        
+        mock_client = MagicMock()
+        mock_client.load_tool.side_effect = load_tool
+        mocker.patch('agent_tools.financial_analyst.ToolboxSyncClient', return_value=mock_client)
+        # Start every test with an empty recommendations cache
+        from agent_tools import financial_analyst
+        financial_analyst._recommendations_cache.clear()
+        financial_analyst._spending_snapshots.clear()
+        return calls
+    
+    def test_generate_recommendations_fetches_history_once_per_category(self, mocker, mock_user_id):
+        """Test that all stages share one category history fetch per category"""
+        calls = self._mock_toolbox_client(mocker, {
+            "get-current-month-spending": [
+                {"category": "Dining", "total_amount": "300.00"},
+                {"category": "Groceries", "total_amount": "100.00"}
+            ],
+            "get-user-categories": [{"category": "Dining"}, {"category": "Groceries"}],
+            "get-category-history": [{"total_amount": "100.00"}, {"total_amount": "120.00"}],
+            "get-user-subscriptions": []
+        })
+        
+        from agent_tools.financial_analyst import FinancialAnalystAgent
+        
+        result = FinancialAnalystAgent().generate_recommendations(mock_user_id)
+        
+        assert result["status"] == "success"
+        assert result["total_recommendations"] > 0
+        history_calls = [kwargs["category"] for name, kwargs in calls if name == "get-category-history"]
+        assert sorted(history_calls) == ["Dining", "Groceries"]
+        # Stages share one spending fetch, which also names the trend categories
+        tool_names = [name for name, _ in calls]
+        assert tool_names.count("get-current-month-spending") == 1
+        assert "get-user-categories" not in tool_names
+        # All recommendations are saved with one bulk insert
+        insert_calls = [kwargs for name, kwargs in calls if name.startswith("insert-recommendation")]
+        assert len(insert_calls) == 1
+        rows = json.loads(insert_calls[0]["recommendations"])
+        assert len(rows) == result["total_recommendations"]
+        # annual_savings is derived on read rather than sent to the insert
+        assert all("annual_savings" not in row for row in rows)
+        for rec in result["recommendations"]:
+            assert rec["annual_savings"] == rec["potential_savings"] * 12
+    
+    def test_prefetch_histories_fetches_failed_categories_once(self, mocker, mock_user_id):
+        """Test that a category whose history fetch fails isn't fetched again"""
+        self._mock_toolbox_client(mocker, {})
+        
+        from agent_tools.financial_analyst import FinancialAnalystAgent, _RunCache
+        
+        agent = FinancialAnalystAgent()
+        
+        def call(name, category, **kwargs):
+            if category == "Travel":
+                raise Exception("tool error")
+            return [{"total_amount": "50.00"}]
+        
+        mocker.patch.object(agent, '_call', side_effect=call)
+        
+        histories = agent._prefetch_histories(_RunCache(), mock_user_id, ["Dining", "Travel", "Dining"])
+        
+        assert histories == {"Dining": [{"total_amount": "50.00"}], "Travel": []}
+        assert agent._call.call_count == 2
+    
+    def test_generate_recommendations_tolerates_null_totals(self, mocker, mock_user_id):
+        """Test that a NULL total_amount row doesn't fail the run"""
+        self._mock_toolbox_client(mocker, {
+            "get-current-month-spending": [
+                {"category": "Dining", "total_amount": "300.00"},
+                {"category": "Gifts", "total_amount": None}
+            ],
+            "get-category-history": [{"total_amount": "100.00"}, {"total_amount": "120.00"}],
+            "get-user-subscriptions": []
+        })
+        
+        from agent_tools.financial_analyst import FinancialAnalystAgent
+        
+        result = FinancialAnalystAgent().generate_recommendations(mock_user_id)
+        
+        assert result["status"] == "success"
+    
+    def test_generate_recommendations_reuses_recent_result(self, mocker, mock_user_id):
+        """Test that a repeat call within the TTL makes no toolbox calls"""
+        calls = self._mock_toolbox_client(mocker, {
+            "get-current-month-spending": [{"category": "Dining", "total_amount": "300.00"}],
+            "get-user-categories": [{"category": "Dining"}],
+            "get-category-history": [{"total_amount": "100.00"}, {"total_amount": "120.00"}],
+            "get-user-subscriptions": []
+        })
+        
+        from agent_tools.financial_analyst import FinancialAnalystAgent
+        
+        agent = FinancialAnalystAgent()
+        first = agent.generate_recommendations(mock_user_id)
+        calls_after_first = len(calls)
+        second = agent.generate_recommendations(mock_user_id)
+        
+        assert second == first
+        assert len(calls) == calls_after_first
+    
+    def test_generate_recommendations_skips_stable_users(self, mocker, mock_user_id):
+        """Test that unchanged spending after an empty run skips the stages"""
+        responses = {
+            "get-current-month-spending": [{"category": "Dining", "total_amount": "100.00"}],
+            "get-category-history": [{"total_amount": "100.00"}, {"total_amount": "100.00"}],
+            "get-user-subscriptions": []
+        }
+        calls = self._mock_toolbox_client(mocker, responses)
+        
+        from agent_tools import financial_analyst
+        
+        agent = financial_analyst.FinancialAnalystAgent()
+        first = agent.generate_recommendations(mock_user_id)
+        assert first["total_recommendations"] == 0
+        
+        financial_analyst._recommendations_cache.clear()
+        del calls[:]
+        responses["get-current-month-spending"] = [{"category": "Dining", "total_amount": "104.00"}]
+        second = agent.generate_recommendations(mock_user_id)
+        
+        assert second["status"] == "success"
+        assert second["total_recommendations"] == 0
+        assert [name for name, _ in calls] == ["get-current-month-spending"]
+        
+        # A larger change runs the stages again
+        financial_analyst._recommendations_cache.clear()
+        del calls[:]
+        responses["get-current-month-spending"] = [{"category": "Dining", "total_amount": "150.00"}]
+        third = agent.generate_recommendations(mock_user_id)
+        
+        assert third["total_recommendations"] > 0
+        assert [name for name, _ in calls].count("get-current-month-spending") == 1
+    
+    def test_generate_daily_summary_empty_day(self, mocker, mock_user_id):
+        """Test that a day without transactions returns without the budget check"""
+        calls = self._mock_toolbox_client(mocker, {"get-user-transactions": []})
+        
+        from agent_tools.financial_analyst import FinancialAnalystAgent
+        
+        result = FinancialAnalystAgent().generate_daily_summary(mock_user_id, "2024-01-15")
+        
+        assert result["status"] == "success"
+        assert result["transaction_count"] == 0
+        assert result["summary_text"] == "No transactions on 2024-01-15"
+        assert result["budget_alerts"] == []
+        assert [name for name, _ in calls].count("get-user-transactions") == 1
+    
+    def test_generate_daily_summary_checks_budget_during_fetch(self, mocker, mock_user_id):
+        """Test that the budget check runs while today's transactions are fetched"""
+        import threading
+        
+        barrier = threading.Barrier(2, timeout=5)
+        responses = {
+            "get-user-transactions": [{"merchant_name": "Cafe", "amount": "4.50", "category": "Dining"}],
+            "get-current-month-spending": [{"category": "Dining", "total_amount": "300.00"}],
+            "get-category-history": [{"total_amount": "100.00"}]
+        }
+        
+        def load_tool(name):
+            def tool(**kwargs):
+                if name in ("get-user-transactions", "get-current-month-spending"):
+                    barrier.wait()
+                return responses[name]
+            return tool
+        
+        mock_client = MagicMock()
+        mock_client.load_tool.side_effect = load_tool
+        mocker.patch('agent_tools.financial_analyst.ToolboxSyncClient', return_value=mock_client)
+        
+        from agent_tools.financial_analyst import FinancialAnalystAgent
+        
+        result = FinancialAnalystAgent().generate_daily_summary(mock_user_id, "2024-01-15")
+        
+        assert result["transaction_count"] == 1
+        assert result["budget_alerts"] == ["Dining: $300.00 (120% of baseline)"]
+    
+    def test_generate_daily_summary_fetches_transactions_once(self, mocker, mock_user_id):
+        """Test that the subscription check reuses the day's transactions"""
+        calls = self._mock_toolbox_client(mocker, {
+            "get-user-transactions": [
+                {"merchant_name": "Netflix", "amount": "15.99", "category": "Entertainment"},
+                {"merchant_name": "Cafe", "amount": "4.50", "category": "Dining"}
+            ],
+            "get-current-month-spending": []
+        })
+        
+        from agent_tools.financial_analyst import FinancialAnalystAgent
+        
+        result = FinancialAnalystAgent().generate_daily_summary(mock_user_id, "2024-01-15")
+        
+        assert result["transaction_count"] == 2
+        assert result["subscriptions_charged"] == [{"merchant": "NETFLIX", "amount": 15.99}]
+        assert [name for name, _ in calls].count("get-user-transactions") == 1
+
+
+class TestFinancialAnalystTools:
+    """Tests for the ADK financial analyst tool functions"""
+    
+    def _mock_toolbox(self, mocker, responses):
+        """Patch the lazy toolbox so call_tool returns responses[name]; returns the call log"""
+        calls = []
+        
+        def call_tool(name, **kwargs):
+            calls.append((name, kwargs))
+            if name not in responses:
+                return {"success": False, "error": f"unknown tool {name}", "data": None}
+            return {"success": True, "data": responses[name]}
+        
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = call_tool
+        mocker.patch('agent_tools.financial_analyst_tools._get_toolbox', return_value=mock_toolbox)
+        # Start every test with an empty history cache
+        from agent_tools.financial_analyst_tools import _history_cache
+        _history_cache.clear()
+        return calls
+    
+    def test_analyze_budget_health_uses_one_baseline_query(self, mocker, mock_user_id):
+        """Test that baselines for all categories come from one aggregate query"""
+        calls = self._mock_toolbox(mocker, {
+            "get-current-month-spending": [
+                {"category": "Dining", "total_amount": "300.00"},
+                {"category": "Groceries", "total_amount": "100.00"}
+            ],
+            "get-category-baselines": [
+                {"category": "Dining", "baseline": "110.00"},
+                {"category": "Groceries", "baseline": "100.00"}
+            ]
+        })
+        
+        from agent_tools.financial_analyst_tools import analyze_budget_health
+        
+        result = analyze_budget_health(mock_user_id)
+        
+        assert result["status"] == "success"
+        assert [a["category"] for a in result["alerts"]] == ["Dining"]
+        assert [name for name, _ in calls] == ["get-current-month-spending", "get-category-baselines"]
+    
+    def test_predict_spending_trends_fetches_histories_in_one_call(self, mocker, mock_user_id):
+        """Test that trend histories for all categories come from one batched query"""
+        calls = self._mock_toolbox(mocker, {
+            "get-user-categories": [{"category": "Dining"}, {"category": "Groceries"}],
+            "get-multi-category-history": [
+                {"category": "Dining", "total_amount": "200.00"},
+                {"category": "Dining", "total_amount": "100.00"},
+                {"category": "Groceries", "total_amount": "100.00"},
+                {"category": "Groceries", "total_amount": "100.00"}
+            ]
+        })
+        
+        from agent_tools.financial_analyst_tools import predict_spending_trends
+        
+        result = predict_spending_trends(mock_user_id)
+        
+        assert result["status"] == "success"
+        assert [t["category"] for t in result["trends"]] == ["Dining"]
+        assert [name for name, _ in calls] == ["get-user-categories", "get-multi-category-history"]
+        assert json.loads(calls[1][1]["categories"]) == ["Dining", "Groceries"]
+    
+    def test_history_falls_back_to_per_category_calls(self, mocker, mock_user_id):
+        """Test the per-category fallback when the batched tool is unavailable"""
+        calls = self._mock_toolbox(mocker, {
+            "get-current-month-spending": [{"category": "Dining", "total_amount": "300.00"}],
+            "get-category-history": [{"total_amount": "100.00"}, {"total_amount": "120.00"}]
+        })
+        
+        from agent_tools.financial_analyst_tools import analyze_budget_health
+        
+        result = analyze_budget_health(mock_user_id)
+        
+        assert result["total_recommendations"] == 1
+        assert [name for name, _ in calls].count("get-category-history") == 1
+    
+    def test_history_fallback_covers_every_category(self, mocker, mock_user_id):
+        """Test that the concurrent fallback returns a history for each category"""
+        calls = self._mock_toolbox(mocker, {
+            "get-category-history": [{"total_amount": "50.00"}]
+        })
+        
+        from agent_tools.financial_analyst_tools import _get_categories_history_bulk, _get_toolbox
+        
+        categories = [f"Category {i}" for i in range(20)]
+        histories = _get_categories_history_bulk(_get_toolbox(), mock_user_id, categories)
+        
+        assert list(histories) == categories
+        assert all(h == [{"total_amount": "50.00"}] for h in histories.values())
+        fetched = [kwargs["category"] for name, kwargs in calls if name == "get-category-history"]
+        assert sorted(fetched) == sorted(categories)
+    
+    def test_histories_are_shared_across_tool_calls(self, mocker, mock_user_id):
+        """Test that a second analysis reuses cached histories until invalidated"""
+        calls = self._mock_toolbox(mocker, {
+            "get-current-month-spending": [{"category": "Dining", "total_amount": "300.00"}],
+            "get-multi-category-history": [{"category": "Dining", "total_amount": "100.00"}]
+        })
+        
+        from agent_tools.financial_analyst_tools import (
+            analyze_budget_health, find_savings_opportunities, invalidate_history_cache
+        )
+        
+        analyze_budget_health(mock_user_id)
+        savings = find_savings_opportunities(mock_user_id)
+        
+        assert savings["status"] == "success"
+        assert len(savings["opportunities"]) == 1
+        assert [name for name, _ in calls].count("get-multi-category-history") == 1
+        
+        invalidate_history_cache(mock_user_id)
+        analyze_budget_health(mock_user_id)
+        
+        assert [name for name, _ in calls].count("get-multi-category-history") == 2
+
+    
+    def test_save_recommendations_bulk_uses_one_insert(self, mocker, mock_user_id):
+        """Test that several recommendations are saved with a single insert"""
+        calls = self._mock_toolbox(mocker, {"insert-recommendations-bulk": []})
+        
+        from agent_tools.financial_analyst_tools import save_recommendations_bulk
+        
+        result = save_recommendations_bulk(mock_user_id, [
+            {"type": "budget_alert", "title": "Over Budget in Dining", "potential_savings": 50.0, "category": "Dining"},
+            {"type": "expensive_subscription", "title": "Review Gym", "potential_savings": "60", "merchant": "Gym"}
+        ])
+        
+        assert result["status"] == "success"
+        assert result["saved"] == 2
+        assert [name for name, _ in calls] == ["insert-recommendations-bulk"]
+        rows = json.loads(calls[0][1]["recommendations"])
+        assert [row["recommendation_type"] for row in rows] == ["budget_alert", "expensive_subscription"]
+        assert rows[1]["potential_savings"] == 60.0
+        assert rows[1]["related_merchant"] == "Gym"
+    
+    def test_unavailable_toolbox_is_not_retried_every_call(self, mocker, mock_user_id):
+        """Test that a failed connection falls back to sample data without reconnecting"""
+        get_toolbox = mocker.patch('agent_tools.toolbox_wrapper.get_toolbox', side_effect=ConnectionError("down"))
+        mocker.patch('agent_tools.financial_analyst_tools._toolbox', None)
+        mocker.patch('agent_tools.financial_analyst_tools._toolbox_unavailable_until', 0.0)
+        
+        from agent_tools.financial_analyst_tools import analyze_budget_health, optimize_subscriptions
+        
+        assert "note" in analyze_budget_health(mock_user_id)
+        assert "note" in optimize_subscriptions(mock_user_id)
+        assert get_toolbox.call_count == 1
+    
+    def test_offline_results_are_independent_copies(self, mocker, mock_user_id):
+        """Test that editing one sample-data result doesn't change the next"""
+        mocker.patch('agent_tools.financial_analyst_tools._get_toolbox', return_value=None)
+        
+        from agent_tools.financial_analyst_tools import analyze_budget_health, generate_daily_summary
+        
+        first = analyze_budget_health(mock_user_id)
+        first["recommendations"].clear()
+        summary = generate_daily_summary(mock_user_id, "2024-12-01")
+        summary["spending_by_category"]["Dining"] = 0
+        
+        assert len(analyze_budget_health(mock_user_id)["recommendations"]) == 1
+        assert generate_daily_summary(mock_user_id, "2024-12-01")["spending_by_category"]["Dining"] == 35.00
+
+
+class TestToolboxWrapper:
+    """Tests for the MCP Toolbox wrapper"""
+    
+    def test_call_tool_decodes_json_results(self, mocker):
+        """Test that JSON text results are returned as Python objects"""
+        mock_client = MagicMock()
+        mock_client.load_tool.return_value = MagicMock(return_value='[{"category": "Dining"}]')
+        mocker.patch('agent_tools.toolbox_wrapper.ToolboxSyncClient', return_value=mock_client)
+        
+        from agent_tools.toolbox_wrapper import ToolboxWrapper
+        
+        result = ToolboxWrapper("http://toolbox").call_tool('get-user-categories', user_id="u1")
+        
+        assert result["success"] is True
+        assert result["data"] == [{"category": "Dining"}]
+        assert result["rows"] == [{"category": "Dining"}]
+    
+    def test_call_tool_keeps_non_json_text(self, mocker):
+        """Test that a plain text result is passed through unchanged"""
+        mock_client = MagicMock()
+        mock_client.load_tool.return_value = MagicMock(return_value="OK")
+        mocker.patch('agent_tools.toolbox_wrapper.ToolboxSyncClient', return_value=mock_client)
+        
+        from agent_tools.toolbox_wrapper import ToolboxWrapper
+        
+        result = ToolboxWrapper("http://toolbox").call_tool('mark-transactions-complete', transaction_ids="t1")
+        
+        assert result["data"] == "OK"
+    
+    def test_toolbox_cache_reuses_successful_calls(self):
+        """Test that identical calls hit the toolbox once and failures are retried"""
+        mock_toolbox = MagicMock()
+        mock_toolbox.call_tool.side_effect = lambda name, **kwargs: {
+            "success": name != "broken", "data": [kwargs]
+        }
+        
+        from agent_tools.toolbox_wrapper import ToolboxCache
+        
+        cache = ToolboxCache(mock_toolbox)
+        first = cache.call_tool("get-top-merchants", user_id="u1", limit=100)
+        assert cache.call_tool("get-top-merchants", limit=100, user_id="u1") is first
+        cache.call_tool("get-top-merchants", user_id="u2", limit=100)
+        cache.call_tool("broken", user_id="u1")
+        cache.call_tool("broken", user_id="u1")
+        
+        assert mock_toolbox.call_tool.call_count == 4
+    
+    def test_ttl_cache_expires_and_evicts(self, mocker):
+        """Test that entries expire after their TTL and the least recently used is evicted"""
+        import agent_tools.toolbox_wrapper as wrapper
+        
+        now = [1000.0]
+        mocker.patch.object(wrapper.time, 'monotonic', side_effect=lambda: now[0])
+        
+        cache = wrapper.TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", None, ttl=10)
+        assert cache.get("b", "miss") is None
+        assert cache.get("a") == 1
+        
+        now[0] += 30
+        assert cache.get("b", "miss") == "miss"
+        
+        cache.set("c", 3)
+        cache.set("d", 4)
+        assert cache.get("a") is None
+        assert cache.keys() == ["c", "d"]
@@ -167,6 +167,13 @@ def show_profile_tab(db, current_user):
                     **profile_data
                 )
                 
+                # Fraud checks cache profiles - make them see the new one
+                try:
+                    from agent_tools.fraud_detector import invalidate_user_profile
+                    invalidate_user_profile(current_user['id'])
+                except ImportError:
+                    pass
+                
                 # Update session
                 st.session_state.current_user.update(profile_data)
                 